@@ -0,0 +1,216 @@
+"""
+An asyncio (ASGI) variant of the /v1/match (and /metrics) endpoint, with the
+same contract as the Flask endpoint in the server module.
+
+Requires Python 3.5+ and an ASGI server, such as uvicorn:
+
+    uvicorn mme_server.asgi:application
+
+The datastore client is blocking, so each datastore operation runs in a
+bounded pool of threads (sized by MME_ASYNC_THREADS), while the event loop
+keeps accepting and parsing requests. The authentication lookup and the
+vocabulary resolution of each request run concurrently.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import random
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import UnsupportedMediaType, NotAcceptable
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from . import metrics
+from .backend import get_backend
+from .models import MatchRequest, Patient, get_terms
+from .schemas import validate_request, validate_response, ValidationError
+from .server import app, get_match_filters, API_MIME_TYPE
+
+logger = logging.getLogger(__name__)
+
+MATCH_PATH = '/v1/match'
+METRICS_PATH = '/metrics'
+# Content types accepted and produced by the match endpoint
+CONSUMES = [API_MIME_TYPE, 'application/json']
+PRODUCES = [API_MIME_TYPE]
+
+
+class Response:
+    def __init__(self, body, status=200, content_type=API_MIME_TYPE):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+
+    @classmethod
+    def from_exception(cls, e):
+        return cls(e.get_body().encode('utf-8'), e.code, content_type='text/html; charset=utf-8')
+
+    async def send(self, send):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [
+                (b'content-type', self.content_type.encode('latin-1')),
+                (b'content-length', str(len(self.body)).encode('latin-1')),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': self.body,
+        })
+
+
+class MatchApplication:
+    """An ASGI application serving the /v1/match endpoint"""
+    def __init__(self, flask_app=app):
+        self.app = flask_app
+        self._executor = None
+
+    def get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.app.config['MME_ASYNC_THREADS'])
+        return self._executor
+
+    async def run(self, function, *args, **kwargs):
+        """Run the blocking function in the thread pool, within the application context"""
+        def call():
+            with self.app.app_context():
+                return function(*args, **kwargs)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_executor(), call)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: {!r}'.format(scope['type']))
+
+        if scope['path'] == METRICS_PATH and scope['method'] == 'GET':
+            response = Response(metrics.render().encode('utf-8'), content_type=metrics.CONTENT_TYPE)
+        elif scope['path'] != MATCH_PATH:
+            response = Response({'message': 'Not found'}, 404, content_type='application/json')
+        elif scope['method'] != 'POST':
+            response = Response({'message': 'Method not allowed'}, 405, content_type='application/json')
+        else:
+            headers = dict([(key.decode('latin-1').lower(), value.decode('latin-1'))
+                            for key, value in scope['headers']])
+            body = await self.read_body(receive)
+            # Elasticsearch requests are made from the thread pool, so are not counted per request
+            with metrics.tracked_request(in_thread=False) as result:
+                try:
+                    response = await self.match(headers, body)
+                except Exception:
+                    logger.exception("Error handling match request")
+                    response = Response({'message': 'Internal server error'}, 500, content_type='application/json')
+                result['status'] = response.status
+
+        await response.send(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def match(self, headers, body):
+        """Return the Response to a match request, with the given (lowercase) headers and body"""
+        # Content negotiation, as in the Flask endpoint
+        mimetype = parse_options_header(headers.get('content-type', ''))[0].lower()
+        if mimetype not in CONSUMES:
+            return Response.from_exception(UnsupportedMediaType())
+
+        accept = parse_accept_header(headers.get('accept'), MIMEAccept)
+        if not set(accept.values()) & set(PRODUCES):
+            return Response.from_exception(NotAcceptable())
+
+        # Start authenticating, while the request is parsed
+        auth = asyncio.ensure_future(self.run(verify_token, headers.get('x-auth-token')))
+
+        error = None
+        terms = None
+        try:
+            request_json = json.loads(body.decode('utf-8'))
+        except ValueError:
+            error = Response({'message': 'Invalid request JSON'}, 400)
+        else:
+            try:
+                with metrics.timed('validation'):
+                    validate_request(request_json)
+            except ValidationError:
+                error = Response({'message': 'Request does not conform to API specification',
+                                  'request': request_json}, 422)
+            else:
+                # Resolve the vocabulary terms of the query, concurrently with authentication
+                ids = Patient.get_term_ids(request_json['patient'])
+                terms = asyncio.ensure_future(self.run(get_terms, ids))
+
+        logger.info("Authenticating request")
+        try:
+            server = await auth
+        except Exception:
+            if terms is not None:
+                terms.cancel()
+            raise
+
+        if not server:
+            if terms is not None:
+                terms.cancel()
+            return Response({'message': 'X-Auth-Token not authorized'}, 401, content_type='application/json')
+        elif error is not None:
+            return error
+
+        logger.info("Parsing query")
+        terms = await terms
+        with metrics.timed('normalization'):
+            request_obj = MatchRequest.from_api(request_json, terms=terms)
+
+        logger.info("Finding similar patients")
+        with metrics.timed('search'):
+            response_obj = await self.run(request_obj.match, n=5, engine=self.app.config['MME_MATCH_ENGINE'],
+                                          candidates=self.app.config['MME_RERANK_CANDIDATES'],
+                                          filters=get_match_filters(self.app.config, request_obj.patient))
+        response_json = response_obj.to_api()
+
+        if random.random() < self.app.config['MME_VALIDATE_RESPONSE_RATE']:
+            try:
+                logger.info("Validating response syntax")
+                with metrics.timed('response_validation'):
+                    await self.run(validate_response, response_json)
+            except ValidationError as e:
+                # log to console and return response anyway
+                logger.error('Response does not conform to API specification:\n{}\n\nResponse:\n{}'.format(e, response_json))
+
+        with metrics.timed('serialization'):
+            return Response(response_json)
+
+
+def verify_token(token):
+    """Return the client server authorized by the token, if any"""
+    servers = get_backend().get_manager('servers')
+    with metrics.timed('auth'):
+        return servers.verify(token)
+
+
+application = MatchApplication()
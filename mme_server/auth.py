@@ -13,6 +13,7 @@ from functools import wraps
 
 from flask import request, jsonify
 
+from . import metrics
 from .backend import get_backend
 
 
@@ -27,7 +28,8 @@ def auth_token_required():
             token = request.headers.get('X-Auth-Token')
             backend = get_backend()
             servers = backend.get_manager('servers')
-            server = servers.verify(token)
+            with metrics.timed('auth'):
+                server = servers.verify(token)
             if not server:
                 error = jsonify(message='X-Auth-Token not authorized')
                 error.status_code = 401
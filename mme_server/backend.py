@@ -4,20 +4,56 @@ Module for accessing the backend connection
 
 from __future__ import with_statement, division, unicode_literals
 
+import os
 import logging
+import threading
 import flask
 
 from elasticsearch import Elasticsearch
 
 from .managers import Managers
+from .metrics import CountingTransport
+from .managers.memory import MemoryPatientManager
+from .managers.patients import PatientManager
+from .managers.vocabularies import VocabularyManager
 
 logger = logging.getLogger(__name__)
 
+# Process-wide backend, shared by all requests and threads
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(config):
+    """Create Managers with a new, pooled elasticsearch client configured by the given settings"""
+    hosts = config['MME_ELASTICSEARCH_HOSTS']
+    logger.info("Connecting to elasticsearch: {}".format(hosts))
+    es = Elasticsearch(hosts,
+                       transport_class=CountingTransport,
+                       maxsize=config['MME_ELASTICSEARCH_POOL_SIZE'],
+                       timeout=config['MME_ELASTICSEARCH_TIMEOUT'])
+    VocabularyManager.PRELOAD_TERMS = config['MME_PRELOAD_TERMS']
+    VocabularyManager.GENERATION_TTL = config['MME_GENERATION_TTL']
+    snapshot = config['MME_ONTOLOGY_SNAPSHOT']
+    # Resolved once, so it does not depend on the working directory of later lookups
+    VocabularyManager.SNAPSHOT_FILENAME = os.path.abspath(snapshot) if snapshot else None
+    PatientManager.configure_match_query(config['MME_MATCH_RESCORE_FRACTION'], config['MME_MATCH_DROP_FRACTION'],
+                                         config['MME_MATCH_MIN_CANDIDATES'])
+    PatientManager.configure_match_cache(config['MME_MATCH_CACHE_SIZE'], config['MME_MATCH_CACHE_TTL'],
+                                         config['MME_GENERATION_TTL'])
+    MemoryPatientManager.FILENAME = config['MME_MEMORY_PATIENTS']
+    return Managers(es, stores={'patients': config['MME_PATIENT_STORE']})
 
 
 def get_backend():
-    backend = getattr(flask.g, '_mme_backend', None)
-    if backend is None:
-        backend = flask.g._mme_backend = Managers(Elasticsearch())
+    global _backend, _backend_pid
 
-    return backend
+    # Connections cannot be shared with forked processes, so each process has its own
+    if _backend is None or _backend_pid != os.getpid():
+        with _backend_lock:
+            if _backend is None or _backend_pid != os.getpid():
+                _backend = create_backend(flask.current_app.config)
+                _backend_pid = os.getpid()
+
+    return _backend
@@ -0,0 +1,296 @@
+"""
+Module for benchmarking patient ingest and the match path, with synthetic cohorts.
+
+Synthetic patients are sampled from the loaded vocabularies: a set of
+synthetic diseases is drawn, each a subtree of the HPO (under Phenotypic
+abnormality) with a causative gene, and each patient has a random subset of
+the phenotypes of one disease, a random unrelated phenotype, and (sometimes)
+the disease gene. Query patients are drawn from the same diseases, so they
+have realistic matches.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import os
+import json
+import math
+import time
+import random
+import logging
+
+from binascii import hexlify
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from . import metrics
+from .backend import get_backend
+from .server import app, API_MIME_TYPE
+
+logger = logging.getLogger(__name__)
+
+# Phenotypic abnormality, the root of the sampled subtrees
+PHENOTYPE_ROOT = 'HP:0000118'
+# The stages of a match request, in order
+STAGES = ['auth', 'validation', 'normalization', 'search', 'serialization', 'response_validation']
+
+
+def get_vocabularies():
+    """Return the (Ontology, list of gene ids) of the loaded vocabularies"""
+    vocabularies = get_backend().get_manager('vocabularies')
+    resolver = vocabularies.get_resolver()
+    ontology = resolver.get_ontology()
+    genes = sorted([id for id in resolver.get_ids() if id not in ontology])
+    return ontology, genes
+
+
+class CohortGenerator:
+    """Generates synthetic patient records in API format
+
+    Each of the diseases is the set of up to disease_size terms of a subtree
+    of the ontology, and one gene. Patients have between min_features and
+    max_features phenotypes of their disease, and its gene with probability
+    gene_rate. Patients are generated deterministically from the seed and
+    their id.
+    """
+    def __init__(self, ontology, genes, diseases=1000, disease_size=30, min_features=3, max_features=10,
+                 gene_rate=0.5, seed=0):
+        self.ontology = ontology
+        self.genes = genes
+        self.min_features = min_features
+        self.max_features = max_features
+        self.gene_rate = gene_rate
+        self.seed = seed
+
+        children = [[] for i in range(len(ontology))]
+        for i in range(len(ontology)):
+            for parent in ontology.get_parent_indices(i):
+                children[parent].append(i)
+        self._children = children
+
+        if PHENOTYPE_ROOT in ontology:
+            self._terms = [ontology.ids[i] for i in self._get_descendants(ontology.get_index(PHENOTYPE_ROOT))]
+        else:
+            self._terms = list(ontology.ids)
+
+        rng = random.Random('{}-diseases'.format(seed))
+        self.diseases = [self._get_disease(rng, disease_size) for i in range(diseases)]
+
+    def _get_descendants(self, i, limit=None):
+        """Return the indices of the term and its descendants, breadth-first (at most limit)"""
+        seen = set([i])
+        descendants = [i]
+        for term in descendants:
+            for child in self._children[term]:
+                if child not in seen:
+                    if limit is not None and len(descendants) >= limit:
+                        return descendants
+                    seen.add(child)
+                    descendants.append(child)
+        return descendants
+
+    def _get_disease(self, rng, size):
+        """Return the (phenotype ids, gene id) of a disease, from the subtree of a random term"""
+        ontology = self.ontology
+        i = ontology.get_index(rng.choice(self._terms))
+        # Widen the subtree by moving up to the grandparent, staying under the phenotype root
+        for level in range(2):
+            parents = [parent for parent in ontology.get_parent_indices(i)
+                       if ontology.ids[parent] != PHENOTYPE_ROOT]
+            if parents:
+                i = rng.choice(parents)
+
+        terms = [ontology.ids[term] for term in self._get_descendants(i, limit=size * 4)]
+        if len(terms) > size:
+            terms = rng.sample(terms, size)
+        gene = rng.choice(self.genes) if self.genes else None
+        return terms, gene
+
+    def get_patient(self, id):
+        rng = random.Random('{}-{}'.format(self.seed, id))
+        terms, gene = rng.choice(self.diseases)
+        n_features = min(len(terms), rng.randint(self.min_features, self.max_features))
+        features = rng.sample(terms, n_features)
+        noise = rng.choice(self._terms)
+        if noise not in features:
+            features.append(noise)
+
+        patient = {
+            'id': id,
+            'label': 'Synthetic patient {}'.format(id),
+            'contact': {
+                'name': 'Benchmark',
+                'href': 'mailto:benchmark@example.com',
+            },
+            'features': [{'id': term, 'observed': 'yes'} for term in features],
+            'test': True,
+        }
+        if gene and rng.random() < self.gene_rate:
+            patient['genomicFeatures'] = [{'gene': {'id': gene}}]
+        return patient
+
+    def iter_patients(self, n, prefix='bench'):
+        for i in range(n):
+            yield self.get_patient('{}-{}'.format(prefix, i))
+
+
+def get_percentile(values, fraction):
+    """Return the nearest-rank percentile of a sorted list of values"""
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def summarize(values):
+    """Return a dict of the count, mean, percentiles and maximum of a list of latencies (in seconds)"""
+    values = sorted(values)
+    return OrderedDict([
+        ('count', len(values)),
+        ('mean', sum(values) / len(values) if values else None),
+        ('p50', get_percentile(values, 0.5)),
+        ('p90', get_percentile(values, 0.9)),
+        ('p99', get_percentile(values, 0.99)),
+        ('max', values[-1] if values else None),
+    ])
+
+
+def get_headers(token):
+    return {
+        'X-Auth-Token': token,
+        'Content-Type': API_MIME_TYPE,
+        'Accept': API_MIME_TYPE,
+    }
+
+
+def run_match(request_json, token):
+    """Send a match request to the /v1/match endpoint of the in-process app, returning the seconds of each stage
+
+    The request is handled in the current thread, by the same code as requests
+    to a server, and its stages are timed by the metrics of the endpoint.
+    """
+    response = app.test_client().post('/v1/match', data=json.dumps(request_json), headers=get_headers(token))
+    if response.status_code != 200:
+        raise Exception('Unexpected status: {}'.format(response.status_code))
+    return metrics.get_request_stages()
+
+
+def send_match(http, url, token, request_json):
+    """Send a match request to the server at url, raising an Exception unless it succeeds"""
+    response = http.request('POST', '{}/v1/match'.format(url.rstrip('/')), headers=get_headers(token),
+                            body=json.dumps(request_json).encode('utf-8'))
+    if response.status != 200:
+        raise Exception('Unexpected status: {}'.format(response.status))
+
+
+def run_clients(requests, token, clients=4, url=None):
+    """Send the match requests from concurrent clients, returning the latency, QPS and stage results
+
+    Requests are handled in-process (with per-stage timings), or sent to the
+    server at url.
+    """
+    if url:
+        # Import within function, to only load the connection pools when needed
+        from .federation import get_http
+        http = get_http(pool_size=clients)
+
+    def handle(request_json):
+        start = time.time()
+        timings = None
+        try:
+            if url:
+                send_match(http, url, token, request_json)
+            else:
+                timings = run_match(request_json, token)
+            error = None
+        except Exception as e:
+            error = str(e)
+        return time.time() - start, timings, error
+
+    latencies = []
+    stages = dict([(stage, []) for stage in STAGES])
+    errors = []
+    pool = ThreadPool(clients)
+    start = time.time()
+    try:
+        for latency, timings, error in pool.imap_unordered(handle, requests):
+            if error is not None:
+                errors.append(error)
+                continue
+            latencies.append(latency)
+            for stage, seconds in (timings or {}).items():
+                stages[stage].append(seconds)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    if errors:
+        logger.error("{} of {} match requests failed, e.g.: {}".format(len(errors), len(requests), errors[0]))
+
+    results = OrderedDict([
+        ('requests', len(requests)),
+        ('errors', len(errors)),
+        ('seconds', elapsed),
+        ('qps', len(latencies) / elapsed if elapsed else None),
+        ('latency', summarize(latencies)),
+    ])
+    if not url:
+        results['stages'] = OrderedDict([(stage, summarize(stages[stage])) for stage in STAGES if stages[stage]])
+    return results
+
+
+def bench(patients=1000, queries=1000, clients=4, url=None, seed=0, cleanup=True, **kwargs):
+    """Index a synthetic cohort, and measure match requests against it, returning the results as a dict
+
+    patients - the number of patients to index (0 to query the existing patients)
+    queries - the number of (distinct) match requests
+    clients - the number of concurrent clients sending match requests
+    url - the base url of a running server to send the requests to (else, they are handled in-process)
+    cleanup - whether to delete the indexed patients afterwards
+    kwargs - options for index_records (batch_size, processes, concurrency)
+    """
+    backend = get_backend()
+    patient_manager = backend.get_manager('patients')
+    servers = backend.get_manager('servers')
+
+    logger.info("Generating diseases from the loaded vocabularies")
+    ontology, genes = get_vocabularies()
+    generator = CohortGenerator(ontology, genes, diseases=max(10, min(1000, patients // 10)), seed=seed)
+
+    results = OrderedDict()
+    results['config'] = OrderedDict([
+        ('patients', patients),
+        ('queries', queries),
+        ('clients', clients),
+        ('store', app.config['MME_PATIENT_STORE']),
+        ('engine', app.config['MME_MATCH_ENGINE']),
+        ('url', url),
+        ('seed', seed),
+    ])
+
+    # A temporary client, to authenticate the match requests
+    client_id = 'bench-{}'.format(hexlify(os.urandom(4)).decode())
+    token = hexlify(os.urandom(30)).decode()
+    servers.add(server_id=client_id, server_label='Benchmark', server_key=token, direction='in')
+    try:
+        if patients:
+            logger.info("Indexing {} synthetic patients".format(patients))
+            start = time.time()
+            patient_manager.index_records(generator.iter_patients(patients), **kwargs)
+            elapsed = time.time() - start
+            results['ingest'] = OrderedDict([
+                ('patients', patients),
+                ('seconds', elapsed),
+                ('patients_per_second', patients / elapsed if elapsed else None),
+            ])
+
+        try:
+            logger.info("Sending {} match requests from {} clients".format(queries, clients))
+            requests = [{'patient': patient} for patient in generator.iter_patients(queries, prefix='query')]
+            results['match'] = run_clients(requests, token, clients=clients, url=url)
+        finally:
+            if patients and cleanup:
+                logger.info("Deleting synthetic patients")
+                patient_manager.delete_records(['bench-{}'.format(i) for i in range(patients)])
+    finally:
+        servers.remove(server_id=client_id, direction='in')
+
+    return results
@@ -0,0 +1,59 @@
+"""
+Module providing a simple in-memory cache.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe, size-limited cache that evicts the least-recently-used items
+
+    Items expire after ttl seconds (if not None), which can be overridden for
+    each item.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expiry time or None, value), least-recently-used first
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+
+            expires, value = item
+            if expires is not None and expires <= time.time():
+                return default
+
+            # Re-insert as the most-recently-used item
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -5,6 +5,7 @@ from __future__ import with_statement, division, unicode_literals
 
 import sys
 import os
+import json
 import logging
 import unittest
 
@@ -53,7 +54,12 @@ def quickstart(data_filename, data_url, hpo_filename, hpo_url, gene_filename, ge
     index_file('patients', data_filename, data_url)
 
 
-def index_file(index, filename, url):
+def index_file(index, filename, url, **kwargs):
+    """Index the given file (downloading it from url if missing)
+
+    Additional keyword arguments (e.g., batch_size) are passed to the
+    indexer; options left as None use the indexer defaults.
+    """
     fetch_resource(filename, url)
 
     with app.app_context():
@@ -65,7 +71,14 @@ def index_file(index, filename, url):
             'genes': vocabularies.index_genes,
             'patients': patients.index_file,
         }
-        index_funcs[index](filename=filename)
+        kwargs = dict([(key, value) for key, value in kwargs.items() if value is not None])
+        if index != 'patients':
+            # Vocabularies are parsed in-process
+            kwargs.pop('processes', None)
+            kwargs.pop('server', None)
+        if index == 'hpo':
+            kwargs['snapshot'] = vocabularies.SNAPSHOT_FILENAME
+        index_funcs[index](filename=filename, **kwargs)
 
 
 def fetch_resource(filename, url):
@@ -120,6 +133,136 @@ def remove_client(id):
     remove_server(id, direction='in')
 
 
+def start_server(host, port, workers=None, threads=None, backlog=None, keep_alive=None, asgi=False):
+    """Start the server, with Flask's development server unless any worker options are given"""
+    if asgi:
+        # Import within function, since uvicorn is an optional dependency
+        try:
+            import uvicorn
+        except ImportError:
+            raise ImportError('uvicorn is required to run the asyncio server (pip install -e .[async])')
+
+        return uvicorn.run('{}.asgi:application'.format(__package__), host=host, port=port,
+                           workers=workers or 1, backlog=backlog or 2048,
+                           timeout_keep_alive=keep_alive or 5)
+
+    options = {
+        'workers': workers,
+        'threads': threads,
+        'backlog': backlog,
+        'keep_alive': keep_alive,
+    }
+    options = dict([(key, value) for key, value in options.items() if value is not None])
+    if not options:
+        return app.run(host=host, port=port)
+
+    # Import within function, since gunicorn is an optional dependency
+    from .production import serve
+    serve(host=host, port=port, **options)
+
+
+def match_servers(filename, timeout=None, deadline=None):
+    """Send the match request in the given JSON file to all outgoing servers, printing the merged results"""
+    from . import federation
+    from .schemas import validate_request
+
+    with open(filename) as ifp:
+        request_json = json.load(ifp)
+    validate_request(request_json)
+
+    with app.app_context():
+        backend = get_backend()
+        servers_manager = backend.get_manager('servers')
+        servers = servers_manager.get_servers()
+        if timeout is None:
+            timeout = app.config['MME_FEDERATION_TIMEOUT']
+        if deadline is None:
+            deadline = app.config['MME_FEDERATION_DEADLINE']
+
+        response = federation.match_servers(request_json, servers, timeout=timeout, deadline=deadline,
+                                            pool_size=app.config['MME_FEDERATION_POOL_SIZE'])
+
+        # Store the latest health of each server, for later requests and listing
+        for server in servers:
+            servers_manager.update_health(server['server_id'], federation.get_health(server).to_dict())
+
+    for outcome in response['servers']:
+        logger.info("Server {server_id!r}: {status} in {elapsed:.2f}s".format(**outcome))
+    print(json.dumps(response, indent=2, sort_keys=True))
+
+
+def run_benchmark(patients, queries, clients, url=None, store=None, seed=0, output=None, keep=False, **kwargs):
+    """Benchmark ingest and match requests with a synthetic cohort, printing (or writing) the results as JSON"""
+    from .bench import bench
+
+    if store:
+        app.config['MME_PATIENT_STORE'] = store
+
+    with app.app_context():
+        kwargs = dict([(key, value) for key, value in kwargs.items() if value is not None])
+        results = bench(patients=patients, queries=queries, clients=clients, url=url, seed=seed,
+                        cleanup=not keep, **kwargs)
+
+    data = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as ofp:
+            ofp.write(data + '\n')
+        logger.info("Wrote benchmark results to: {}".format(output))
+    else:
+        print(data)
+
+
+def summarize_profiles(directory=None, top=20):
+    """Print the hottest frames and slowest requests of the profiled match requests"""
+    from .profiler import summarize_profiles
+
+    if directory is None:
+        directory = app.config['MME_PROFILE_DIR']
+    if not os.path.isdir(directory):
+        raise Exception('No profiles found in: {}'.format(directory))
+
+    summary = summarize_profiles(directory, top=top)
+    print('{} profiles, {} samples'.format(summary['profiles'], summary['samples']))
+
+    print('\nMean seconds by stage:')
+    for stage, seconds in sorted(summary['stages'].items(), key=lambda item: -item[1]):
+        print('{:>10.4f}  {}'.format(seconds, stage))
+
+    print('\nSlowest requests:')
+    for seconds, request_id in summary['slowest']:
+        print('{:>10.4f}  {}'.format(seconds, request_id))
+
+    for key, title in [('self', 'Hottest frames (self)'), ('total', 'Hottest frames (total)')]:
+        print('\n{}:'.format(title))
+        for frame, fraction in summary[key]:
+            print('{:>9.1%}  {}'.format(fraction, frame))
+
+
+def print_term_stats(field='phenotype', top=20, rebuild=False):
+    """Print the most and least frequent phenotypes (or genes) of the stored patients"""
+    with app.app_context():
+        backend = get_backend()
+        patients = backend.get_manager('patients')
+        if rebuild:
+            logger.info("Recounting the phenotypes and genes of all patients")
+            stats = patients.rebuild_term_stats()
+        else:
+            stats = patients.get_term_stats()
+
+        most_common = stats.get_most_common(field, top)
+        least_common = stats.get_least_common(field, top)
+        vocabularies = backend.get_manager('vocabularies')
+        terms = vocabularies.get_terms([term for term, count in most_common + least_common])
+
+    n_patients = len(stats)
+    print('{} patients, {} distinct {}s'.format(n_patients, len(stats.counts.get(field, {})), field))
+    for title, items in [('Most frequent', most_common), ('Least frequent', least_common)]:
+        print('\n{} {}s:'.format(title, field))
+        for term, count in items:
+            names = (terms.get(term) or {}).get('name') or ['']
+            print('{:>8}  {:>6.1%}  {}  {}'.format(count, count / n_patients if n_patients else 0, term, names[0]))
+
+
 def run_tests():
     suite = unittest.TestLoader().discover('.'.join([__package__, 'tests']))
     unittest.TextTestRunner().run(suite)
@@ -157,6 +300,15 @@ def add_server_subcommands(parser, direction):
     else:
         subparser.set_defaults(function=list_clients)
 
+    if server_type == 'server':
+        subparser = subparsers.add_parser('match', description="Send a match request to all servers concurrently, and print their merged results")
+        subparser.add_argument("filename", metavar="FILE", help="A JSON file with the match request")
+        subparser.add_argument("--timeout", dest="timeout", type=float, metavar="SECONDS",
+                               help="The time to wait for each server to respond (default: MME_FEDERATION_TIMEOUT)")
+        subparser.add_argument("--deadline", dest="deadline", type=float, metavar="SECONDS",
+                               help="The time to wait for all servers to respond (default: MME_FEDERATION_DEADLINE)")
+        subparser.set_defaults(function=match_servers)
+
 
 def parse_args(args):
     from argparse import ArgumentParser
@@ -182,9 +334,17 @@ def parse_args(args):
     subparser = subparsers.add_parser('index', description="Index a set of patients or vocabulary")
     subparser.add_argument("index", choices=['hpo', 'genes', 'patients'])
     subparser.add_argument("--filename", metavar="FILE",
-                           help="Load data from the following file (will download from --url if file does not exist)")
+                           help="Load data from the following file (will download from --url if file does not exist); patient files can be a JSON array or newline-delimited JSON")
     subparser.add_argument("--url", dest="url", metavar="URL",
                            help="Download data from the following url")
+    subparser.add_argument("--batch-size", dest="batch_size", type=int, metavar="N",
+                           help="The number of records per bulk request (default: 500 patients, 1000 vocabulary terms)")
+    subparser.add_argument("--processes", dest="processes", type=int, metavar="N",
+                           help="The number of processes used to normalize patients (default: the number of CPUs; ignored for vocabularies)")
+    subparser.add_argument("--concurrency", dest="concurrency", type=int, metavar="N",
+                           help="The maximum number of bulk requests in flight (default: 2 for patients, 4 for vocabularies)")
+    subparser.add_argument("--server", dest="server", metavar="ID",
+                           help="The id of the server that submitted the patients, by which matches can be filtered (see MME_MATCH_FILTERS)")
     subparser.set_defaults(function=index_file)
 
     subparser = subparsers.add_parser('start', description="Start running a simple Matchmaker Exchange API server")
@@ -194,7 +354,17 @@ def parse_args(args):
     subparser.add_argument("--host", default=DEFAULT_HOST,
                            dest="host", metavar="IP",
                            help="The host the server will listen to (0.0.0.0 to listen globally; 127.0.0.1 to listen locally; default: %(default)s)")
-    subparser.set_defaults(function=app.run)
+    subparser.add_argument("--workers", dest="workers", type=int, metavar="N",
+                           help="Serve requests from N pre-forked worker processes with gunicorn, instead of the single-process development server (requires gunicorn; default: 4 if any of the following options are given)")
+    subparser.add_argument("--threads", dest="threads", type=int, metavar="N",
+                           help="The number of request threads in each worker process (default: 1)")
+    subparser.add_argument("--backlog", dest="backlog", type=int, metavar="N",
+                           help="The maximum number of pending connections (default: 2048)")
+    subparser.add_argument("--keep-alive", dest="keep_alive", type=int, metavar="SECONDS",
+                           help="The number of seconds to wait for the next request on a keep-alive connection (default: 5)")
+    subparser.add_argument("--asgi", dest="asgi", action="store_true",
+                           help="Serve /v1/match with the asyncio (ASGI) server, with uvicorn (requires Python 3.5+ and uvicorn; --threads is ignored)")
+    subparser.set_defaults(function=start_server)
 
     subparser = subparsers.add_parser('servers', description="Server authorization sub-commands")
     add_server_subcommands(subparser, direction='out')
@@ -202,6 +372,47 @@ def parse_args(args):
     subparser = subparsers.add_parser('clients', description="Client authorization sub-commands")
     add_server_subcommands(subparser, direction='in')
 
+    subparser = subparsers.add_parser('bench', description="Benchmark ingest and match requests with a synthetic cohort, sampled from the loaded vocabularies")
+    subparser.add_argument("--patients", default=1000, dest="patients", type=int, metavar="N",
+                           help="The number of synthetic patients to index (0 to only query the existing patients; default: %(default)s)")
+    subparser.add_argument("--queries", default=1000, dest="queries", type=int, metavar="N",
+                           help="The number of match requests (default: %(default)s)")
+    subparser.add_argument("--clients", default=4, dest="clients", type=int, metavar="N",
+                           help="The number of concurrent clients sending match requests (default: %(default)s)")
+    subparser.add_argument("--url", dest="url", metavar="URL",
+                           help="Send the match requests to the server running at URL (e.g., http://localhost:8000), instead of handling them in-process with per-stage timings; the server must use the same elasticsearch patients index")
+    subparser.add_argument("--store", dest="store", choices=['elasticsearch', 'memory'],
+                           help="The patient store (default: MME_PATIENT_STORE)")
+    subparser.add_argument("--seed", default=0, dest="seed", type=int, metavar="N",
+                           help="The random seed of the synthetic cohort (default: %(default)s)")
+    subparser.add_argument("--batch-size", dest="batch_size", type=int, metavar="N",
+                           help="The number of patients per bulk request (default: 500)")
+    subparser.add_argument("--processes", dest="processes", type=int, metavar="N",
+                           help="The number of processes used to normalize patients (default: the number of CPUs)")
+    subparser.add_argument("--concurrency", dest="concurrency", type=int, metavar="N",
+                           help="The maximum number of bulk requests in flight (default: 2)")
+    subparser.add_argument("--keep", dest="keep", action="store_true",
+                           help="Keep the synthetic patients, instead of deleting them afterwards")
+    subparser.add_argument("-o", "--output", dest="output", metavar="FILE",
+                           help="Write the results to FILE, instead of printing them")
+    subparser.set_defaults(function=run_benchmark)
+
+    subparser = subparsers.add_parser('profiles', description="Summarize the profiles of slow match requests (see MME_PROFILE)")
+    subparser.add_argument("--directory", dest="directory", metavar="DIR",
+                           help="The directory of the profiles (default: MME_PROFILE_DIR)")
+    subparser.add_argument("--top", default=20, dest="top", type=int, metavar="N",
+                           help="The number of frames and requests to list (default: %(default)s)")
+    subparser.set_defaults(function=summarize_profiles)
+
+    subparser = subparsers.add_parser('stats', description="Print the most and least frequent phenotypes or genes of the stored patients")
+    subparser.add_argument("--field", default='phenotype', dest="field", choices=['phenotype', 'gene'],
+                           help="The terms to list (default: %(default)s)")
+    subparser.add_argument("--top", default=20, dest="top", type=int, metavar="N",
+                           help="The number of most and least frequent terms to list (default: %(default)s)")
+    subparser.add_argument("--rebuild", dest="rebuild", action="store_true",
+                           help="Recount the terms of all patients, replacing the stored statistics (e.g., for indexes created by older versions)")
+    subparser.set_defaults(function=print_term_stats)
+
     subparser = subparsers.add_parser('test', description="Run tests")
     subparser.set_defaults(function=run_tests)
 
@@ -0,0 +1,209 @@
+"""
+Module for sending match requests to other Matchmaker Exchange servers.
+
+A query is sent to all outgoing servers concurrently, over pooled keep-alive
+connections, and their responses are merged as they arrive. Each server has a
+timeout, and servers that have not responded by the overall deadline are
+abandoned.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import os
+import json
+import time
+import logging
+import threading
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+import urllib3
+
+from .health import PeerHealth
+from .schemas import validate_response, ValidationError
+from .server import API_MIME_TYPE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_DEADLINE = 30
+DEFAULT_POOL_SIZE = 4
+
+# Process-wide connection pools, keyed by host
+_http = None
+_http_pid = None
+_http_lock = threading.Lock()
+# Process-wide health of each outgoing server, by server_id
+_peer_health = {}
+_peer_health_lock = threading.Lock()
+
+
+class ServerError(Exception):
+    pass
+
+
+def get_http(pool_size=DEFAULT_POOL_SIZE):
+    """Return the process-wide pool manager, keeping up to pool_size connections open to each server"""
+    global _http, _http_pid
+
+    # Connections cannot be shared with forked processes, so each process has its own
+    if _http is None or _http_pid != os.getpid():
+        with _http_lock:
+            if _http is None or _http_pid != os.getpid():
+                _http = urllib3.PoolManager(maxsize=pool_size, retries=False)
+                _http_pid = os.getpid()
+
+    return _http
+
+
+def get_health(server):
+    """Return the PeerHealth of the server, starting from its stored 'health' on first use in this process"""
+    server_id = server['server_id']
+    health = _peer_health.get(server_id)
+    if health is None:
+        with _peer_health_lock:
+            health = _peer_health.get(server_id)
+            if health is None:
+                health = _peer_health[server_id] = PeerHealth.from_dict(server.get('health') or {})
+    return health
+
+
+def send_match(server, request_json, timeout=DEFAULT_TIMEOUT, http=None):
+    """Send a match request to the server, returning the validated response JSON
+
+    Raises ServerError if the server does not return a valid response.
+    """
+    if http is None:
+        http = get_http()
+
+    url = '{}/match'.format(server['base_url'].rstrip('/'))
+    headers = {
+        'X-Auth-Token': server['server_key'],
+        'Content-Type': API_MIME_TYPE,
+        'Accept': API_MIME_TYPE,
+    }
+    body = json.dumps(request_json).encode('utf-8')
+    try:
+        response = http.request('POST', url, body=body, headers=headers,
+                                timeout=urllib3.Timeout(total=timeout), retries=False)
+    except urllib3.exceptions.HTTPError as e:
+        raise ServerError('Request failed: {}'.format(e))
+
+    if response.status != 200:
+        raise ServerError('Unexpected status: {}'.format(response.status))
+
+    try:
+        response_json = json.loads(response.data.decode('utf-8'))
+        validate_response(response_json)
+    except (ValueError, ValidationError) as e:
+        raise ServerError('Invalid response: {}'.format(e))
+
+    return response_json
+
+
+def iter_server_responses(request_json, servers, timeout=DEFAULT_TIMEOUT, deadline=DEFAULT_DEADLINE,
+                          pool_size=DEFAULT_POOL_SIZE):
+    """Send the match request to all servers concurrently, yielding the outcomes as they arrive
+
+    Yields a dict for each server, with the 'server_id', 'status' ('ok',
+    'error', 'timeout' or 'unavailable'), 'elapsed' seconds, and either the
+    'response' JSON or the 'error' message. Servers that have not responded
+    within deadline seconds are yielded with a 'timeout' status.
+
+    The outcome of each request is recorded in the server's PeerHealth, which
+    shortens its timeout to a margin over its p99 latency, and skips servers
+    whose circuit is open (with an 'unavailable' status).
+    """
+    start = time.time()
+    available = []
+    for server in servers:
+        if get_health(server).allow_request(start):
+            available.append(server)
+        else:
+            yield {
+                'server_id': server['server_id'],
+                'status': 'unavailable',
+                'elapsed': 0,
+                'error': 'Circuit open after repeated failures',
+            }
+
+    if not available:
+        return
+
+    http = get_http(pool_size)
+    # Servers given up on at the deadline, whose outcome is recorded as a failure then
+    abandoned = set()
+    abandoned_lock = threading.Lock()
+
+    def query(server):
+        outcome = {'server_id': server['server_id']}
+        health = get_health(server)
+        # A server is never waited on beyond the deadline
+        server_timeout = min(health.get_timeout(timeout), deadline)
+        try:
+            outcome['response'] = send_match(server, request_json, timeout=server_timeout, http=http)
+            outcome['status'] = 'ok'
+        except Exception as e:
+            logger.warning("Error querying server {!r}: {}".format(server['server_id'], e))
+            outcome['status'] = 'error'
+            outcome['error'] = str(e)
+        outcome['elapsed'] = time.time() - start
+        with abandoned_lock:
+            if server['server_id'] not in abandoned:
+                health.record(outcome['elapsed'], outcome['status'] == 'ok')
+        return outcome
+
+    servers = available
+    pool = ThreadPool(len(servers))
+    try:
+        outcomes = pool.imap_unordered(query, servers)
+        pending = set([server['server_id'] for server in servers])
+        while pending:
+            try:
+                outcome = outcomes.next(timeout=max(0, start + deadline - time.time()))
+            except TimeoutError:
+                break
+            pending.discard(outcome['server_id'])
+            yield outcome
+
+        for server in servers:
+            if server['server_id'] not in pending:
+                continue
+            server_id = server['server_id']
+            logger.warning("Server {!r} did not respond within the deadline".format(server_id))
+            with abandoned_lock:
+                abandoned.add(server_id)
+                get_health(server).record(deadline, False)
+            yield {
+                'server_id': server_id,
+                'status': 'timeout',
+                'elapsed': time.time() - start,
+                'error': 'No response within {}s'.format(deadline),
+            }
+    finally:
+        # Do not wait for abandoned requests, which end by their own timeout
+        pool.close()
+
+
+def match_servers(request_json, servers, **kwargs):
+    """Send the match request to all servers concurrently, returning their merged results
+
+    Returns a dict with the 'results' of all servers, best first, each with
+    the 'server_id' of the server that returned it, and the outcome of each
+    server in 'servers' (see iter_server_responses, for kwargs).
+    """
+    results = []
+    outcomes = []
+    for outcome in iter_server_responses(request_json, servers, **kwargs):
+        response = outcome.pop('response', None)
+        if response is not None:
+            for result in response.get('results', []):
+                results.append(dict(result, server_id=outcome['server_id']))
+            outcome['results'] = len(response.get('results', []))
+        outcomes.append(outcome)
+
+    results.sort(key=lambda result: result['score']['patient'], reverse=True)
+    return {
+        'results': results,
+        'servers': outcomes,
+    }
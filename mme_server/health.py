@@ -0,0 +1,172 @@
+"""
+Module tracking the health of outgoing servers: latency histograms, error
+rates, adaptive timeouts and a circuit breaker.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket
+# counts all slower requests
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class PeerHealth:
+    """Recent latencies and errors of requests to a server, and its circuit breaker
+
+    Counts are halved whenever more than window requests have been recorded,
+    so the statistics follow recent behaviour. The circuit opens after
+    failure_threshold consecutive failures, rejecting requests until
+    reset_timeout seconds have passed, after which a single trial request is
+    allowed (half-open): if it succeeds, the circuit closes, otherwise it
+    opens again. Another trial is allowed if the outcome of a trial is not
+    recorded within reset_timeout seconds.
+    """
+    def __init__(self, window=1000, failure_threshold=5, reset_timeout=60,
+                 min_samples=20, timeout_margin=2.0, min_timeout=1.0):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_samples = min_samples
+        self.timeout_margin = timeout_margin
+        self.min_timeout = min_timeout
+
+        # Latency histogram of successful requests
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            'latencies': list(self.latencies),
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'state': self.state,
+            'opened_at': self.opened_at,
+            'updated_at': self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        health = cls(**kwargs)
+        latencies = data.get('latencies')
+        if latencies and len(latencies) == len(health.latencies):
+            health.latencies = list(latencies)
+        health.successes = data.get('successes', 0)
+        health.failures = data.get('failures', 0)
+        health.consecutive_failures = data.get('consecutive_failures', 0)
+        health.state = data.get('state', CLOSED)
+        health.opened_at = data.get('opened_at')
+        health.updated_at = data.get('updated_at')
+        return health
+
+    def get_requests(self):
+        return self.successes + self.failures
+
+    def get_error_rate(self):
+        requests = self.get_requests()
+        return self.failures / requests if requests else 0
+
+    def get_percentile(self, fraction):
+        """Return the upper bound of the latency bucket containing the given fraction of successful requests
+
+        Returns None if there are no successful requests, and infinity if the
+        percentile is beyond the last bucket.
+        """
+        total = sum(self.latencies)
+        if not total:
+            return None
+
+        cumulative = 0
+        for i, count in enumerate(self.latencies):
+            cumulative += count
+            if cumulative >= fraction * total:
+                break
+        return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+
+    def get_timeout(self, default):
+        """Return the timeout for the next request: a margin over the observed p99 latency, at most default"""
+        if sum(self.latencies) < self.min_samples:
+            return default
+
+        p99 = self.get_percentile(0.99)
+        return min(default, max(self.min_timeout, p99 * self.timeout_margin))
+
+    def allow_request(self, now=None):
+        """Return whether a request may be sent, moving an open circuit to half-open once it is due"""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            elif now - (self.opened_at or 0) >= self.reset_timeout:
+                # Allow a single trial request
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return True
+            else:
+                return False
+
+    def record(self, latency, success, now=None):
+        """Record the outcome of a request that took latency seconds"""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if self.get_requests() >= self.window:
+                self.latencies = [count // 2 for count in self.latencies]
+                self.successes //= 2
+                self.failures //= 2
+
+            self.updated_at = now
+            if success:
+                self.latencies[bisect_left(LATENCY_BUCKETS, latency)] += 1
+                self.successes += 1
+                self.consecutive_failures = 0
+                if self.state != CLOSED:
+                    logger.info("Closing circuit after successful request")
+                self.state = CLOSED
+                self.opened_at = None
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        logger.warning("Opening circuit after {} consecutive failures".format(self.consecutive_failures))
+                    self.state = OPEN
+                    self.opened_at = now
+
+    def summary(self):
+        """Return a dict of display fields: state, requests, error rate and latency percentiles"""
+        def format_latency(latency):
+            if latency is None:
+                return '-'
+            elif latency == float('inf'):
+                return '>{:g}s'.format(LATENCY_BUCKETS[-1])
+            else:
+                return '<={:g}s'.format(latency)
+
+        return {
+            'state': self.state,
+            'requests': self.get_requests(),
+            'error_rate': '{:.1%}'.format(self.get_error_rate()),
+            'p50': format_latency(self.get_percentile(0.5)),
+            'p99': format_latency(self.get_percentile(0.99)),
+        }
@@ -5,33 +5,48 @@ from __future__ import with_statement, division, unicode_literals
 
 import logging
 
+from .memory import MemoryPatientManager
 from .patients import PatientManager
 from .servers import ServerManager
 from .vocabularies import VocabularyManager
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_STORE = 'elasticsearch'
+
 
 class Managers:
+    # name -> store -> Manager class
     _managers = {}
-    _db = None
 
-    def __init__(self, backend):
-        Managers._db = backend
+    def __init__(self, backend, stores=None):
+        self._db = backend
+        # name -> the store used for managers with several implementations
+        self._stores = dict(stores or {})
+        # Manager instances, created on first use and then reused
+        self._instances = {}
 
     @classmethod
-    def add_manager(cls, name, Manager):
+    def add_manager(cls, name, Manager, store=DEFAULT_STORE):
         # name = Manager.NAME
-        logger.debug('Registering manager: {} -> {}'.format(name, Manager))
+        logger.debug('Registering manager: {} ({}) -> {}'.format(name, store, Manager))
         assert name, "Manager name is required"
-        assert name not in cls._managers, "Manager name already registered: {}".format(name)
-        cls._managers[name] = Manager
+        stores = cls._managers.setdefault(name, {})
+        assert store not in stores, "Manager name already registered: {} ({})".format(name, store)
+        stores[store] = Manager
 
-    @classmethod
-    def get_manager(cls, name):
-        return cls._managers[name](cls._db)
+    def get_manager(self, name):
+        manager = self._instances.get(name)
+        if manager is None:
+            store = self._stores.get(name, DEFAULT_STORE)
+            Manager = self._managers[name].get(store)
+            if Manager is None:
+                raise ValueError('Unknown store for {}: {!r}'.format(name, store))
+            manager = self._instances[name] = Manager(self._db)
+        return manager
 
 
 Managers.add_manager('patients', PatientManager)
+Managers.add_manager('patients', MemoryPatientManager, store='memory')
 Managers.add_manager('servers', ServerManager)
 Managers.add_manager('vocabularies', VocabularyManager)
@@ -3,15 +3,23 @@ A base implementation of a manager and metaclass
 """
 from __future__ import with_statement, division, unicode_literals
 
+import time
 import logging
+import threading
 
-from elasticsearch import Elasticsearch
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch import Elasticsearch, RequestError
 from elasticsearch_dsl import Search
 
 logger = logging.getLogger(__name__)
 
 
 class BaseManager:
+    # Names of indices known to exist, to avoid checking before every request
+    _existing_indices = set()
+
     def __init__(self, backend=None):
         self._db = backend
 
@@ -41,10 +49,39 @@ class BaseManager:
 
     def create_index(self):
         logger.info("Creating ElasticSearch index: {!r}".format(self.get_name()))
-        return self.get_db().indices.create(index=self.get_name(), body=self.get_config())
+        response = self.get_db().indices.create(index=self.get_name(), body=self.get_config())
+        BaseManager._existing_indices.add(self.get_name())
+        return response
+
+    def delete_index(self):
+        logger.info("Deleting ElasticSearch index: {!r}".format(self.get_name()))
+        BaseManager._existing_indices.discard(self.get_name())
+        return self.get_db().indices.delete(index=self.get_name())
+
+    def put_mappings(self, doc_types=None):
+        """Add the mappings of the doc types (default: all) in the config to the existing index
+
+        Adds the types and fields of the current version to indexes created by
+        older versions, before documents with them are written (which would
+        otherwise be mapped dynamically). Raises an Exception if a field is
+        already mapped differently, in which case the index must be recreated.
+        """
+        mappings = self.get_config()['mappings']
+        for doc_type in doc_types or sorted(mappings):
+            try:
+                self.get_db().indices.put_mapping(index=self.get_name(), doc_type=doc_type, body=mappings[doc_type])
+            except RequestError as e:
+                raise Exception('Unable to update the mapping of {!r} in index {!r}, delete and reindex it: {}'.format(
+                    doc_type, self.get_name(), e))
 
     def index_exists(self):
-        return self.get_db().indices.exists(index=self.get_name())
+        """Return whether the index exists, only checking the datastore until it does"""
+        name = self.get_name()
+        if name not in BaseManager._existing_indices:
+            if not self.get_db().indices.exists(index=name):
+                return False
+            BaseManager._existing_indices.add(name)
+        return True
 
     def ensure_index_exists(self):
         if not self.index_exists():
@@ -98,7 +135,86 @@ class BaseManager:
     def bulk(self, data, refresh=True, request_timeout=60, **kwargs):
         # Ensure the index exists
         self.ensure_index_exists()
-        self.get_db().bulk(data, index=self.get_name(), request_timeout=request_timeout, **kwargs)
+        response = self.get_db().bulk(data, index=self.get_name(), request_timeout=request_timeout, **kwargs)
         if refresh:
             self.refresh()
+        return response
+
+    @contextmanager
+    def bulk_indexing(self, replicas=False):
+        """Disable refreshes (and, unless replicas is True, replicas) of the index while bulk indexing
+
+        Keep the replicas of indexes that serve requests while they are
+        indexed, so a node failure does not lose their only copy. The previous
+        settings are restored, and the index refreshed once, on exit.
+        """
+        self.ensure_index_exists()
+        name = self.get_name()
+        settings = self.get_db().indices.get_settings(index=name)[name]['settings']['index']
+        previous = {
+            'refresh_interval': settings.get('refresh_interval', '1s'),
+        }
+        changes = {
+            'refresh_interval': '-1',
+        }
+        if not replicas:
+            previous['number_of_replicas'] = settings.get('number_of_replicas', 1)
+            changes['number_of_replicas'] = 0
+        self.get_db().indices.put_settings(index=name, body={'index': changes})
+        try:
+            yield
+        finally:
+            self.get_db().indices.put_settings(index=name, body={'index': previous})
+            self.refresh()
+
+    def send_batches(self, batches, send, concurrency=2):
+        """Call send(batch) for each batch from a pool of threads, with at most concurrency calls in flight
+
+        Batches are only taken from the iterator as calls complete, so memory
+        use is bounded. Logs the throughput and returns the number of items sent.
+        """
+        pool = ThreadPool(concurrency)
+        in_flight = threading.BoundedSemaphore(concurrency)
+        errors = []
+
+        def send_batch(batch):
+            try:
+                send(batch)
+            except Exception as e:
+                logger.exception("Error sending batch to {!r}".format(self.get_name()))
+                errors.append(e)
+            finally:
+                in_flight.release()
+
+        start = time.time()
+        n = 0
+        try:
+            for batch in batches:
+                in_flight.acquire()
+                if errors:
+                    break
+                pool.apply_async(send_batch, (batch,))
+                n += len(batch)
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise errors[0]
+
+        elapsed = time.time() - start
+        logger.info("Indexed {} documents into {!r} in {:.1f}s ({:.0f} docs/s)".format(
+            n, self.get_name(), elapsed, n / elapsed if elapsed else 0))
+        return n
+
+    def iter_batches(self, iterator, batch_size):
+        batch = []
+        for item in iterator:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
 
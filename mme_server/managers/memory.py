@@ -0,0 +1,406 @@
+"""
+An in-process patient store, for deployments, tests and benchmarks without elasticsearch.
+
+Select it with MME_PATIENT_STORE = 'memory'. Patients are kept in inverted
+indexes from each phenotype and gene to the (integer) numbers of the
+patients annotated with it, and matched with the same TF/IDF score as the
+elasticsearch query. The store is process-wide, and is not persisted: set
+MME_MEMORY_PATIENTS to a patients file to load into it on first use.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import math
+import logging
+import threading
+
+from array import array
+from contextlib import contextmanager
+
+from elasticsearch_dsl.result import Result
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .patients import PatientManager
+from .stats import TermStats
+
+logger = logging.getLogger(__name__)
+
+
+class PatientStore:
+    """Patient index documents, with an inverted index of their indexed fields
+
+    Each saved document is given the next integer number, and the postings of
+    each (field, term) are the array of the numbers of the documents with
+    that term, in increasing order. Deleted (and replaced) documents are only
+    marked as deleted, and the postings are rebuilt once most documents are
+    deleted.
+    """
+    FIELDS = ['phenotype', 'gene', 'test', 'server', 'institution']
+    # The values of fields missing from a document, as for the filter queries
+    # of elasticsearch (patients without a test flag are not test patients)
+    DEFAULTS = {'test': False}
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Document number -> id, document (None if deleted), and 1 if live
+            self._ids = []
+            self._docs = []
+            self._live = bytearray()
+            # id -> document number
+            self._numbers = {}
+            # field -> term -> array of document numbers
+            self._postings = dict([(field, {}) for field in self.FIELDS])
+            # field -> term -> number of live documents
+            self._counts = dict([(field, {}) for field in self.FIELDS])
+            self._deleted = 0
+
+    @classmethod
+    def get_terms(cls, doc, field):
+        """Return the set of terms of a field of a document, which may have a single value"""
+        value = doc.get(field, cls.DEFAULTS.get(field))
+        if value is None:
+            return set()
+        if not isinstance(value, list):
+            return set([value])
+        return set(value)
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def get(self, id):
+        """Return the document with the given id, or None"""
+        number = self._numbers.get(id)
+        return self._docs[number] if number is not None else None
+
+    def get_count(self, field, term):
+        """Return the number of documents with the term in the field"""
+        return self._counts[field].get(term, 0)
+
+    def get_counts(self, field):
+        """Return a dict of term -> number of documents with the term in the field"""
+        with self._lock:
+            return dict(self._counts[field])
+
+    def get_frequencies(self):
+        """Return the (live, not copied) dict of field -> term -> number of documents with the term"""
+        return self._counts
+
+    def scan(self):
+        """Iterate over the (id, document) of all documents"""
+        with self._lock:
+            items = list(zip(self._ids, self._docs))
+        for id, doc in items:
+            if doc is not None:
+                yield id, doc
+
+    def save(self, id, doc):
+        """Add a document, replacing any document with the same id"""
+        with self._lock:
+            if id in self._numbers:
+                self._remove(id)
+
+            number = len(self._docs)
+            self._ids.append(id)
+            self._docs.append(doc)
+            self._live.append(1)
+            self._numbers[id] = number
+            for field in self.FIELDS:
+                postings = self._postings[field]
+                counts = self._counts[field]
+                for term in self.get_terms(doc, field):
+                    if term not in postings:
+                        postings[term] = array(str('i'))
+                    postings[term].append(number)
+                    counts[term] = counts.get(term, 0) + 1
+
+    def delete(self, id):
+        """Delete the document with the given id, returning whether it existed"""
+        with self._lock:
+            if id not in self._numbers:
+                return False
+
+            self._remove(id)
+            if self._deleted > max(len(self._numbers), 1000):
+                self._compact()
+            return True
+
+    def _remove(self, id):
+        number = self._numbers.pop(id)
+        doc = self._docs[number]
+        for field in self.FIELDS:
+            counts = self._counts[field]
+            for term in self.get_terms(doc, field):
+                counts[term] -= 1
+                if not counts[term]:
+                    del counts[term]
+        self._docs[number] = None
+        self._live[number] = 0
+        self._deleted += 1
+
+    def _compact(self):
+        """Renumber the live documents, and rebuild the postings without deleted documents"""
+        logger.info("Compacting patient store, with {} deleted documents".format(self._deleted))
+        items = list(self.scan())
+        self.clear()
+        for id, doc in items:
+            self.save(id, doc)
+
+    def get_weights(self, clauses):
+        """Return the (postings, weight) of each (field, term) clause, and the query norm
+
+        As for the elasticsearch (Lucene TF/IDF) score of a bool query of term
+        clauses on fields without norms, each clause is weighted by its squared
+        inverse document frequency.
+        """
+        n_docs = len(self)
+        weights = []
+        for field, term in clauses:
+            idf = 1 + math.log(n_docs / (self.get_count(field, term) + 1))
+            weights.append((self._postings[field].get(term), idf * idf))
+
+        total = sum([weight for postings, weight in weights])
+        query_norm = 1 / math.sqrt(total) if total else 0
+        return weights, query_norm
+
+    def get_filtered(self, filters):
+        """Return the postings of the documents passing all of the (field, list of terms) filters
+
+        Returns a list with the postings of each term of each filter.
+        """
+        return [[self._postings[field].get(term) or () for term in terms] for field, terms in filters]
+
+    def match(self, clauses, n=10, filters=(), rescore=()):
+        """Return the (id, document, score) of the n best documents matching any of the (field, term) clauses
+
+        Documents are scored by the sum of the weights of their matching
+        clauses, scaled by the fraction of clauses they match. The rescore
+        clauses only add to the scores of the documents matching a clause, as
+        the should clauses of an elasticsearch bool query with the clauses as a
+        must clause. Only documents with one of the terms of each of the
+        (field, list of terms) filters are matched, without affecting the scores.
+        """
+        clauses = list(clauses)
+        rescore = list(rescore)
+        with self._lock:
+            if not len(self):
+                return []
+            weights, query_norm = self.get_weights(clauses + rescore)
+            select_weights, rescore_weights = weights[:len(clauses)], weights[len(clauses):]
+            filtered = self.get_filtered(filters)
+            if np is not None:
+                top = self._match_numpy(select_weights, rescore_weights, n, filtered)
+            else:
+                top = self._match_python(select_weights, rescore_weights, n, filtered)
+
+            return [(self._ids[number], self._docs[number], score * query_norm) for number, score in top]
+
+    def _get_numpy_scores(self, weights):
+        """Return arrays of the sum of the weights of the matching clauses of each document, and their number"""
+        scores = np.zeros(len(self._docs))
+        matched = np.zeros(len(self._docs), dtype=np.int32)
+        for postings, weight in weights:
+            if postings:
+                numbers = np.frombuffer(postings, dtype=np.dtype(str('i')))
+                scores[numbers] += weight
+                matched[numbers] += 1
+        return scores, matched
+
+    def _match_numpy(self, weights, rescore_weights, n, filtered):
+        # Import within function to avoid cyclic import
+        from ..similarity import get_top
+
+        scores, matched = self._get_numpy_scores(weights)
+        if weights:
+            scores *= matched / len(weights)
+        if rescore_weights:
+            rescores, rematched = self._get_numpy_scores(rescore_weights)
+            rescores *= matched > 0
+            scores += rescores
+            scores *= (1 + rematched) / (1 + len(rescore_weights))
+        scores *= np.frombuffer(self._live, dtype=np.uint8)
+        for filter_postings in filtered:
+            passed = np.zeros(len(self._docs), dtype=bool)
+            for postings in filter_postings:
+                if postings:
+                    passed[np.frombuffer(postings, dtype=np.dtype(str('i')))] = True
+            scores *= passed
+        return [(int(number), float(scores[number])) for number in get_top(scores, n)]
+
+    def _match_python(self, weights, rescore_weights, n, filtered):
+        scores = {}
+        matched = {}
+        live = self._live
+        for postings, weight in weights:
+            for number in postings or ():
+                if live[number]:
+                    scores[number] = scores.get(number, 0) + weight
+                    matched[number] = matched.get(number, 0) + 1
+
+        for number in scores:
+            scores[number] *= matched[number] / len(weights)
+
+        if rescore_weights:
+            rematched = dict([(number, 0) for number in scores])
+            for postings, weight in rescore_weights:
+                for number in postings or ():
+                    if number in scores:
+                        scores[number] += weight
+                        rematched[number] += 1
+            for number in scores:
+                scores[number] *= (1 + rematched[number]) / (1 + len(rescore_weights))
+
+        for filter_postings in filtered:
+            passed = set()
+            for postings in filter_postings:
+                passed.update(postings)
+            scores = dict([(number, score) for number, score in scores.items() if number in passed])
+
+        top = sorted(scores, key=lambda number: (-scores[number], number))[:n]
+        return [(number, scores[number]) for number in top]
+
+
+class MemoryPatientManager(PatientManager):
+    """A PatientManager keeping patients in the process-wide PatientStore, instead of elasticsearch"""
+    # A patients file to load into the store on first use (set from MME_MEMORY_PATIENTS)
+    FILENAME = None
+    _store = PatientStore()
+    _loaded = False
+    _load_lock = threading.Lock()
+    # Incremented whenever patients are indexed or deleted, since the store is process-local
+    _generation = 0
+
+    def get_store(self):
+        """Return the process-wide PatientStore, loading FILENAME into it on first use"""
+        if not MemoryPatientManager._loaded:
+            with MemoryPatientManager._load_lock:
+                if not MemoryPatientManager._loaded:
+                    MemoryPatientManager._loaded = True
+                    if self.FILENAME:
+                        logger.info("Loading patients into memory from: {}".format(self.FILENAME))
+                        self.index_file(self.FILENAME, processes=1)
+        return MemoryPatientManager._store
+
+    def create_index(self):
+        pass
+
+    def delete_index(self):
+        MemoryPatientManager._store.clear()
+        self.bump_generation()
+
+    def index_exists(self):
+        return True
+
+    def ensure_mappings(self):
+        # The store has no mappings
+        pass
+
+    def refresh(self, **kwargs):
+        pass
+
+    def count(self, **kwargs):
+        return len(self.get_store())
+
+    @contextmanager
+    def bulk_indexing(self, replicas=False):
+        yield
+
+    def bulk_index(self, docs):
+        store = MemoryPatientManager._store
+        for id, doc in docs:
+            store.save(id, doc)
+
+    def bulk_delete(self, ids):
+        store = MemoryPatientManager._store
+        for id in ids:
+            store.delete(id)
+
+    def save(self, doc, id=None, **kwargs):
+        if id is None:
+            raise ValueError('Patients must have an id')
+        self.get_store().save(id, doc)
+
+    def delete(self, id, **kwargs):
+        deleted = self.get_store().delete(id)
+        if deleted:
+            self.bump_generation()
+        return deleted
+
+    def search(self, **kwargs):
+        # Every PatientManager method that searches is overridden below
+        raise ValueError('Patients in memory (MME_PATIENT_STORE = \'memory\') cannot be searched with '
+                         'elasticsearch queries')
+
+    def bump_generation(self):
+        MemoryPatientManager._generation += 1
+        self.reset_similarity()
+        if PatientManager._match_cache is not None:
+            PatientManager._match_cache.clear()
+
+    def get_generation(self):
+        return MemoryPatientManager._generation
+
+    def get_current_generation(self):
+        # The store is process-local, so the generation is always current
+        return MemoryPatientManager._generation
+
+    def get_patients(self, ids):
+        # Import within function to avoid cyclic import
+        from ..models import Patient
+
+        store = self.get_store()
+        patients = []
+        for id in ids:
+            doc = store.get(id)
+            if doc is not None:
+                patients.append(Patient.from_index(Result({'_id': id, '_source': doc})))
+        return patients
+
+    def iter_profiles(self):
+        for id, doc in self.get_store().scan():
+            yield (id, doc.get('phenotype', []), doc.get('gene', []))
+
+    def get_term_counts(self):
+        store = self.get_store()
+        return store.get_counts('phenotype'), len(store)
+
+    def get_term_stats(self):
+        # The counts of the store are always up to date
+        store = self.get_store()
+        return TermStats(store.get_frequencies(), len(store))
+
+    def get_indexed_terms(self, ids):
+        # The store updates its counts itself
+        return {}
+
+    def update_term_stats(self, changes, **kwargs):
+        pass
+
+    def count_term_stats(self):
+        return self.get_term_stats()
+
+    def rebuild_term_stats(self):
+        return self.get_term_stats()
+
+    def match(self, phenotypes, genes, n=10, filters=None):
+        """Return a list of the elasticsearch_dsl.Result of the most similar patients, with elasticsearch scores"""
+        select, rescore = self.get_query_tiers(phenotypes, genes)
+        matches = self.get_store().match(select, n=n, filters=self.get_filters(filters), rescore=rescore)
+        return [Result({'_id': id, '_score': score, '_source': doc}) for id, doc, score in matches]
+
+    def iter_filtered_ids(self, filters):
+        filters = self.get_filters(filters)
+        for id, doc in self.get_store().scan():
+            if all([PatientStore.get_terms(doc, field).intersection(terms) for field, terms in filters]):
+                yield id
+
+    def get_candidate_profiles(self, phenotypes, genes, candidates, filters=None):
+        select, rescore = self.get_query_tiers(phenotypes, genes)
+        matches = self.get_store().match(select, n=candidates, filters=self.get_filters(filters), rescore=rescore)
+        return [(id, doc.get('phenotype', []), doc.get('gene', [])) for id, doc, score in matches]
@@ -4,19 +4,93 @@ Module hanlding the authentication of incoming and outgoing server requests.
 from __future__ import with_statement, division, unicode_literals
 
 import json
+import time
+import uuid
+import random
 import logging
 import codecs
+import hashlib
 
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from elasticsearch import NotFoundError, ConflictError
 from elasticsearch_dsl import Q
+from elasticsearch_dsl.result import Result
 
+from ..cache import LRUCache
+from ..metrics import record_cache
 from .base import BaseManager
+from .readers import iter_json_records
+from .stats import TermStats
+from .vocabularies import VocabularyManager
 
 logger = logging.getLogger(__name__)
 
 
+def normalize_record(record):
+    """Return the (id, index document) of a patient record in API format"""
+    # Import within function to avoid cyclic import
+    from ..models import Patient
+
+    patient = Patient.from_api(record)
+    return patient.get_id(), patient.to_index()
+
+
 class PatientManager(BaseManager):
     NAME = 'patients'
     DOC_TYPE = 'patient'
+    # A single document whose token changes whenever patients are indexed or
+    # deleted, so every process can tell when its cached matches are stale
+    GENERATION_DOC_TYPE = 'generation'
+    GENERATION_ID = 'patients'
+    # The number of patients annotated with each phenotype and gene (a TermStats),
+    # updated whenever patients are indexed or deleted. The counts are split by
+    # a hash of each term across STATS_BUCKETS documents (with ids STATS_ID-N),
+    # so indexing a patient only rewrites the small documents of its terms, and
+    # concurrent writers rarely update the same document
+    STATS_DOC_TYPE = 'stats'
+    STATS_ID = 'terms'
+    STATS_BUCKETS = 64
+    MATCH_CACHE_SIZE = 1024
+    MATCH_CACHE_TTL = 300
+    # The seconds the generation token is cached for, so changes by other
+    # processes are seen after at most this long
+    GENERATION_TTL = 1.0
+    # (time, token) of the generation last read or written by this process
+    _current_generation = None
+    # Match cache key -> MatchResponse, shared by all manager instances in this process
+    _match_cache = LRUCache(maxsize=MATCH_CACHE_SIZE, ttl=MATCH_CACHE_TTL)
+    # In-process (generation, PatientProfiles, ResnikScorer) of all patients,
+    # shared by all manager instances in this process, and rebuilt when the
+    # generation changes
+    _similarity = None
+    # In-process (generation, ResnikScorer), with information content from term
+    # counts across all patients, for reranking candidates, and rebuilt when the
+    # generation changes
+    _scorer = None
+    # The (PatientProfiles, dict of filters (as canonical JSON) -> boolean array
+    # of whether each of the profiles passes them) of the similarity index
+    _filter_masks = (None, {})
+    # Indexed fields by which matches can be filtered (without affecting scores)
+    FILTER_FIELDS = ['test', 'server', 'institution']
+    # Whether this process has added the current mappings to the index, which
+    # may have been created by an older version without the filter fields
+    _mappings_updated = False
+    # Phenotypes annotated on more than RESCORE_FRACTION of patients only rescore
+    # the candidates selected by genes and rarer phenotypes, and phenotypes
+    # annotated on more than DROP_FRACTION of patients are left out of match
+    # queries (None to disable)
+    RESCORE_FRACTION = 0.1
+    DROP_FRACTION = 0.9
+    # Common phenotypes still select candidates, rarest first, until the selecting
+    # terms are annotated on at least this many patients
+    MIN_CANDIDATES = 500
+    # The seconds the term statistics are cached for, since other processes may
+    # change the patients
+    STATS_TTL = 60
+    # (time, generation, TermStats) of the stored statistics, shared by all manager instances in this process
+    _stats = None
     CONFIG = {
         'mappings': {
             'patient': {
@@ -32,59 +106,737 @@ class PatientManager(BaseManager):
                         'type': 'string',
                         'index': 'not_analyzed',
                     },
+                    'test': {
+                        'type': 'boolean',
+                    },
+                    # The id of the server that submitted the patient
+                    'server': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'institution': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
                     'doc': {
                         'type': 'object',
                         'enabled': False,
                         'include_in_all': False,
                     }
                 }
+            },
+            'generation': {
+                '_all': {
+                    'enabled': False,
+                },
+                'properties': {
+                    'token': {
+                        'type': 'string',
+                        'index': 'no',
+                    },
+                }
+            },
+            'stats': {
+                '_all': {
+                    'enabled': False,
+                },
+                'properties': {
+                    'patients': {
+                        'type': 'long',
+                        'index': 'no',
+                    },
+                    'counts': {
+                        'type': 'object',
+                        'enabled': False,
+                        'include_in_all': False,
+                    },
+                }
             }
         }
     }
 
-    def index_file(self, filename):
-        """Populate the database with patient data from the given file"""
-        # Import within function to avoid cyclic import
-        from ..models import Patient
+    def search(self, **kwargs):
+        # Exclude the generation and stats documents
+        kwargs.setdefault('doc_type', self.get_default_doc_type())
+        return BaseManager.search(self, **kwargs)
 
-        with codecs.open(filename, encoding='utf-8') as ifp:
-            data = json.load(ifp)
+    def create_index(self):
+        response = BaseManager.create_index(self)
+        # Start the statistics of the new index, so they can be updated incrementally
+        self.save_term_stats(TermStats())
+        return response
 
-        for record in data:
-            patient = Patient.from_api(record)
-            self.index_patient(patient)
+    def index_file(self, filename, **kwargs):
+        """Populate the database with patient data from the given file
+
+        The file can be a JSON array of patient records or newline-delimited
+        JSON, and is streamed rather than loaded into memory. Keyword
+        arguments are passed to index_records.
+        """
+        with codecs.open(filename, encoding='utf-8') as ifp:
+            self.index_records(iter_json_records(ifp), **kwargs)
 
         # Update index before returning record count
-        self.refresh()
         n = self.count()
         logger.info('Datastore now contains {} patient records'.format(n))
 
-    def index_patient(self, patient):
+    def index_records(self, records, batch_size=500, processes=None, concurrency=2, server=None):
+        """Index an iterable of patient records (in API format) with the bulk API
+
+        Records are normalized by a pool of worker processes, one batch at a
+        time, while previous batches are sent to the datastore. Refreshes are
+        disabled until the end.
+
+        batch_size - the number of patients per bulk request
+        processes - the number of worker processes (default: the number of CPUs; 1 to normalize in-process)
+        concurrency - the maximum number of bulk requests in flight
+        server - the id of the server that submitted the patients, by which matches can be filtered
+        """
+        self.ensure_mappings()
+        # Load vocabularies before forking, so worker processes share them
+        VocabularyManager(self.get_db()).get_resolver()
+        pool = Pool(processes) if processes != 1 else None
+        # The changes to the term statistics of the indexed batches
+        changes = TermStats()
+
+        def iter_normalized_batches():
+            n = 0
+            for batch in self.iter_batches(records, batch_size):
+                if pool is not None:
+                    docs = pool.map(normalize_record, batch)
+                else:
+                    docs = [normalize_record(record) for record in batch]
+
+                if server:
+                    for id, doc in docs:
+                        doc['server'] = server
+
+                n += len(docs)
+                logger.info("Normalized {} patients".format(n))
+                yield docs
+
+        def send(docs):
+            # Only the last record with each id is indexed, so only count it once
+            docs = list(OrderedDict(docs).items())
+            previous = self.get_indexed_terms([id for id, doc in docs])
+            self.bulk_index(docs)
+            for doc in previous.values():
+                changes.remove(doc)
+            for id, doc in docs:
+                changes.add(doc)
+
+        try:
+            # Patients are indexed into the live index, so keep its replicas
+            with self.bulk_indexing(replicas=True):
+                self.send_batches(iter_normalized_batches(), send, concurrency=concurrency)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.update_term_stats(changes)
+
+        self.bump_generation()
+
+    def ensure_mappings(self):
+        """Add the current mappings (such as the filter fields) to the index, once per process
+
+        Otherwise, the filter fields of indexes created by older versions would
+        be mapped dynamically (institution as an analyzed string), and could
+        not be filtered by.
+        """
+        if not PatientManager._mappings_updated:
+            if self.index_exists():
+                self.put_mappings()
+            else:
+                self.create_index()
+            PatientManager._mappings_updated = True
+
+    def bulk_index(self, docs):
+        """Index a list of (id, index document) tuples with a single bulk request, without refreshing"""
+        commands = []
+        for id, doc in docs:
+            commands.append({'index': {'_id': id}})
+            commands.append(doc)
+
+        data = ''.join([json.dumps(command) + '\n' for command in commands])
+        response = self.bulk(data, refresh=False, doc_type=self.get_default_doc_type())
+        if response.get('errors'):
+            failed = [item['index'] for item in response['items'] if item['index'].get('error')]
+            raise Exception('Failed to index {} patients, e.g. {!r}: {}'.format(len(failed), failed[0]['_id'], failed[0]['error']))
+
+    def delete_records(self, ids, batch_size=500, concurrency=2):
+        """Delete the patients with the given ids with the bulk API, ignoring missing patients"""
+        changes = TermStats()
+
+        def send(ids):
+            previous = self.get_indexed_terms(ids)
+            self.bulk_delete(ids)
+            for doc in previous.values():
+                changes.remove(doc)
+
+        try:
+            self.send_batches(self.iter_batches(ids, batch_size), send, concurrency=concurrency)
+        finally:
+            self.update_term_stats(changes)
+        self.refresh()
+        self.bump_generation()
+
+    def bulk_delete(self, ids):
+        """Delete a list of patient ids with a single bulk request, without refreshing"""
+        data = ''.join([json.dumps({'delete': {'_id': id}}) + '\n' for id in ids])
+        response = self.bulk(data, refresh=False, doc_type=self.get_default_doc_type())
+        if response.get('errors'):
+            failed = [item['delete'] for item in response['items'] if item['delete'].get('error')]
+            if failed:
+                raise Exception('Failed to delete {} patients, e.g. {!r}: {}'.format(len(failed), failed[0]['_id'], failed[0]['error']))
+
+    def index_patient(self, patient, server=None):
         """Index the provided models.Patient object
 
         If a patient with the same id already exists in the index, the patient is replaced.
+
+        server - the id of the server that submitted the patient, by which matches can be filtered
         """
         id = patient.get_id()
         data = patient.to_index()
+        if server:
+            data['server'] = server
 
+        self.ensure_mappings()
+        previous = self.get_indexed_terms([id])
         self.save(id=id, doc=data)
+        changes = TermStats()
+        for doc in previous.values():
+            changes.remove(doc)
+        changes.add(data)
+        self.update_term_stats(changes)
+        self.bump_generation()
         logger.info("Indexed patient: {!r}".format(id))
 
-    def match(self, phenotypes, genes, n=10):
+    def delete(self, id, **kwargs):
+        previous = self.get_indexed_terms([id])
+        response = BaseManager.delete(self, id, **kwargs)
+        changes = TermStats()
+        for doc in previous.values():
+            changes.remove(doc)
+        self.update_term_stats(changes)
+        self.bump_generation()
+        return response
+
+    def delete_index(self):
+        """Delete the index, and start a new generation (in a new, empty index) so all processes drop their caches"""
+        response = BaseManager.delete_index(self)
+        PatientManager._mappings_updated = False
+        self.bump_generation()
+        return response
+
+    def get_indexed_terms(self, ids):
+        """Return a dict of id -> the phenotypes and genes (as an index document) of the indexed patients with the given ids
+
+        This is a realtime get, so patients are found before the index is refreshed.
+        """
+        if not ids or not self.index_exists():
+            return {}
+
+        response = self.get_db().mget(index=self.get_name(), doc_type=self.get_default_doc_type(),
+                                      body={'ids': ids}, _source_include=['phenotype', 'gene'])
+        return dict([(doc['_id'], doc['_source']) for doc in response['docs'] if doc.get('found')])
+
+    def get_stats_ids(self):
+        """Return the ids of the statistics documents, one per bucket"""
+        return ['{}-{}'.format(self.STATS_ID, bucket) for bucket in range(self.STATS_BUCKETS)]
+
+    def split_term_stats(self, stats):
+        """Return a dict of statistics document id -> TermStats of the terms of its bucket
+
+        Only the sum of the numbers of patients of the buckets matters, so the
+        number of patients is added to one of the buckets written anyway.
+        """
+        ids = self.get_stats_ids()
+        buckets = {}
+        for field, counts in stats.counts.items():
+            for term, count in counts.items():
+                digest = hashlib.md5('{}:{}'.format(field, term).encode('utf-8')).hexdigest()
+                id = ids[int(digest[:8], 16) % len(ids)]
+                buckets.setdefault(id, TermStats()).counts.setdefault(field, {})[term] = count
+
+        if stats.n_patients:
+            id = random.choice(sorted(buckets)) if buckets else ids[0]
+            buckets.setdefault(id, TermStats()).n_patients = stats.n_patients
+        return buckets
+
+    def get_stats_documents(self, ids):
+        """Return a dict of id -> (TermStats, version) of the statistics documents, or None if any is missing
+
+        This is a realtime get, so changes are seen before the index is refreshed.
+        """
+        try:
+            response = self.get_db().mget(index=self.get_name(), doc_type=self.STATS_DOC_TYPE, body={'ids': ids})
+        except NotFoundError:
+            return None
+
+        documents = {}
+        for doc in response['docs']:
+            if not doc.get('found'):
+                return None
+            documents[doc['_id']] = (TermStats.from_dict(doc['_source']), doc['_version'])
+        return documents
+
+    def get_stored_term_stats(self):
+        """Return the TermStats of the stored statistics (the sum of its buckets), or None if there are none"""
+        documents = self.get_stats_documents(self.get_stats_ids())
+        if documents is None:
+            return None
+
+        stats = TermStats()
+        for bucket, version in documents.values():
+            stats.update(bucket)
+        return stats
+
+    def save_term_stats(self, stats):
+        """Replace the stored statistics, writing every bucket with a single bulk request"""
+        buckets = self.split_term_stats(stats)
+        commands = []
+        for id in self.get_stats_ids():
+            commands.append({'index': {'_id': id}})
+            commands.append(buckets.get(id, TermStats()).to_dict())
+
+        data = ''.join([json.dumps(command) + '\n' for command in commands])
+        response = self.bulk(data, refresh=False, doc_type=self.STATS_DOC_TYPE)
+        if response.get('errors'):
+            raise Exception('Failed to save patient term statistics')
+        PatientManager._stats = None
+
+    def update_term_stats(self, changes, retries=10):
+        """Apply a TermStats of changes (from indexed and deleted patients) to the stored statistics
+
+        Only the statistics documents of the changed terms are read (with a
+        single request) and rewritten. Concurrent updates (from other
+        processes) are detected by the versions of the documents, and the
+        conflicting documents are retried.
+        """
+        if changes.is_empty():
+            return
+
+        pending = self.split_term_stats(changes)
+        for attempt in range(retries):
+            documents = self.get_stats_documents(sorted(pending))
+            if documents is None:
+                logger.warning("Patient term statistics not found, run `mme-server stats --rebuild` to count them")
+                return
+
+            for id, (stats, version) in sorted(documents.items()):
+                stats.update(pending[id])
+                try:
+                    self.save(id=id, doc=stats.to_dict(), doc_type=self.STATS_DOC_TYPE, version=version)
+                    del pending[id]
+                except ConflictError:
+                    logger.info("Patient term statistics changed concurrently, retrying update")
+
+            if not pending:
+                break
+        else:
+            logger.error("Unable to update patient term statistics, run `mme-server stats --rebuild` to recount them")
+
+        PatientManager._stats = None
+
+    def count_term_stats(self):
+        """Return a TermStats of the phenotypes and genes of the indexed patients, counted with an aggregation"""
+        s = self.search()
+        # A size of 0 returns all terms
+        for field in TermStats.FIELDS:
+            s.aggs.bucket(field, 'terms', field=field, size=0)
+        s = s[:0]
+        response = s.execute()
+
+        counts = {}
+        for field in TermStats.FIELDS:
+            counts[field] = dict([(bucket.key, bucket.doc_count) for bucket in response.aggregations[field].buckets])
+        return TermStats(counts, response.hits.total)
+
+    def rebuild_term_stats(self):
+        """Recount the statistics of the indexed patients, replacing the stored statistics
+
+        The mappings are updated first, since indexes created by older versions
+        may lack the statistics and generation types, and the filter fields.
+        """
+        self.put_mappings()
+        self.refresh()
+        stats = self.count_term_stats()
+        self.save_term_stats(stats)
+        return stats
+
+    def get_term_stats(self):
+        """Return the TermStats of the number of patients annotated with each phenotype and gene
+
+        The stored statistics are cached for STATS_TTL seconds, or until the
+        patients generation changes. If there are none (for indexes created by
+        older versions), the patients are counted with an aggregation instead.
+        """
+        generation = self.get_current_generation()
+        cached = PatientManager._stats
+        if cached is not None and cached[1] == generation and time.time() - cached[0] < self.STATS_TTL:
+            return cached[2]
+
+        stats = self.get_stored_term_stats()
+        if stats is None:
+            stats = self.count_term_stats()
+        PatientManager._stats = (time.time(), generation, stats)
+        return stats
+
+    @classmethod
+    def reset_similarity(cls):
+        """Discard the in-process similarity index and scorer, so they are rebuilt on next use"""
+        PatientManager._similarity = None
+        PatientManager._scorer = None
+        PatientManager._filter_masks = (None, {})
+        PatientManager._stats = None
+
+    @classmethod
+    def configure_match_query(cls, rescore_fraction=RESCORE_FRACTION, drop_fraction=DROP_FRACTION,
+                              min_candidates=MIN_CANDIDATES):
+        """Set which phenotypes of match queries select candidates, only rescore them, or are dropped"""
+        PatientManager.RESCORE_FRACTION = rescore_fraction
+        PatientManager.DROP_FRACTION = drop_fraction
+        PatientManager.MIN_CANDIDATES = min_candidates
+
+    @classmethod
+    def configure_match_cache(cls, maxsize=MATCH_CACHE_SIZE, ttl=MATCH_CACHE_TTL, generation_ttl=GENERATION_TTL):
+        """Replace the in-process match cache with one of maxsize matches, kept for ttl seconds (0 to disable)
+
+        generation_ttl - the seconds the generation token is cached for
+        """
+        PatientManager._match_cache = LRUCache(maxsize=maxsize, ttl=ttl) if maxsize and ttl != 0 else None
+        PatientManager.GENERATION_TTL = generation_ttl
+        PatientManager._current_generation = None
+
+    def bump_generation(self):
+        """Record that the patients have changed, invalidating the cached matches of all processes"""
+        token = uuid.uuid4().hex
+        self.save(id=self.GENERATION_ID, doc={'token': token}, doc_type=self.GENERATION_DOC_TYPE)
+        PatientManager._current_generation = (time.time(), token)
+        self.reset_similarity()
+        if PatientManager._match_cache is not None:
+            PatientManager._match_cache.clear()
+
+    def get_generation(self):
+        """Return the current generation token of the patients (None if they have never been indexed)
+
+        This is a realtime get, so changes are seen before the index is refreshed.
+        """
+        try:
+            response = self.get_db().get(index=self.get_name(), doc_type=self.GENERATION_DOC_TYPE,
+                                         id=self.GENERATION_ID)
+        except NotFoundError:
+            return None
+        return response['_source'].get('token')
+
+    def get_current_generation(self):
+        """Return the generation token of the patients, read at most once every GENERATION_TTL seconds
+
+        Changes by this process are seen at once, and changes by other
+        processes after at most GENERATION_TTL seconds.
+        """
+        cached = PatientManager._current_generation
+        if cached is not None and time.time() - cached[0] < self.GENERATION_TTL:
+            return cached[1]
+
+        generation = self.get_generation()
+        PatientManager._current_generation = (time.time(), generation)
+        return generation
+
+    def get_match_cache_key(self, phenotypes, genes, n, **options):
+        """Return the key of cached matches for the normalized phenotypes and genes of a query
+
+        The key includes the current generation, so matches cached before the
+        patients changed are not returned once the generation is read again:
+        at once for changes by this process, and within GENERATION_TTL seconds
+        for changes by other processes (which is the window in which a stale
+        match can be returned). Returns None if matches are not cached.
+        """
+        if PatientManager._match_cache is None:
+            return None
+
+        query = {
+            'phenotypes': sorted(phenotypes),
+            'genes': sorted(genes),
+            'n': n,
+            'options': options,
+            'generation': self.get_current_generation(),
+        }
+        data = json.dumps(query, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get_cached_match(self, key):
+        if key is None:
+            return None
+        response = PatientManager._match_cache.get(key)
+        record_cache('match', response is not None)
+        return response
+
+    def set_cached_match(self, key, response):
+        if key is not None and PatientManager._match_cache is not None:
+            PatientManager._match_cache.set(key, response)
+
+    def get_patients(self, ids):
+        """Return the models.Patient objects with the given ids, skipping missing patients"""
+        # Import within function to avoid cyclic import
+        from ..models import Patient
+
+        if not ids:
+            return []
+
+        response = self.get_db().mget(index=self.get_name(), doc_type=self.get_default_doc_type(), body={'ids': ids})
+        return [Patient.from_index(Result(doc)) for doc in response['docs'] if doc.get('found')]
+
+    def iter_profiles(self):
+        """Iterate over the (id, phenotypes, genes) of all indexed patients"""
+        s = self.search()
+        s = s.source(include=['phenotype', 'gene'])
+        for hit in s.scan():
+            doc = hit.to_dict()
+            yield (hit.meta.id, doc.get('phenotype', []), doc.get('gene', []))
+
+    def get_query_tiers(self, phenotypes, genes):
+        """Return the (field, term) clauses of a match query that select candidates, and those that only rescore them
+
+        Genes and rare phenotypes select the candidates, so the cost of a query
+        scales with the number of relevant patients rather than with the size
+        of the index. Phenotypes annotated on more than RESCORE_FRACTION of
+        patients only add to the scores of the candidates (unless the selecting
+        terms are annotated on fewer than MIN_CANDIDATES patients), and those
+        annotated on more than DROP_FRACTION of patients (such as Phenotypic
+        abnormality) are dropped, since they hardly change the scores. Indexes
+        of fewer than MIN_CANDIDATES patients are cheap to query, so all terms
+        select candidates alike, and rankings are unchanged.
+        """
+        select = [('gene', id) for id in sorted(genes)]
+        if self.RESCORE_FRACTION is None and self.DROP_FRACTION is None:
+            return [('phenotype', id) for id in sorted(phenotypes)] + select, []
+
+        stats = self.get_term_stats()
+        n_patients = len(stats)
+        if n_patients < self.MIN_CANDIDATES:
+            return [('phenotype', id) for id in sorted(phenotypes)] + select, []
+
+        ranked = sorted([(stats.get_count('phenotype', id), id) for id in phenotypes])
+        if self.DROP_FRACTION is not None:
+            kept = [(count, id) for count, id in ranked if count <= self.DROP_FRACTION * n_patients]
+            # Keep ubiquitous phenotypes if there is nothing else to match
+            if kept or select:
+                ranked = kept
+
+        n_candidates = sum([stats.get_count('gene', id) for id in genes])
+        rescore = []
+        for count, id in ranked:
+            if rescore or (self.RESCORE_FRACTION is not None and count > self.RESCORE_FRACTION * n_patients and
+                           n_candidates >= self.MIN_CANDIDATES):
+                rescore.append(('phenotype', id))
+            else:
+                select.append(('phenotype', id))
+                n_candidates += count
+
+        if not select:
+            return rescore, []
+        return select, rescore
+
+    def get_filters(self, filters):
+        """Return a list of (field, list of values) for a dict of field -> value or list of values
+
+        Raises ValueError for fields that cannot be filtered.
+        """
+        clauses = []
+        for field, values in sorted((filters or {}).items()):
+            if field not in self.FILTER_FIELDS:
+                raise ValueError('Cannot filter matches by: {!r}'.format(field))
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            clauses.append((field, list(values)))
+        return clauses
+
+    def get_filter_query(self, filters):
+        """Return a list of elasticsearch_dsl queries, for the filter context of a query
+
+        Patients without a test flag (such as those indexed by older versions)
+        are not test patients, so filtering by test: false excludes the patients
+        with test: true, rather than requiring test: false.
+        """
+        queries = []
+        for field, values in self.get_filters(filters):
+            if field == 'test' and False in values:
+                if True not in values:
+                    queries.append(Q('bool', must_not=[Q('term', test=True)]))
+            else:
+                queries.append(Q('terms', **{field: values}))
+        return queries
+
+    def get_match_query(self, phenotypes, genes, filters=None):
+        """Return an elasticsearch_dsl query for patients similar to a list of phenotypes and candidate genes
+
+        Patients must match one of the clauses that select candidates (see
+        get_query_tiers), and the other clauses only add to their scores.
+
+        filters - a dict of field -> value or list of values, which restrict the
+            patients without contributing to their scores (and are cached by elasticsearch)
+        """
+        select, rescore = self.get_query_tiers(phenotypes, genes)
+        query_parts = [Q('match', **{field: term}) for field, term in select]
+        filter_parts = self.get_filter_query(filters)
+        if rescore:
+            rescore_parts = [Q('match', **{field: term}) for field, term in rescore]
+            return Q('bool', must=[Q('bool', should=query_parts)], should=rescore_parts, filter=filter_parts)
+
+        if not filter_parts:
+            return Q('bool', should=query_parts)
+
+        # With a filter, should clauses are otherwise optional, matching every filtered patient
+        return Q('bool', should=query_parts, filter=filter_parts, minimum_should_match=1)
+
+    def match(self, phenotypes, genes, n=10, filters=None):
         """Return an elasticsearch_dsl.Response of the most similar patients to a list of phenotypes and candidate genes
 
         phenotypes - a list of HPO term IDs (including implied terms)
         genes - a list of ENSEMBL gene IDs for candidate genes
+        filters - a dict of field -> value or list of values, restricting the matched patients
         """
-        query_parts = []
-        for id in phenotypes:
-            query_parts.append(Q('match', phenotype=id))
-
-        for gene_id in genes:
-            query_parts.append(Q('match', gene=gene_id))
-
-        query = Q('bool', should=query_parts)
+        query = self.get_match_query(phenotypes, genes, filters=filters)
         s = self.search()
         s = s.query(query)[:n]
         response = s.execute()
         return response
+
+    def get_term_counts(self):
+        """Return a (dict of HPO term ID -> number of patients annotated with it, number of patients) tuple"""
+        stats = self.get_term_stats()
+        return dict(stats.counts.get('phenotype', {})), len(stats)
+
+    def get_scorer(self):
+        """Get the in-process similarity.ResnikScorer, with information content from all patients
+
+        The scorer is rebuilt when the patients generation changes.
+        """
+        # Import within function, since numpy is an optional dependency
+        from ..similarity import ResnikScorer
+
+        generation = self.get_current_generation()
+        scorer = PatientManager._scorer
+        if scorer is None or scorer[0] != generation:
+            ontology = VocabularyManager(self.get_db()).get_ontology()
+            counts, n_patients = self.get_term_counts()
+            term_counts = [counts.get(id, 0) for id in ontology.ids]
+            scorer = PatientManager._scorer = (generation, ResnikScorer(ontology, term_counts, n_patients))
+
+        return scorer[1]
+
+    def get_similarity_index(self):
+        """Get the in-process similarity index of all patients, building it on first use
+
+        The index is rebuilt when the generation of the patients changes, so
+        patients indexed or deleted by other processes are included within
+        GENERATION_TTL seconds.
+
+        Returns a (similarity.PatientProfiles, similarity.ResnikScorer) tuple.
+        """
+        # Import within function, since numpy is an optional dependency
+        from ..similarity import PatientProfiles, ResnikScorer
+
+        generation = self.get_current_generation()
+        similarity = PatientManager._similarity
+        if similarity is None or similarity[0] != generation:
+            ontology = VocabularyManager(self.get_db()).get_ontology()
+            profiles = PatientProfiles(ontology, self.iter_profiles())
+            scorer = ResnikScorer.from_profiles(ontology, profiles)
+            logger.info("Loaded {} patient profiles for similarity scoring".format(len(profiles)))
+            similarity = PatientManager._similarity = (generation, profiles, scorer)
+
+        return similarity[1], similarity[2]
+
+    def iter_filtered_ids(self, filters):
+        """Iterate over the ids of the patients that pass the filters"""
+        s = self.search()
+        s = s.query(Q('bool', filter=self.get_filter_query(filters)))
+        s = s.source(False)
+        for hit in s.scan():
+            yield hit.meta.id
+
+    def get_filter_mask(self, profiles, filters):
+        """Return a boolean array of whether each of the in-process similarity profiles passes the filters"""
+        # Import within function, since numpy is an optional dependency
+        import numpy as np
+
+        masked_profiles, masks = PatientManager._filter_masks
+        if masked_profiles is not profiles:
+            # The similarity index was rebuilt
+            masks = {}
+            PatientManager._filter_masks = (profiles, masks)
+
+        key = json.dumps(self.get_filters(filters), sort_keys=True)
+        mask = masks.get(key)
+        if mask is None:
+            ids = set(self.iter_filtered_ids(filters))
+            mask = masks[key] = np.array([id in ids for id in profiles.ids], dtype=bool)
+        return mask
+
+    def get_scored_patients(self, profiles, scores, n):
+        """Return a list of the (models.Patient, score) of the n best-scoring profiles, fetching only their documents"""
+        # Import within function, since numpy is an optional dependency
+        from ..similarity import get_top
+
+        top = get_top(scores, n)
+        scores_by_id = dict([(profiles.ids[i], float(scores[i])) for i in top])
+        patients = self.get_patients([profiles.ids[i] for i in top])
+        return [(patient, scores_by_id[patient.get_id()]) for patient in patients]
+
+    def match_similar(self, phenotypes, genes, n=10, filters=None):
+        """Return a list of the (models.Patient, score) of the most semantically similar patients
+
+        Patients are scored in-process by similarity.ResnikScorer, and only the
+        n best are fetched from the index.
+
+        phenotypes - a list of HPO term IDs (including implied terms)
+        genes - a list of ENSEMBL gene IDs for candidate genes
+        filters - a dict of field -> value or list of values, restricting the matched patients
+        """
+        profiles, scorer = self.get_similarity_index()
+        scores = scorer.score(phenotypes, genes, profiles)
+        if filters:
+            scores *= self.get_filter_mask(profiles, filters)
+        return self.get_scored_patients(profiles, scores, n)
+
+    def get_candidate_profiles(self, phenotypes, genes, candidates, filters=None):
+        """Return the (id, phenotypes, genes) of the best candidates by elasticsearch score, without their documents"""
+        query = self.get_match_query(phenotypes, genes, filters=filters)
+        s = self.search()
+        s = s.query(query)
+        s = s.source(include=['phenotype', 'gene'])
+        s = s[:candidates]
+        response = s.execute()
+
+        profiles = []
+        for hit in response:
+            doc = hit.to_dict()
+            profiles.append((hit.meta.id, doc.get('phenotype', []), doc.get('gene', [])))
+        return profiles
+
+    def match_reranked(self, phenotypes, genes, n=10, candidates=500, filters=None):
+        """Return a list of the (models.Patient, score) of the most similar patients, in three stages
+
+        1. Retrieve the ids, phenotypes and genes (but not the documents) of the
+           best candidates by elasticsearch score
+        2. Rescore the candidates in-process with similarity.ResnikScorer
+        3. Fetch the documents of the n best candidates
+
+        phenotypes - a list of HPO term IDs (including implied terms)
+        genes - a list of ENSEMBL gene IDs for candidate genes
+        candidates - the number of candidates to rescore
+        filters - a dict of field -> value or list of values, restricting the candidates
+        """
+        # Import within function, since numpy is an optional dependency
+        from ..similarity import PatientProfiles
+
+        profiles = self.get_candidate_profiles(phenotypes, genes, candidates, filters=filters)
+        scorer = self.get_scorer()
+        profiles = PatientProfiles(scorer.ontology, profiles)
+
+        scores = scorer.score(phenotypes, genes, profiles)
+        return self.get_scored_patients(profiles, scores, n)
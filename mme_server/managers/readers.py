@@ -0,0 +1,122 @@
+"""
+Module for reading records from large data files, without loading them into memory.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = ' \t\n\r'
+# Characters that end a JSON number or literal, so a decode error before them
+# is not due to the record continuing in the next chunk
+DELIMITERS = WHITESPACE + ',:[]{}'
+
+
+def is_truncated(error, buffer):
+    """Return whether the ValueError from decoding the buffer may be due to it ending mid-record"""
+    pos = getattr(error, 'pos', None)
+    if pos is None:
+        # The error does not say where it is (Python 2), so assume it may be
+        return True
+    if error.msg.startswith('Unterminated string'):
+        return True
+    # Otherwise, only the last token may be incomplete
+    return not any(c in DELIMITERS for c in buffer[pos:])
+
+
+def iter_json_records(ifp, chunk_size=1 << 16):
+    """Iterate over the records in a text file, reading chunk_size characters at a time
+
+    The format is detected from the first character: a file starting with '['
+    is read as a JSON array of records, otherwise as newline-delimited JSON
+    (one record per line). Raises ValueError on malformed JSON as soon as it
+    is read, including trailing commas and text after the array.
+    """
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+
+    def read_more():
+        chunk = ifp.read(chunk_size)
+        return chunk, not chunk
+
+    # Read up to the first character, skipping any byte order mark
+    buffer = ''
+    while not buffer and not eof:
+        buffer, eof = read_more()
+        buffer = buffer.lstrip('\ufeff' + WHITESPACE)
+
+    def skip_whitespace(buffer, pos):
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        return pos
+
+    in_array = buffer.startswith('[')
+    if in_array:
+        logger.info("Reading records from JSON array")
+        pos = 1
+    else:
+        logger.info("Reading records from newline-delimited JSON")
+
+    expect_separator = False
+    # Whether a "," was read, so another record must follow
+    expect_record = False
+    # Whether the closing "]" was read, so only whitespace may follow
+    closed = False
+    while True:
+        pos = skip_whitespace(buffer, pos)
+        # Drop consumed text, to keep the buffer small
+        if pos >= chunk_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+        if pos >= len(buffer):
+            if eof:
+                if in_array and not closed:
+                    raise ValueError('Unexpected end of file in JSON array')
+                return
+
+            chunk, eof = read_more()
+            buffer += chunk
+            continue
+
+        if closed:
+            raise ValueError('Unexpected text after JSON array: {!r}'.format(buffer[pos:pos + 20]))
+
+        if in_array:
+            if buffer[pos] == ']':
+                if expect_record:
+                    raise ValueError('Trailing "," in JSON array')
+                closed = True
+                pos += 1
+                continue
+            elif expect_separator:
+                if buffer[pos] != ',':
+                    raise ValueError('Expected "," or "]" in JSON array, found: {!r}'.format(buffer[pos]))
+                pos += 1
+                expect_separator = False
+                expect_record = True
+                continue
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except ValueError as e:
+            if eof or not is_truncated(e, buffer):
+                raise
+            # The record may continue in the next chunk
+            chunk, eof = read_more()
+            buffer += chunk
+            continue
+
+        if end == len(buffer) and not eof:
+            # A number or literal could continue in the next chunk
+            chunk, eof = read_more()
+            buffer += chunk
+            continue
+
+        yield record
+        pos = end
+        expect_separator = True
+        expect_record = False
@@ -4,20 +4,54 @@ Module hanlding the authentication of incoming and outgoing server requests.
 from __future__ import with_statement, division, unicode_literals
 
 import json
+import time
+import uuid
 import logging
+import hashlib
 
+from elasticsearch import NotFoundError
+
+from ..cache import LRUCache
 from ..compat import urlsplit
+from ..health import PeerHealth
+from ..metrics import record_cache
 from .base import BaseManager
 
 logger = logging.getLogger(__name__)
 
+# Marks a key missing from the verification cache (None caches a failed verification)
+_MISSING = object()
+
+
+def hash_key(key):
+    """Return the digest of an authentication key, as stored for incoming clients"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
 
 class ServerManager(BaseManager):
     NAME = 'servers'
     SERVER_DOC_TYPE = 'server'
     CLIENT_DOC_TYPE = 'client'
+    # A document whose token changes whenever servers or clients are added or
+    # removed, so every process discards its cached verifications
+    VERSION_DOC_TYPE = 'version'
+    VERSION_ID = 'servers'
     SERVER_DISPLAY_FIELDS = ['server_id', 'server_label', 'base_url']
     CLIENT_DISPLAY_FIELDS = ['server_id', 'server_label']
+    # Fields of PeerHealth.summary() listed for outgoing servers
+    HEALTH_DISPLAY_FIELDS = ['state', 'requests', 'error_rate', 'p50', 'p99']
+    # Seconds to cache successful and failed key verifications
+    VERIFY_CACHE_TTL = 60
+    VERIFY_CACHE_NEGATIVE_TTL = 5
+    # The seconds the version token is cached for, so key verifications by other
+    # processes are invalidated after at most this long
+    VERSION_TTL = 1.0
+    # (time, token) of the version last read by this process
+    _current_version = None
+    # (version, verified key digest) -> client (or None), shared by all manager instances in this process
+    _verified = LRUCache(maxsize=1024, ttl=VERIFY_CACHE_TTL)
+    # Whether this process has hashed the keys of clients authorized before keys were hashed
+    _migrated = False
     CONFIG = {
         'mappings': {
             'server': {
@@ -37,6 +71,11 @@ class ServerManager(BaseManager):
                     'base_url': {
                         'type': 'string',
                         'index': 'not_analyzed',
+                    },
+                    # PeerHealth.to_dict() of the latest requests to the server
+                    'health': {
+                        'type': 'object',
+                        'enabled': False,
                     }
                 }
             },
@@ -51,9 +90,24 @@ class ServerManager(BaseManager):
                         'type': 'string',
                         'index': 'not_analyzed',
                     },
+                    # Only present for clients authorized before keys were hashed,
+                    # until they are migrated by migrate_keys()
                     'server_key': {
                         'type': 'string',
                         'index': 'not_analyzed',
+                    },
+                    'server_key_digest': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    }
+                }
+            },
+
+            'version': {
+                'properties': {
+                    'token': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
                     }
                 }
             }
@@ -91,15 +145,20 @@ class ServerManager(BaseManager):
             data = {
                 'server_id': server_id,
                 'server_label': server_label,
-                'server_key': server_key,
             }
             if doc_type == 'server':
+                # Keys for outgoing requests are sent to the server, so are stored as-is
+                data['server_key'] = server_key
                 data['base_url'] = base_url
+            else:
+                data['server_key_digest'] = hash_key(server_key)
 
             self.save(id=id, doc_type=doc_type, doc=data)
-            logger.info("Authorized {}:\n{}".format(doc_type, json.dumps(data, indent=4, sort_keys=True)))
+            display_data = dict(data, server_key=server_key)
+            logger.info("Authorized {}:\n{}".format(doc_type, json.dumps(display_data, indent=4, sort_keys=True)))
             # Refresh index to ensure immediately usable
             self.refresh()
+            self.bump_version()
 
     def remove(self, server_id, direction):
         if self.index_exists():
@@ -113,6 +172,8 @@ class ServerManager(BaseManager):
                 self.delete(id=id, doc_type=doc_type)
                 logger.info("Deleted {}:{}".format(doc_type, hit.server_id))
 
+            self.bump_version()
+
     def list(self, direction):
         rows = []
         if self.index_exists():
@@ -124,17 +185,116 @@ class ServerManager(BaseManager):
             # Iterate through all, using scan
             for hit in s.scan():
                 row = dict([(field, hit[field]) for field in fields])
+                if doc_type == 'server':
+                    health = PeerHealth.from_dict(hit.to_dict().get('health') or {})
+                    row.update(health.summary())
                 rows.append(row)
 
+            if doc_type == 'server':
+                fields = fields + self.HEALTH_DISPLAY_FIELDS
+
         return {
             'fields': fields,
             'rows': rows
         }
 
+    def get_servers(self):
+        """Return the outgoing servers, with the base_url and server_key to send requests with"""
+        servers = []
+        if self.index_exists():
+            s = self.search(doc_type=self.SERVER_DOC_TYPE)
+            s = s.query('match_all')
+            for hit in s.scan():
+                servers.append(hit.to_dict())
+
+        return servers
+
+    def update_health(self, server_id, health):
+        """Store the PeerHealth.to_dict() of the outgoing server, without refreshing"""
+        if self.index_exists():
+            s = self.search(doc_type=self.SERVER_DOC_TYPE)
+            s = s.filter('term', server_id=server_id)
+            for hit in s.execute():
+                self.get_db().update(index=self.get_name(), doc_type=self.SERVER_DOC_TYPE,
+                                     id=hit.meta.id, body={'doc': {'health': health}})
+
+    def bump_version(self):
+        """Record that the servers or clients have changed, invalidating the cached verifications of all processes"""
+        token = uuid.uuid4().hex
+        self.save(id=self.VERSION_ID, doc={'token': token}, doc_type=self.VERSION_DOC_TYPE)
+        # This process sees its own changes at once
+        ServerManager._current_version = (time.time(), token)
+        return token
+
+    def get_version(self):
+        """Return the current version token of the servers and clients (None if they have never changed)"""
+        try:
+            response = self.get_db().get(index=self.get_name(), doc_type=self.VERSION_DOC_TYPE, id=self.VERSION_ID)
+        except NotFoundError:
+            return None
+        return response['_source'].get('token')
+
+    def get_current_version(self):
+        """Return the version token of the servers and clients, read at most once every VERSION_TTL seconds"""
+        cached = ServerManager._current_version
+        if cached is not None and time.time() - cached[0] < self.VERSION_TTL:
+            return cached[1]
+
+        version = self.get_version() if self.index_exists() else None
+        ServerManager._current_version = (time.time(), version)
+        return version
+
     def verify(self, key):
-        if key and self.index_exists():
-            s = self.search()
-            s = s.filter('term', server_key=key)
+        """Return the incoming client authorized with the given key, else None
+
+        Results (including failures) are cached for a short time, by key
+        digest and version, so clients added or removed by any process are
+        seen within VERSION_TTL seconds.
+        """
+        if not key:
+            return None
+
+        digest = hash_key(key)
+        cache_key = (self.get_current_version(), digest)
+        client = self._verified.get(cache_key, _MISSING)
+        record_cache('verify', client is not _MISSING)
+        if client is _MISSING:
+            client = self.find_client(digest)
+            ttl = self.VERIFY_CACHE_TTL if client else self.VERIFY_CACHE_NEGATIVE_TTL
+            self._verified.set(cache_key, client, ttl=ttl)
+
+        return client
+
+    def migrate_keys(self):
+        """Replace the raw keys of clients authorized before keys were hashed with their digests
+
+        Returns the number of clients migrated.
+        """
+        n = 0
+        if self.index_exists():
+            s = self.search(doc_type=self.CLIENT_DOC_TYPE)
+            s = s.filter('exists', field='server_key')
+            for hit in s.scan():
+                doc = hit.to_dict()
+                doc['server_key_digest'] = hash_key(doc.pop('server_key'))
+                self.save(id=hit.meta.id, doc_type=self.CLIENT_DOC_TYPE, doc=doc)
+                logger.info("Hashed the key of client {!r}".format(hit.server_id))
+                n += 1
+
+            if n:
+                self.refresh()
+                self.bump_version()
+
+        ServerManager._migrated = True
+        return n
+
+    def find_client(self, digest):
+        if self.index_exists():
+            if not ServerManager._migrated:
+                self.migrate_keys()
+
+            s = self.search(doc_type=self.CLIENT_DOC_TYPE)
+            s = s.filter('term', server_key_digest=digest)
             results = s.execute()
 
             if results.hits:
@@ -0,0 +1,81 @@
+"""
+Document-frequency statistics of the phenotypes and genes of patients.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import threading
+
+
+class TermStats:
+    """The number of patients annotated with each phenotype and gene, and the number of patients
+
+    Counts are kept in a dict of field -> term -> count, so reading the count
+    of a term is O(1). Instances are also used to accumulate the changes of a
+    batch of indexed and deleted patients (with negative counts), which are
+    then applied to the stored statistics with update().
+    """
+    FIELDS = ['phenotype', 'gene']
+
+    def __init__(self, counts=None, n_patients=0):
+        self.counts = counts if counts is not None else dict([(field, {}) for field in self.FIELDS])
+        self.n_patients = n_patients
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(counts=data.get('counts'), n_patients=data.get('patients', 0))
+
+    def to_dict(self):
+        return {
+            'patients': self.n_patients,
+            'counts': self.counts,
+        }
+
+    def __len__(self):
+        return self.n_patients
+
+    def get_count(self, field, term):
+        """Return the number of patients with the term (a phenotype or gene id) in the field"""
+        return self.counts.get(field, {}).get(term, 0)
+
+    def add(self, doc, sign=1):
+        """Count the phenotypes and genes of a patient index document (or subtract them, with sign=-1)"""
+        with self._lock:
+            self.n_patients += sign
+            for field in self.FIELDS:
+                self._add_terms(self.counts.setdefault(field, {}), set(doc.get(field, [])), sign)
+
+    def remove(self, doc):
+        self.add(doc, sign=-1)
+
+    def update(self, other):
+        """Add the counts of other TermStats (such as a batch of changes)"""
+        with self._lock:
+            self.n_patients += other.n_patients
+            for field, counts in other.counts.items():
+                field_counts = self.counts.setdefault(field, {})
+                for term, count in counts.items():
+                    self._add_terms(field_counts, [term], count)
+
+    @staticmethod
+    def _add_terms(counts, terms, amount):
+        for term in terms:
+            count = counts.get(term, 0) + amount
+            if count:
+                counts[term] = count
+            else:
+                del counts[term]
+
+    def is_empty(self):
+        """Return whether there are no counts (for a batch of changes, whether it changes nothing)"""
+        return not self.n_patients and not any(self.counts.values())
+
+    def get_most_common(self, field, n=10):
+        """Return the (term, count) of the n terms in the field with the most patients, most first"""
+        counts = self.counts.get(field, {})
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def get_least_common(self, field, n=10):
+        """Return the (term, count) of the n terms in the field with the fewest (but some) patients, fewest first"""
+        counts = self.counts.get(field, {})
+        return sorted(counts.items(), key=lambda item: (item[1], item[0]))[:n]
@@ -3,22 +3,69 @@ Module hanlding the authentication of incoming and outgoing server requests.
 """
 from __future__ import with_statement, division, unicode_literals
 
+import os
 import json
+import time
+import uuid
 import logging
+import threading
 
+from elasticsearch import NotFoundError
 from elasticsearch_dsl import Search, Q
 
 from ..base import BaseManager
 from .parsers import OBOParser, GeneParser
+from .resolver import TermResolver, TERM_FIELDS, RESOLVED_FIELDS
+from .snapshot import OntologySnapshot, get_checksum, read_checksum, write_snapshot
 
 logger = logging.getLogger(__name__)
 
 HPO_DOC_TYPE = 'hpo'
 GENE_DOC_TYPE = 'gene'
+# The checksum of the indexed HPO file, to check snapshots against
+SNAPSHOT_DOC_TYPE = 'snapshot'
+# A single document whose token changes whenever a vocabulary is indexed, so
+# every process can tell when its in-process resolver is stale
+GENERATION_DOC_TYPE = 'generation'
 
 class VocabularyManager(BaseManager):
     NAME = 'vocabularies'
+    # Whether to resolve terms from an in-process copy of the index, rather than
+    # querying the index for each batch of terms (set from MME_PRELOAD_TERMS)
+    PRELOAD_TERMS = True
+    # In-process term resolver, shared by all manager instances in this process,
+    # and the generation of the vocabularies it was loaded from
+    _resolver = None
+    _resolver_generation = None
+    _resolver_lock = threading.Lock()
+    GENERATION_ID = 'vocabularies'
+    # The seconds the generation token is cached for (set from MME_GENERATION_TTL)
+    GENERATION_TTL = 1.0
+    # (time, token) of the generation last read or written by this process
+    _current_generation = None
+    # The absolute path of a compiled HPO snapshot (written by index_hpo) to load
+    # ontology terms from, instead of the index, if it is of the indexed file
+    SNAPSHOT_FILENAME = None
     DOC_TYPES = [HPO_DOC_TYPE, GENE_DOC_TYPE]
+    SNAPSHOT_CONFIG = {
+        'properties': {
+            'checksum': {
+                'type': 'string',
+                'index': 'not_analyzed',
+            },
+        }
+    }
+    GENERATION_CONFIG = {
+        '_all': {
+            'enabled': False,
+        },
+        'properties': {
+            'token': {
+                'type': 'string',
+                'index': 'no',
+            },
+        }
+    }
     TERM_CONFIG = {
         '_all': {
             'enabled': False,
@@ -54,6 +101,8 @@ class VocabularyManager(BaseManager):
         mappings = {}
         for doc_type in self.DOC_TYPES:
             mappings[doc_type] = self.TERM_CONFIG
+        mappings[SNAPSHOT_DOC_TYPE] = self.SNAPSHOT_CONFIG
+        mappings[GENERATION_DOC_TYPE] = self.GENERATION_CONFIG
 
         return {
             'mappings': mappings
@@ -73,43 +122,216 @@ class VocabularyManager(BaseManager):
             data = ''.join([json.dumps(command) + '\n' for command in commands])
             self.bulk(data, **kwargs)
 
-    def iter_batches(self, iterator, batch_size):
-        batch = []
-        for item in iterator:
-            batch.append(item)
-            if len(batch) >= batch_size:
-                yield batch
-                batch = []
+        # Keep the in-process resolver in step with the index
+        with VocabularyManager._resolver_lock:
+            if VocabularyManager._resolver is not None:
+                VocabularyManager._resolver.update(terms)
+
+    def index_documents(self, doc_type, terms, batch_size=1000, concurrency=4):
+        """Index terms from an iterable
 
-        if batch:
-            yield batch
+        Batches of terms are sent in concurrent bulk requests, with refreshes
+        and replicas disabled until all terms are indexed.
 
-    def index_file(self, doc_type, filename, Parser, batch_size=1000):
+        :param doc_type: the doc_type for terms from this vocabulary
+        :param terms: an iterable of terms
+        :param batch_size: the number of terms per bulk request
+        :param concurrency: the maximum number of bulk requests in flight
+        """
+        def send(batch):
+            self.index_terms(doc_type, batch, refresh=False)
+
+        with self.bulk_indexing():
+            self.send_batches(self.iter_batches(terms, batch_size=batch_size), send, concurrency=concurrency)
+
+    def index_file(self, doc_type, filename, Parser, **kwargs):
         """Index terms from the given file
 
         :param doc_type: the doc_type for terms from this vocabulary
         :param filename: the path to the vocabulary file
         :param Parser: the Parser class to use to parse the vocabulary file
+        Other kwargs are passed to index_documents.
         """
-        parser = Parser(filename)
-
         logger.info("Parsing vocabulary from: {!r}".format(filename))
-        for batch in self.iter_batches(parser, batch_size=batch_size):
-            self.index_terms(doc_type, batch, refresh=False)
+        self.index_documents(doc_type, Parser(filename), **kwargs)
 
-    def index_hpo(self, filename, doc_type=HPO_DOC_TYPE):
-        return self.index_file(doc_type=doc_type, filename=filename, Parser=OBOParser)
+    def index_hpo(self, filename, doc_type=HPO_DOC_TYPE, snapshot=None, **kwargs):
+        """Index HPO terms from the given OBO file
 
-    def index_genes(self, filename, doc_type=GENE_DOC_TYPE):
-        return self.index_file(doc_type=doc_type, filename=filename, Parser=GeneParser)
+        If snapshot is given, a compiled snapshot of the ontology is also
+        written to that path, unless it is already a snapshot of this file.
+        The checksum of the file is recorded in the index, so only snapshots
+        of the indexed file are loaded.
+        """
+        checksum = get_checksum(filename)
+        if not snapshot:
+            self.index_file(doc_type=doc_type, filename=filename, Parser=OBOParser, **kwargs)
+        else:
+            logger.info("Parsing vocabulary from: {!r}".format(filename))
+            terms = list(OBOParser(filename))
+            self.index_documents(doc_type, terms, **kwargs)
 
-    def get_term(self, id):
-        """Get vocabulary term by ID"""
+            if read_checksum(snapshot) == checksum:
+                logger.info("Ontology snapshot is up to date: {!r}".format(snapshot))
+            else:
+                write_snapshot(snapshot, terms, checksum)
+
+        self.save(id=doc_type, doc={'checksum': checksum}, doc_type=SNAPSHOT_DOC_TYPE)
+        self.bump_generation()
+
+    def index_genes(self, filename, doc_type=GENE_DOC_TYPE, **kwargs):
+        self.index_file(doc_type=doc_type, filename=filename, Parser=GeneParser, **kwargs)
+        self.bump_generation()
+
+    def bump_generation(self):
+        """Record that the vocabularies have changed, so all processes reload their resolvers"""
+        token = uuid.uuid4().hex
+        self.save(id=self.GENERATION_ID, doc={'token': token}, doc_type=GENERATION_DOC_TYPE)
+        VocabularyManager._current_generation = (time.time(), token)
+
+    def get_generation(self):
+        """Return the current generation token of the vocabularies (None if it was never recorded)"""
+        try:
+            response = self.get_db().get(index=self.get_name(), doc_type=GENERATION_DOC_TYPE, id=self.GENERATION_ID)
+        except NotFoundError:
+            return None
+        return response['_source'].get('token')
+
+    def get_current_generation(self):
+        """Return the generation token of the vocabularies, read at most once every GENERATION_TTL seconds"""
+        cached = VocabularyManager._current_generation
+        if cached is not None and time.time() - cached[0] < self.GENERATION_TTL:
+            return cached[1]
+
+        generation = self.get_generation()
+        VocabularyManager._current_generation = (time.time(), generation)
+        return generation
+
+    def get_indexed_checksum(self, doc_type=HPO_DOC_TYPE):
+        """Return the checksum of the indexed vocabulary file, or None if it was not recorded"""
+        try:
+            response = self.get_db().get(index=self.get_name(), doc_type=SNAPSHOT_DOC_TYPE, id=doc_type)
+        except NotFoundError:
+            return None
+        return response['_source'].get('checksum')
+
+    def load_snapshot(self):
+        """Return the OntologySnapshot at SNAPSHOT_FILENAME, or None if there is no valid snapshot of the indexed HPO"""
+        filename = self.SNAPSHOT_FILENAME
+        if not filename or not os.path.isfile(filename):
+            return None
+
+        try:
+            snapshot = OntologySnapshot(filename)
+        except (IOError, OSError, ValueError):
+            logger.exception("Unable to load ontology snapshot: {!r}".format(filename))
+            return None
+
+        checksum = self.get_indexed_checksum()
+        if snapshot.checksum != checksum:
+            logger.warning("Ignoring ontology snapshot of a different HPO file than was indexed: {!r}".format(filename))
+            return None
+
+        logger.info("Mapped ontology snapshot: {!r}".format(filename))
+        return snapshot
+
+    def load_resolver(self):
+        """Load all indexed terms into a new TermResolver
+
+        HPO terms are looked up in the ontology snapshot, if there is one,
+        instead of being loaded.
+        """
+        s = self.search()
+        s = s.source(include=TERM_FIELDS)
+
+        snapshot = self.load_snapshot()
+        resolver = TermResolver(snapshot=snapshot)
+        if snapshot is not None:
+            s = s.doc_type(*[doc_type for doc_type in self.DOC_TYPES if doc_type != HPO_DOC_TYPE])
+        else:
+            s = s.doc_type(*self.DOC_TYPES)
+
+        for hit in s.scan():
+            resolver.add(hit.to_dict())
+
+        logger.info("Loaded {} vocabulary terms into memory".format(len(resolver)))
+        return resolver
+
+    def get_resolver(self):
+        """Get the in-process TermResolver, loading it from the index on first use
+
+        It is reloaded when the vocabularies are indexed again (by any process),
+        as seen by the generation token. Only one thread loads it: others wait
+        for the first load, but keep using the previous resolver during a reload.
+        """
+        generation = self.get_current_generation()
+        resolver = VocabularyManager._resolver
+        if resolver is not None and VocabularyManager._resolver_generation == generation:
+            return resolver
+
+        if not VocabularyManager._resolver_lock.acquire(resolver is None):
+            # Being reloaded by another thread
+            return resolver
+        try:
+            if VocabularyManager._resolver is None or VocabularyManager._resolver_generation != generation:
+                if VocabularyManager._resolver is not None:
+                    logger.info("Vocabularies changed, reloading them")
+                VocabularyManager._resolver = self.load_resolver()
+                VocabularyManager._resolver_generation = generation
+            return VocabularyManager._resolver
+        finally:
+            VocabularyManager._resolver_lock.release()
+
+    def get_ontology(self):
+        """Get the compiled HPO Ontology, from the in-process TermResolver"""
+        return self.get_resolver().get_ontology()
+
+    @classmethod
+    def reset_resolver(cls):
+        """Discard the in-process TermResolver, so it is reloaded on next use"""
+        with VocabularyManager._resolver_lock:
+            VocabularyManager._resolver = None
+            VocabularyManager._resolver_generation = None
+            VocabularyManager._current_generation = None
+
+    def search_terms(self, ids):
+        """Return all indexed terms with an ID or alternate ID in ids, in a single query"""
         s = self.search()
-        s = s.query(Q('term', id=id) | Q('term', alt_id=id))
+        s = s.query(Q('terms', id=ids) | Q('terms', alt_id=ids))
+        s = s.source(include=RESOLVED_FIELDS)
+        s = s[:len(ids)]
         response = s.execute()
 
-        if response.hits.total == 1:
-            return response.hits[0].to_dict()
+        if response.hits.total > len(response.hits):
+            # Some ids matched several terms, so fetch them all
+            return [hit.to_dict() for hit in s.scan()]
         else:
-            logger.error("Unable to uniquely resolve term: {!r}".format(id))
+            return [hit.to_dict() for hit in response.hits]
+
+    def get_terms(self, ids):
+        """Get vocabulary terms by ID or alternate ID
+
+        Returns a dict mapping each uniquely-resolved id to its term.
+        """
+        ids = sorted(set(ids))
+        if not ids:
+            return {}
+
+        if self.PRELOAD_TERMS:
+            resolver = self.get_resolver()
+        else:
+            resolver = TermResolver(self.search_terms(ids))
+
+        terms = {}
+        for id in ids:
+            term = resolver.get_term(id)
+            if term is None:
+                logger.error("Unable to uniquely resolve term: {!r}".format(id))
+            else:
+                terms[id] = term
+
+        return terms
+
+    def get_term(self, id):
+        """Get vocabulary term by ID or alternate ID"""
+        return self.get_terms([id]).get(id)
@@ -259,6 +259,8 @@ class Parser(object):
                 stanza.tags[tag].append(value)
             except KeyError:
                 stanza.tags[tag] = [value]
+        if stanza:
+            yield stanza
 
     def __iter__(self):
         return self.stanzas()
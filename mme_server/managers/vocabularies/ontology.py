@@ -0,0 +1,127 @@
+"""
+Module providing a compiled, integer-indexed representation of an ontology DAG.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+
+from array import array
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Typecode of the packed integer arrays (32-bit on all supported platforms)
+INDEX_TYPECODE = str('i')
+
+
+class Ontology:
+    """An ontology DAG compiled into packed integer arrays
+
+    Terms are numbered in topological order (every term after all of its
+    parents). The parents and the ancestor closure (the term itself and all
+    of its ancestors) of term i are the slices [offsets[i]:offsets[i + 1]]
+    of a single packed array, sorted in ascending (topological) order.
+    """
+    # Names of the packed arrays, in the order of the constructor arguments
+    ARRAY_NAMES = ['parent_offsets', 'parents', 'closure_offsets', 'closure']
+
+    def __init__(self, ids, parent_offsets, parents, closure_offsets, closure):
+        self.ids = ids
+        self._index = dict([(id, i) for i, id in enumerate(ids)])
+        self._parent_offsets = parent_offsets
+        self._parents = parents
+        self._closure_offsets = closure_offsets
+        self._closure = closure
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    @classmethod
+    def from_terms(cls, terms):
+        """Compile an ontology from an iterable of terms with 'id' and 'is_a' fields"""
+        term_parents = {}
+        for term in terms:
+            term_parents[term['id']] = list(term.get('is_a', []))
+
+        # Drop references to unknown (e.g., obsolete) parents
+        children = {}
+        n_parents = {}
+        for id, parent_ids in term_parents.items():
+            known_parent_ids = []
+            for parent_id in parent_ids:
+                if parent_id in term_parents:
+                    known_parent_ids.append(parent_id)
+                    children.setdefault(parent_id, []).append(id)
+                else:
+                    logger.warning("Ignoring unknown parent of {!r}: {!r}".format(id, parent_id))
+            term_parents[id] = known_parent_ids
+            n_parents[id] = len(known_parent_ids)
+
+        # Number terms in topological order
+        ids = []
+        queue = deque(sorted([id for id in term_parents if not n_parents[id]]))
+        while queue:
+            id = queue.popleft()
+            ids.append(id)
+            for child_id in sorted(children.get(id, [])):
+                n_parents[child_id] -= 1
+                if not n_parents[child_id]:
+                    queue.append(child_id)
+
+        if len(ids) < len(term_parents):
+            raise ValueError('Ontology contains a cycle')
+
+        index = dict([(id, i) for i, id in enumerate(ids)])
+
+        # Compute the closure of each term once, from the closures of its parents
+        parent_offsets = array(INDEX_TYPECODE, [0])
+        parents = array(INDEX_TYPECODE)
+        closure_offsets = array(INDEX_TYPECODE, [0])
+        closure = array(INDEX_TYPECODE)
+        for i, id in enumerate(ids):
+            parent_ids = term_parents[id]
+            if len(parent_ids) == 1:
+                # The closure of a single parent is already sorted, and precedes i
+                j = index[parent_ids[0]]
+                parents.append(j)
+                closure.extend(closure[closure_offsets[j]:closure_offsets[j + 1]])
+            else:
+                parent_indices = sorted([index[parent_id] for parent_id in parent_ids])
+                parents.extend(parent_indices)
+                ancestors = set()
+                for j in parent_indices:
+                    ancestors.update(closure[closure_offsets[j]:closure_offsets[j + 1]])
+                closure.extend(sorted(ancestors))
+            parent_offsets.append(len(parents))
+            closure.append(i)
+            closure_offsets.append(len(closure))
+
+        return cls(ids, parent_offsets, parents, closure_offsets, closure)
+
+    def get_arrays(self):
+        """Return the (name, array) of each packed array, in ARRAY_NAMES order"""
+        return list(zip(self.ARRAY_NAMES, [self._parent_offsets, self._parents,
+                                           self._closure_offsets, self._closure]))
+
+    def get_index(self, id):
+        """Return the integer index of the term, or None if it is not in the ontology"""
+        return self._index.get(id)
+
+    def get_parent_indices(self, i):
+        return self._parents[self._parent_offsets[i]:self._parent_offsets[i + 1]]
+
+    def get_closure_indices(self, i):
+        """Return the indices of term i and all of its ancestors"""
+        return self._closure[self._closure_offsets[i]:self._closure_offsets[i + 1]]
+
+    def get_parents(self, id):
+        i = self._index[id]
+        return [self.ids[j] for j in self.get_parent_indices(i)]
+
+    def get_ancestors(self, id):
+        """Return the term and all of its ancestors, in topological order"""
+        i = self._index[id]
+        return [self.ids[j] for j in self.get_closure_indices(i)]
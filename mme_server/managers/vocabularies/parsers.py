@@ -4,12 +4,20 @@ Module for providing file and dataset parsing functionality.
 
 from __future__ import with_statement, division, unicode_literals
 
+import re
 import codecs
+import unicodedata
 
 from csv import DictReader
 from collections import defaultdict
 
-from .obo import Parser as BaseOBOParser
+from .obo import Parser as BaseOBOParser, ParseError
+from .ontology import Ontology
+
+try:
+    unichr
+except NameError:
+    unichr = chr
 
 
 class BaseParser:
@@ -23,52 +31,195 @@ class BaseParser:
         return self.documents()
 
 
+# Python string escape sequences, which OBO quoted values share
+STRING_ESCAPE_RE = re.compile(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|x[0-9a-fA-F]{2}|[0-7]{1,3}|N\{[^}]*\}|.)')
+SIMPLE_ESCAPES = {
+    '\\': '\\',
+    "'": "'",
+    '"': '"',
+    'a': '\a',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+
+
+def _unescape(match):
+    escape = match.group(1)
+    first = escape[0]
+    if first in SIMPLE_ESCAPES:
+        return SIMPLE_ESCAPES[first]
+    elif first in 'uUx':
+        return unichr(int(escape[1:], 16))
+    elif first == 'N':
+        return unicodedata.lookup(escape[2:-1])
+    elif first in '01234567':
+        return unichr(int(escape, 8))
+    else:
+        # Unknown escapes are left as they are
+        return match.group(0)
+
+
+def parse_obo_string(value):
+    """Return the text of the quoted string at the start of value, dropping any modifiers"""
+    end = value.find('"', 1)
+    while end > 0:
+        text = value[1:end]
+        if '\\' not in text:
+            return text
+
+        # Skip escaped quotes, by counting the backslashes preceding this one
+        backslashes = len(text) - len(text.rstrip('\\'))
+        if backslashes % 2 == 0:
+            return STRING_ESCAPE_RE.sub(_unescape, text)
+        end = value.find('"', end + 1)
+
+    raise ParseError('Cannot parse string literal: {!r}'.format(value))
+
+
+def strip_obo_comment(line):
+    """Remove a trailing "! comment" from the line, ignoring "!" within quoted strings"""
+    index = line.find('!')
+    if index < 0:
+        return line
+
+    if '"' in line[:index]:
+        in_quotes = False
+        escape = False
+        index = None
+        for i, char in enumerate(line):
+            if escape:
+                escape = False
+            elif char == '"':
+                in_quotes = not in_quotes
+            elif char == '\\' and in_quotes:
+                escape = True
+            elif char == '!' and not in_quotes:
+                index = i
+                break
+
+        if index is None:
+            return line
+
+    return line[:index].strip()
+
+
+def iter_obo_stanzas(lines):
+    """Iterate over the stanzas in the lines of an OBO file
+
+    Yields a (name, tags) tuple for each stanza, where tags maps each tag to
+    the list of its values. Quoted values are unescaped and their modifiers
+    dropped, other values are kept as they are. Header lines are skipped.
+    """
+    lines = iter(lines)
+    name = None
+    tags = None
+    in_headers = True
+    for line in lines:
+        line = line.strip()
+        if not line:
+            in_headers = False
+            continue
+
+        first = line[0]
+        if first == '!':
+            continue
+        elif line[-1] == '\\':
+            # The line is continued on the following lines
+            parts = [line[:-1]]
+            for line in lines:
+                if line[:1] == '!':
+                    continue
+                line = line.strip()
+                if line[-1:] != '\\':
+                    parts.append(line)
+                    break
+                parts.append(line[:-1])
+            line = ' '.join(parts)
+        elif '!' in line:
+            line = strip_obo_comment(line)
+
+        if first == '[':
+            in_headers = False
+            if tags is not None:
+                yield name, tags
+            name = line[1:-1]
+            tags = {}
+            continue
+        elif tags is None:
+            if in_headers:
+                continue
+            raise ParseError('Expected a stanza, found: {!r}'.format(line))
+
+        tag, colon, value = line.partition(':')
+        if not tag or not colon:
+            raise ParseError('Expected "tag: value", found: {!r}'.format(line))
+
+        value = value.lstrip()
+        if value and value[0] == '"':
+            value = parse_obo_string(value)
+
+        values = tags.get(tag)
+        if values is None:
+            tags[tag] = [value]
+        else:
+            values.append(value)
+
+    if tags is not None:
+        yield name, tags
+
+
 class OBOParser(BaseParser):
-    def documents(self):
-        parser = BaseOBOParser(codecs.open(self._filename, encoding='utf-8'))
+    def stanzas(self):
+        with codecs.open(self._filename, encoding='utf-8') as ifp:
+            # Split lines as the codecs reader does, reading the file at once for speed
+            lines = ifp.read().splitlines()
+
+        return iter_obo_stanzas(lines)
 
+    def documents(self):
         # Parse all terms first
         terms = {}
-
-        def get_tag_strings(stanza, tag):
-            return list(map(str, stanza.tags.get(tag, [])))
-
-        for stanza in parser:
-            id = str(stanza.tags['id'][0])
-            name = get_tag_strings(stanza, 'name')
-            alt_id = get_tag_strings(stanza, 'alt_id')
-            synonym = get_tag_strings(stanza, 'synonym')
-            is_a = get_tag_strings(stanza, 'is_a')
-            is_obsolete = get_tag_strings(stanza, 'is_obsolete')
+        for name, tags in self.stanzas():
+            id = tags['id'][0]
+            is_obsolete = tags.get('is_obsolete', [])
             # Skip obsolete terms
             if is_obsolete and 'true' in is_obsolete:
                 continue
 
             terms[id] = {
                 'id': id,
-                'name': name,
-                'synonym': synonym,
-                'alt_id': alt_id,
-                'is_a': is_a,
+                'name': tags.get('name', []),
+                'synonym': tags.get('synonym', []),
+                'alt_id': tags.get('alt_id', []),
+                'is_a': tags.get('is_a', []),
                 'term_category': [],  # Added later
             }
 
-        # Then compute ancestor paths for each term
-        def get_ancestors(node_id, ancestors=None):
-            if ancestors is None:
-                ancestors = set()
-            ancestors.add(node_id)
-            for parent_id in terms[node_id]['is_a']:
-                get_ancestors(parent_id, ancestors)
-            return ancestors
+        # Then compile the ontology to compute the ancestors of every term
+        ontology = Ontology.from_terms(terms.values())
 
         for id in terms:
             term = terms[id]
-            term['term_category'] = list(get_ancestors(id))
+            term['term_category'] = ontology.get_ancestors(id)
 
             yield term
 
 
+class ReferenceOBOParser(OBOParser):
+    """OBOParser using the (much slower) vendored OBO parser, for comparison"""
+    def stanzas(self):
+        with codecs.open(self._filename, encoding='utf-8') as ifp:
+            for stanza in BaseOBOParser(ifp):
+                tags = {}
+                for tag, values in stanza.tags.items():
+                    tags[tag] = list(map(str, values))
+                yield stanza.name, tags
+
+
 class TSVParser(BaseParser):
     def _documents(self, columns):
         with codecs.open(self._filename, encoding='utf-8') as ifp:
@@ -0,0 +1,159 @@
+"""
+Module providing in-process resolution of vocabulary terms.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+
+from .ontology import Ontology
+from .snapshot import AMBIGUOUS
+
+logger = logging.getLogger(__name__)
+
+# Term fields loaded into memory (synonyms are only useful for full-text search, and
+# the term_category of ontology terms can be computed from the compiled ontology)
+TERM_FIELDS = ['id', 'name', 'alt_id', 'is_a']
+RESOLVED_FIELDS = TERM_FIELDS + ['term_category']
+
+
+class TermResolver:
+    """An in-memory map from term ids and alt_ids to canonical vocabulary terms
+
+    A key shared by more than one term (e.g., a gene symbol that is a synonym
+    of several genes) cannot be uniquely resolved, so it resolves to None, as
+    it would when querying the index.
+
+    Terms with an 'is_a' field are compiled into an Ontology, from which the
+    term_category (the term and all of its ancestors) of each term is derived,
+    unless the term was added with its term_category.
+
+    The terms of an OntologySnapshot are not loaded into memory: they are
+    looked up in the mapped file when resolved, and its compiled Ontology is
+    used until terms with an 'is_a' field change. Added terms take the place
+    of snapshot terms with the same id.
+    """
+    def __init__(self, terms=(), snapshot=None):
+        # term id -> term
+        self._terms = {}
+        # id or alt_id -> term id (or a tuple of term ids, if ambiguous)
+        self._keys = {}
+        self._snapshot = snapshot
+        # The ids of removed snapshot terms
+        self._removed = set()
+        # Compiled on demand, after any terms are added or removed
+        self._ontology = snapshot.get_ontology() if snapshot is not None else None
+        self.update(terms)
+
+    def __len__(self):
+        return len(self.get_ids())
+
+    def __contains__(self, key):
+        return key in self._keys or self._find_snapshot_term(key) is not None
+
+    def get_ids(self):
+        """Return the ids of all terms"""
+        ids = list(self._terms)
+        if self._snapshot is not None:
+            ids.extend([id for id in self._snapshot.get_ontology().ids if not self._is_replaced(id)])
+        return ids
+
+    def _is_replaced(self, id):
+        """Return whether the snapshot term with the id was added again or removed"""
+        return id in self._terms or id in self._removed
+
+    def _find_snapshot_term(self, key):
+        """Return the index of the snapshot term with the id or alt_id, AMBIGUOUS, or None"""
+        if self._snapshot is None:
+            return None
+
+        i = self._snapshot.find(key)
+        if i is not None and i != AMBIGUOUS and self._is_replaced(self._snapshot.get_ontology().ids[i]):
+            return None
+        return i
+
+    def _iter_terms(self):
+        for term in self._terms.values():
+            yield term
+
+        if self._snapshot is not None:
+            for term in self._snapshot.iter_terms():
+                if not self._is_replaced(term['id']):
+                    yield term
+
+    def _get_keys(self, term):
+        return [term['id']] + list(term.get('alt_id', []))
+
+    def add(self, term):
+        """Add a term, replacing any existing term with the same id"""
+        id = term['id']
+        if id in self._terms:
+            self.remove(id)
+
+        term = dict([(field, term[field]) for field in RESOLVED_FIELDS if field in term])
+        self._terms[id] = term
+        self._removed.discard(id)
+        if 'is_a' in term:
+            self._ontology = None
+
+        for key in self._get_keys(term):
+            existing = self._keys.get(key)
+            if existing is None or existing == id:
+                self._keys[key] = id
+            elif isinstance(existing, tuple):
+                if id not in existing:
+                    self._keys[key] = existing + (id,)
+            else:
+                self._keys[key] = (existing, id)
+
+    def update(self, terms):
+        for term in terms:
+            self.add(term)
+
+    def remove(self, id):
+        """Remove the term with the given id, if present"""
+        term = self._terms.pop(id, None)
+        if self._snapshot is not None and self._snapshot.get_ontology().get_index(id) is not None:
+            self._removed.add(id)
+            self._ontology = None
+        if term is None:
+            return
+
+        if 'is_a' in term:
+            self._ontology = None
+
+        for key in self._get_keys(term):
+            existing = self._keys.get(key)
+            if isinstance(existing, tuple):
+                remaining = tuple([other for other in existing if other != id])
+                self._keys[key] = remaining[0] if len(remaining) == 1 else remaining
+            elif existing == id:
+                del self._keys[key]
+
+    def get_ontology(self):
+        """Return the Ontology compiled from all terms with an 'is_a' field"""
+        if self._ontology is None:
+            terms = [term for term in self._iter_terms() if 'is_a' in term]
+            self._ontology = Ontology.from_terms(terms)
+
+        return self._ontology
+
+    def get_term(self, key):
+        """Return the term uniquely identified by the given id or alt_id, else None"""
+        id = self._keys.get(key)
+        i = self._find_snapshot_term(key)
+        if i is not None:
+            # The key of a snapshot term, unless it is shared with other terms
+            if i == AMBIGUOUS or id is not None:
+                return None
+            term = self._snapshot.get_term(i)
+            id = term['id']
+        elif id is None or isinstance(id, tuple):
+            return None
+        else:
+            term = self._terms[id]
+
+        if 'is_a' in term and 'term_category' not in term:
+            term = dict(term)
+            term['term_category'] = self.get_ontology().get_ancestors(id)
+
+        return term
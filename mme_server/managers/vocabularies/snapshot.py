@@ -0,0 +1,249 @@
+"""
+Module for writing and memory-mapping compiled snapshots of an ontology.
+
+A snapshot holds the term ids, names, alt_ids and is_a fields of every term,
+a sorted table of the ids and alt_ids by which terms are looked up, and the
+packed parent and closure arrays of the compiled Ontology, so that server
+processes can load the ontology without parsing or querying for it, look up
+terms without decoding them all, and share the pages of the mapped file.
+
+Layout: an 8-byte magic number, the length of a JSON header (a little-endian
+uint32), the header, and then each section at the byte offset listed in the
+header. Integer sections are packed INDEX_TYPECODE arrays; string sections
+are UTF-8 data with an array of the byte offsets of each string.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import logging
+
+from array import array
+
+from .ontology import Ontology, INDEX_TYPECODE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MMEONTO\x02'
+HEADER_LENGTH = struct.Struct(str('<I'))
+# Sections start at multiples of this many bytes, so integer arrays are aligned
+ALIGNMENT = 8
+# Term fields stored in the snapshot, as lists of strings per term
+TERM_FIELDS = ['name', 'alt_id', 'is_a']
+# The term of a key shared by several terms, which cannot be uniquely resolved
+AMBIGUOUS = -1
+
+
+def get_checksum(filename, block_size=1 << 20):
+    """Return the SHA-256 hex digest of the contents of the file"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as ifp:
+        block = ifp.read(block_size)
+        while block:
+            digest.update(block)
+            block = ifp.read(block_size)
+    return digest.hexdigest()
+
+
+def _to_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def _pack_strings(strings):
+    """Return the byte offsets and the concatenated UTF-8 data of the strings"""
+    offsets = array(INDEX_TYPECODE, [0])
+    data = []
+    length = 0
+    for string in strings:
+        encoded = string.encode('utf-8')
+        data.append(encoded)
+        length += len(encoded)
+        offsets.append(length)
+    return offsets, b''.join(data)
+
+
+def write_snapshot(filename, terms, checksum):
+    """Compile the ontology of the given terms and write it to a snapshot file
+
+    The file is written alongside and then moved into place, so processes
+    that have already mapped a previous snapshot are not affected.
+    """
+    terms = dict([(term['id'], term) for term in terms])
+    ontology = Ontology.from_terms(terms.values())
+
+    sections = []
+    for name, values in ontology.get_arrays():
+        sections.append((name, _to_bytes(values)))
+
+    offsets, data = _pack_strings(ontology.ids)
+    sections.append(('ids_offsets', _to_bytes(offsets)))
+    sections.append(('ids_data', data))
+
+    for field in TERM_FIELDS:
+        # The strings of term i are the slice [index[i]:index[i + 1]] of all strings
+        index = array(INDEX_TYPECODE, [0])
+        strings = []
+        for id in ontology.ids:
+            strings.extend(terms[id].get(field, []))
+            index.append(len(strings))
+
+        offsets, data = _pack_strings(strings)
+        sections.append((field + '_index', _to_bytes(index)))
+        sections.append((field + '_offsets', _to_bytes(offsets)))
+        sections.append((field + '_data', data))
+
+    # The ids and alt_ids of the terms, sorted by their UTF-8 encoding, and the term of each
+    keys = {}
+    for i, id in enumerate(ontology.ids):
+        for key in [id] + list(terms[id].get('alt_id', [])):
+            keys.setdefault(key.encode('utf-8'), set()).add(i)
+
+    sorted_keys = sorted(keys)
+    key_terms = array(INDEX_TYPECODE, [])
+    for key in sorted_keys:
+        indices = keys[key]
+        key_terms.append(indices.pop() if len(indices) == 1 else AMBIGUOUS)
+
+    offsets, data = _pack_strings([key.decode('utf-8') for key in sorted_keys])
+    sections.append(('keys_offsets', _to_bytes(offsets)))
+    sections.append(('keys_data', data))
+    sections.append(('keys_terms', _to_bytes(key_terms)))
+
+    # Lay out the sections after the header
+    layout = {}
+    position = 0
+    for name, data in sections:
+        layout[name] = [position, len(data)]
+        position += len(data) + (-len(data) % ALIGNMENT)
+
+    header = json.dumps({
+        'checksum': checksum,
+        'byteorder': sys.byteorder,
+        'itemsize': array(INDEX_TYPECODE).itemsize,
+        'sections': layout,
+    }).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + HEADER_LENGTH.size + len(header)) % ALIGNMENT)
+
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'wb') as ofp:
+        ofp.write(MAGIC)
+        ofp.write(HEADER_LENGTH.pack(len(header)))
+        ofp.write(header)
+        for name, data in sections:
+            ofp.write(data)
+            ofp.write(b'\0' * (-len(data) % ALIGNMENT))
+
+    getattr(os, 'replace', os.rename)(temp_filename, filename)
+    logger.info("Wrote snapshot of {} ontology terms to: {!r}".format(len(ontology), filename))
+    return ontology
+
+
+def read_checksum(filename):
+    """Return the checksum of the source of the snapshot file, or None if it is missing or invalid"""
+    try:
+        return OntologySnapshot(filename).checksum
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class OntologySnapshot:
+    """A memory-mapped ontology snapshot
+
+    Raises ValueError if the file is not a snapshot readable on this platform.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as ifp:
+            self._mmap = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        prefix_length = len(MAGIC) + HEADER_LENGTH.size
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not an ontology snapshot: {!r}'.format(filename))
+
+        header_length = HEADER_LENGTH.unpack(self._mmap[len(MAGIC):prefix_length])[0]
+        header = json.loads(self._mmap[prefix_length:prefix_length + header_length].decode('utf-8'))
+        if (header['byteorder'] != sys.byteorder or
+                header['itemsize'] != array(INDEX_TYPECODE).itemsize):
+            raise ValueError('Ontology snapshot written on an incompatible platform: {!r}'.format(filename))
+
+        self.checksum = header['checksum']
+        self._start = prefix_length + header_length
+        self._sections = header['sections']
+        self._arrays = {}
+        self._ontology = None
+
+    def __len__(self):
+        return len(self._get_array('ids_offsets')) - 1
+
+    def _get_bytes(self, name):
+        offset, length = self._sections[name]
+        offset += self._start
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def _get_array(self, name):
+        values = self._arrays.get(name)
+        if values is None:
+            data = self._get_bytes(name)
+            if hasattr(data, 'cast'):
+                # Use the mapped pages directly
+                values = data.cast(INDEX_TYPECODE)
+            else:
+                values = array(INDEX_TYPECODE)
+                values.fromstring(data.tobytes())
+            self._arrays[name] = values
+        return values
+
+    def _get_encoded_string(self, name, i):
+        offsets = self._get_array(name + '_offsets')
+        return self._get_bytes(name + '_data')[offsets[i]:offsets[i + 1]].tobytes()
+
+    def _get_strings(self, name):
+        offsets = self._get_array(name + '_offsets')
+        data = self._get_bytes(name + '_data')
+        return [data[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+                for i in range(len(offsets) - 1)]
+
+    def get_ontology(self):
+        """Return the Ontology, backed by the mapped arrays"""
+        if self._ontology is None:
+            arrays = [self._get_array(name) for name in Ontology.ARRAY_NAMES]
+            self._ontology = Ontology(self._get_strings('ids'), *arrays)
+        return self._ontology
+
+    def find(self, key):
+        """Return the index of the term with the given id or alt_id, AMBIGUOUS, or None if there is none
+
+        This is a binary search of the mapped key table, decoding nothing.
+        """
+        encoded = key.encode('utf-8')
+        low = 0
+        high = len(self._get_array('keys_terms'))
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_encoded_string('keys', middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        key_terms = self._get_array('keys_terms')
+        if low < len(key_terms) and self._get_encoded_string('keys', low) == encoded:
+            return key_terms[low]
+        return None
+
+    def get_term(self, i):
+        """Return term i (an index of the Ontology), with its id and TERM_FIELDS, decoding only its strings"""
+        term = {'id': self.get_ontology().ids[i]}
+        for field in TERM_FIELDS:
+            index = self._get_array(field + '_index')
+            term[field] = [self._get_encoded_string(field, j).decode('utf-8')
+                           for j in range(index[i], index[i + 1])]
+        return term
+
+    def iter_terms(self):
+        """Iterate over the terms in the snapshot, with their id and TERM_FIELDS"""
+        for i in range(len(self)):
+            yield self.get_term(i)
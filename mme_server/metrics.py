@@ -0,0 +1,335 @@
+"""
+Module for in-process metrics, exposed in the Prometheus text format on /metrics.
+
+Metrics are plain counters, gauges and histograms updated under a lock, so
+they are cheap enough to leave on in production. Each process keeps its own
+metrics; with several worker processes, set MME_METRICS_DIR to a directory
+shared by the workers, to which each worker writes its metrics (at most once
+a second), so that /metrics reports the sum over all workers.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import os
+import json
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from elasticsearch import Transport
+from werkzeug.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# Upper bounds of the histogram of elasticsearch requests per match request
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50]
+# The minimum seconds between writes of the metrics of this process to DIRECTORY
+DUMP_INTERVAL = 1.0
+# The directory shared by worker processes to sum their metrics (set from MME_METRICS_DIR)
+DIRECTORY = None
+
+
+class Metric:
+    """A metric with a value for each combination of label values"""
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Tuple of label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, labels):
+        return tuple([str(labels[label]) for label in self.labels])
+
+    def get_state(self):
+        """Return a JSON-serializable list of the [label values, value] of the metric"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge_states(self, states):
+        """Return a dict of label values -> value, summed over the states of several processes"""
+        values = {}
+        for state in states:
+            for key, value in state:
+                key = tuple(key)
+                if key in values:
+                    values[key] = self._add(values[key], value)
+                else:
+                    values[key] = value
+        return values
+
+    def _add(self, value, other):
+        return value + other
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(['{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                               for name, value in pairs]) + '}'
+
+    def render(self, values):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.TYPE),
+        ]
+        for key in sorted(values):
+            lines.extend(self._render_value(key, values[key]))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, self._format_labels(key), format_value(value))]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Gauge(Counter):
+    """A value that goes up and down, which is only reported for running processes"""
+    TYPE = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts of observations by bucket (each value is [bucket counts..., count of larger values, sum])"""
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels=labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def get_state(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+    def _add(self, value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def _render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else format_value(bound)
+            lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, [('le', le)]), cumulative))
+        lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, self._format_labels(key), format_value(counts[-1])))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REQUESTS = Counter('mme_match_requests_total', 'Match requests, by HTTP status', labels=['status'])
+REQUEST_SECONDS = Histogram('mme_match_request_seconds', 'Latency of match requests')
+STAGE_SECONDS = Histogram('mme_match_stage_seconds', 'Latency of each stage of match requests', labels=['stage'])
+IN_FLIGHT = Gauge('mme_match_requests_in_flight', 'Match requests being handled')
+ES_REQUESTS = Counter('mme_elasticsearch_requests_total', 'Requests to elasticsearch')
+ES_REQUESTS_PER_MATCH = Histogram('mme_match_elasticsearch_requests', 'Requests to elasticsearch per match request',
+                                  buckets=COUNT_BUCKETS)
+CACHE_REQUESTS = Counter('mme_cache_requests_total', 'Cache lookups, by cache and result (hit or miss)',
+                         labels=['cache', 'result'])
+
+METRICS = [REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, IN_FLIGHT, ES_REQUESTS, ES_REQUESTS_PER_MATCH, CACHE_REQUESTS]
+
+# The number of elasticsearch requests made (es_requests) and the seconds of
+# each stage (stages) of the match request handled by the current thread
+_local = threading.local()
+_last_dump = 0
+_dump_lock = threading.Lock()
+
+
+class CountingTransport(Transport):
+    """An elasticsearch Transport counting requests, in total and for the match request of the current thread"""
+    def perform_request(self, method, url, params=None, body=None):
+        ES_REQUESTS.inc()
+        if getattr(_local, 'es_requests', None) is not None:
+            _local.es_requests += 1
+        return Transport.perform_request(self, method, url, params=params, body=body)
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+@contextmanager
+def timed(stage):
+    """Record the latency of a stage of a match request"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        stages = getattr(_local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + elapsed
+
+
+def get_request_stages():
+    """Return a dict of the seconds of each stage of the match request of the current thread so far
+
+    Between requests, returns the stages of the last request of the thread.
+    """
+    stages = getattr(_local, 'stages', None)
+    if stages is None:
+        stages = getattr(_local, 'last_stages', None)
+    return dict(stages or {})
+
+
+def get_request_elasticsearch_requests():
+    """Return the number of elasticsearch requests of the match request of the current thread so far"""
+    return getattr(_local, 'es_requests', None)
+
+
+@contextmanager
+def tracked_request(in_thread=True):
+    """Record the latency and in-flight count of a match request
+
+    Yields a dict, in which the HTTP 'status' of the response should be set.
+
+    in_thread - whether the whole request is handled by the current thread,
+        so its elasticsearch requests and stages can be recorded per request
+    """
+    IN_FLIGHT.inc()
+    if in_thread:
+        _local.es_requests = 0
+        _local.stages = {}
+    start = time.time()
+    result = {'status': 500}
+    try:
+        yield result
+    finally:
+        REQUEST_SECONDS.observe(time.time() - start)
+        REQUESTS.inc(status=result['status'])
+        if in_thread:
+            ES_REQUESTS_PER_MATCH.observe(_local.es_requests)
+            _local.es_requests = None
+            _local.last_stages = _local.stages
+            _local.stages = None
+        IN_FLIGHT.dec()
+        dump()
+
+
+def track_requests():
+    """Decorate a Flask view to record its requests with tracked_request"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with tracked_request() as result:
+                try:
+                    response = f(*args, **kwargs)
+                except HTTPException as e:
+                    result['status'] = e.code
+                    raise
+                result['status'] = getattr(response, 'status_code', 200)
+                return response
+        return decorated_function
+    return decorator
+
+
+def get_state():
+    return {
+        'pid': os.getpid(),
+        'metrics': dict([(metric.name, metric.get_state()) for metric in METRICS]),
+    }
+
+
+def dump(force=False):
+    """Write the metrics of this process to DIRECTORY (if set), at most once every DUMP_INTERVAL seconds"""
+    global _last_dump
+
+    directory = DIRECTORY
+    if not directory:
+        return
+
+    now = time.time()
+    if not force and now - _last_dump < DUMP_INTERVAL:
+        return
+
+    with _dump_lock:
+        if not force and now - _last_dump < DUMP_INTERVAL:
+            return
+        _last_dump = now
+
+        try:
+            filename = os.path.join(directory, 'metrics-{}.json'.format(os.getpid()))
+            temp_filename = '{}.tmp'.format(filename)
+            with open(temp_filename, 'w') as ofp:
+                json.dump(get_state(), ofp)
+            getattr(os, 'replace', os.rename)(temp_filename, filename)
+        except (IOError, OSError):
+            logger.exception("Unable to write metrics to: {!r}".format(directory))
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def load_states(directory):
+    """Return the states of the other processes that wrote their metrics to the directory"""
+    states = []
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as ifp:
+                state = json.load(ifp)
+        except (IOError, OSError, ValueError):
+            continue
+        if state['pid'] != os.getpid():
+            state['running'] = is_running(state['pid'])
+            states.append(state)
+    return states
+
+
+def render():
+    """Return the metrics in the Prometheus text format, summed over the processes writing to DIRECTORY"""
+    states = [get_state()]
+    if DIRECTORY:
+        dump(force=True)
+        states.extend(load_states(DIRECTORY))
+
+    lines = []
+    for metric in METRICS:
+        # Gauges of stopped processes are no longer meaningful
+        metric_states = [state['metrics'].get(metric.name, []) for state in states
+                         if state.get('running', True) or metric.TYPE != 'gauge']
+        lines.extend(metric.render(metric.merge_states(metric_states)))
+    return '\n'.join(lines) + '\n'
@@ -9,13 +9,26 @@ from copy import deepcopy
 
 from .backend import get_backend
 
+def get_terms(ids):
+    """Resolve a list of vocabulary term IDs together, returning a dict of id -> term"""
+    backend = get_backend()
+    vocabularies = backend.get_manager('vocabularies')
+    return vocabularies.get_terms(ids)
+
+
 class Feature:
-    def __init__(self, data):
+    def __init__(self, data, terms=None):
+        """Normalize a phenotype feature
+
+        terms - a dict of id -> term, including the ids from get_term_ids(data)
+            (if not provided, the terms are resolved with the vocabulary manager)
+        """
         self.data = deepcopy(data)
-        backend = get_backend()
-        vocabularies = backend.get_manager('vocabularies')
+        if terms is None:
+            terms = get_terms(self.get_term_ids(data))
+
         # Normalize phenotype term
-        term = vocabularies.get_term(id=self.data['id'])
+        term = terms.get(self.data['id'])
         if term:
             self.data['id'] = term['id']
             # All vocabulary fields are lists
@@ -30,13 +43,22 @@ class Feature:
         # Normalize age of onset
         term_id = self.data.get('ageOfOnset')
         if term_id:
-            term = vocabularies.get_term(id=term_id)
-            self.data['ageOfOnset'] = term['id']
+            term = terms.get(term_id)
+            if term:
+                self.data['ageOfOnset'] = term['id']
 
         # Normalize observed
         observed = self.data.get('observed', 'yes') == 'yes'
         self.data['observed'] = 'yes' if observed else 'no'
 
+    @staticmethod
+    def get_term_ids(data):
+        """Return the vocabulary term IDs to resolve to normalize the feature"""
+        ids = [data['id']]
+        if data.get('ageOfOnset'):
+            ids.append(data['ageOfOnset'])
+        return ids
+
     def get_implied_terms(self):
         return self.phenotypes
 
@@ -48,14 +70,15 @@ class Feature:
 
 
 class Gene:
-    def __init__(self, data):
+    def __init__(self, data, terms=None):
         self.data = deepcopy(data)
         gene_id = self.data.get('id')
         if gene_id:
+            if terms is None:
+                terms = get_terms(self.get_term_ids(data))
+
             # Normalize gene id
-            backend = get_backend()
-            vocabularies = backend.get_manager('vocabularies')
-            term = vocabularies.get_term(id=gene_id)
+            term = terms.get(gene_id)
             if term:
                 self.data['id'] = term['id']
                 # All vocabulary fields are lists
@@ -63,6 +86,11 @@ class Gene:
                     name = term['name'][0]
                     self.data['label'] = name
 
+    @staticmethod
+    def get_term_ids(data):
+        """Return the vocabulary term IDs to resolve to normalize the gene"""
+        return [data['id']] if data.get('id') else []
+
     def get_id(self):
         return self.data.get('id')
 
@@ -71,17 +99,24 @@ class Gene:
 
 
 class GenomicFeature:
-    def __init__(self, data):
+    def __init__(self, data, terms=None):
         self.data = deepcopy(data)
+        self.gene = None
 
         # Normalize gene
         gene_json = data.get('gene')
         if gene_json:
-            self.gene = Gene(gene_json)
+            self.gene = Gene(gene_json, terms=terms)
             self.data['gene'] = self.gene.to_json()
 
         # TODO: Normalize mutation type with SO
 
+    @staticmethod
+    def get_term_ids(data):
+        """Return the vocabulary term IDs to resolve to normalize the genomic feature"""
+        gene_json = data.get('gene')
+        return Gene.get_term_ids(gene_json) if gene_json else []
+
     def get_gene_id(self):
         if self.gene:
             return self.gene.get_id()
@@ -108,16 +143,34 @@ class Patient:
         # API representation of the patient
         self.data = dict(data)
 
+    @staticmethod
+    def get_term_ids(data):
+        """Return the vocabulary term IDs to resolve to normalize the patient"""
+        ids = []
+        for feature_json in data.get('features', []):
+            ids.extend(Feature.get_term_ids(feature_json))
+        for gf_json in data.get('genomicFeatures', []):
+            ids.extend(GenomicFeature.get_term_ids(gf_json))
+        return ids
+
     @classmethod
-    def from_api(cls, data):
+    def from_api(cls, data, terms=None):
+        """Normalize a patient from the API
+
+        terms - a dict of id -> term, including the ids from get_term_ids(data)
+            (if not provided, all terms are resolved at once with the vocabulary manager)
+        """
         data = deepcopy(data)
         phenotypes = set()
         genes = set()
 
+        if terms is None:
+            terms = get_terms(cls.get_term_ids(data))
+
         # Normalize phenotype terms
         features = []
         for feature_json in data.get('features', []):
-            feature = Feature(feature_json)
+            feature = Feature(feature_json, terms=terms)
             if feature.is_present():
                 phenotypes.update(feature.get_implied_terms())
 
@@ -128,7 +181,7 @@ class Patient:
         # Normalize genomic features
         genomic_features = []
         for gf_json in data.get('genomicFeatures', []):
-            gf = GenomicFeature(gf_json)
+            gf = GenomicFeature(gf_json, terms=terms)
             gene = gf.get_gene_id()
             if gene:
                 genes.add(gene)
@@ -157,12 +210,20 @@ class Patient:
     def to_api(self):
         return self.data
 
+    def is_test(self):
+        return bool(self.data.get('test', False))
+
     def to_index(self):
         doc = {
             'phenotype': sorted(self.phenotypes),
             'gene': sorted(self.genes),
+            'test': self.is_test(),
             'doc': dict(self.data),
         }
+        # Indexed separately from the (non-indexed) doc, to filter matches
+        institution = self.data.get('contact', {}).get('institution')
+        if institution:
+            doc['institution'] = institution
         return doc
 
 
@@ -171,8 +232,8 @@ class MatchRequest:
         self.patient = patient
 
     @classmethod
-    def from_api(cls, request):
-        patient = Patient.from_api(request['patient'])
+    def from_api(cls, request, terms=None):
+        patient = Patient.from_api(request['patient'], terms=terms)
         return cls(patient)
 
     def to_api(self):
@@ -180,20 +241,55 @@ class MatchRequest:
             'patient': self.patient.to_api()
         }
 
-    def match(self, n=5):
+    def match(self, n=5, engine='elasticsearch', candidates=500, filters=None):
+        """Return a MatchResponse of the n most similar patients
+
+        engine - 'elasticsearch' to use the elasticsearch TF/IDF score,
+            'similarity' to use the in-process semantic similarity score, or
+            'rerank' to rescore the best elasticsearch candidates by semantic similarity
+        candidates - the number of candidates to rescore with the 'rerank' engine
+        filters - a dict of indexed field ('test', 'server' or 'institution') ->
+            value or list of values, restricting the matched patients without
+            affecting their scores
+
+        Responses are cached by the normalized phenotypes and genes of the
+        query, until the patients change.
+        """
         backend = get_backend()
         patients = backend.get_manager('patients')
         phenotypes = self.patient.phenotypes
         genes = self.patient.genes
-        hits = patients.match(phenotypes, genes)
+
+        options = {'engine': engine}
+        if engine == 'rerank':
+            options['candidates'] = candidates
+        if filters:
+            options['filters'] = filters
+        key = patients.get_match_cache_key(phenotypes, genes, n, **options)
+        response = patients.get_cached_match(key)
+        if response is not None:
+            return response
 
         matches = []
-        for hit in hits[:n]:
-            match = MatchResult.from_index(hit)
-            matches.append(match)
+        if engine == 'similarity':
+            for patient, score in patients.match_similar(phenotypes, genes, n=n, filters=filters):
+                matches.append(MatchResult(patient, score))
+        elif engine == 'rerank':
+            for patient, score in patients.match_reranked(phenotypes, genes, n=n, candidates=candidates,
+                                                             filters=filters):
+                matches.append(MatchResult(patient, score))
+        elif engine == 'elasticsearch':
+            hits = patients.match(phenotypes, genes, n=n, filters=filters)
+            for hit in hits[:n]:
+                match = MatchResult.from_index(hit)
+                matches.append(match)
+        else:
+            raise ValueError('Unknown match engine: {!r}'.format(engine))
 
         matches.sort(reverse=True)
-        return MatchResponse(matches)
+        response = MatchResponse(matches)
+        patients.set_cached_match(key, response)
+        return response
 
 
 class MatchResult:
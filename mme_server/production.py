@@ -0,0 +1,90 @@
+"""
+Module for serving the API from multiple pre-forked worker processes, with gunicorn.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+import tempfile
+
+from . import metrics
+from .backend import get_backend
+from .schemas import get_schema
+from .server import app
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_THREADS = 1
+DEFAULT_BACKLOG = 2048
+DEFAULT_KEEP_ALIVE = 5
+DEFAULT_TIMEOUT = 30
+
+
+def preload():
+    """Load shared, read-only state, so forked workers share its pages instead of each loading it"""
+    get_schema()
+
+    with app.app_context():
+        backend = get_backend()
+        try:
+            backend.get_manager('vocabularies').get_resolver()
+        except Exception:
+            logger.exception("Unable to preload vocabularies; each worker will load them on first use")
+            return
+
+        if app.config['MME_PATIENT_STORE'] == 'memory':
+            backend.get_manager('patients').get_store()
+
+        if app.config['MME_MATCH_ENGINE'] == 'similarity':
+            # Workers start with the forked index, and each rebuilds its own once
+            # the patients generation changes
+            try:
+                backend.get_manager('patients').get_similarity_index()
+            except Exception:
+                logger.exception("Unable to preload similarity index; each worker will build it on first use")
+
+
+def serve(host, port, workers=DEFAULT_WORKERS, threads=DEFAULT_THREADS, backlog=DEFAULT_BACKLOG,
+          keep_alive=DEFAULT_KEEP_ALIVE, timeout=DEFAULT_TIMEOUT):
+    """Serve the API with gunicorn, from pre-forked worker processes
+
+    :param workers: the number of worker processes
+    :param threads: the number of request threads in each worker
+    :param backlog: the maximum number of pending connections
+    :param keep_alive: the number of seconds to wait for the next request on a keep-alive connection
+    :param timeout: the number of seconds after which a silent worker is restarted
+    """
+    # Import within function, since gunicorn is an optional dependency
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError('gunicorn is required to run worker processes (pip install -e .[production])')
+
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'backlog': backlog,
+        'keepalive': keep_alive,
+        'timeout': timeout,
+        # Load the application (and preloaded state) once, before forking
+        'preload_app': True,
+    }
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    if not metrics.DIRECTORY:
+        # Workers write their metrics to a shared directory, so /metrics reports all workers
+        metrics.DIRECTORY = tempfile.mkdtemp(prefix='mme-metrics-')
+
+    logger.info("Preloading shared state")
+    preload()
+    logger.info("Starting {} workers with {} threads each on {}".format(workers, threads, options['bind']))
+    Application().run()
@@ -0,0 +1,296 @@
+"""
+Module for profiling slow match requests, by sampling their stacks.
+
+When enabled (MME_PROFILE), a background thread samples the stack of each
+thread handling a match request every MME_PROFILE_INTERVAL seconds. The
+samples of requests that take longer than MME_PROFILE_THRESHOLD seconds (and
+of 1 in MME_PROFILE_EVERY requests) are written to MME_PROFILE_DIR:
+
+- <name>.folded: the samples, aggregated by stack, in the folded format of
+  flamegraph.pl and speedscope (frames from the root, separated by ';',
+  followed by the number of samples)
+- <name>.json: the request id, latency, per-stage timings and number of
+  elasticsearch requests of the request
+
+Only the latest MME_PROFILE_MAX_FILES profiles are kept. Summarize them
+with `mme-server profiles`.
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+
+from functools import wraps
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_THRESHOLD = 1.0
+DEFAULT_MAX_FILES = 100
+
+# Characters not allowed in request ids, which are used in file names
+UNSAFE_ID_RE = re.compile(r'[^A-Za-z0-9_.-]')
+
+# The process-wide RequestProfiler, if profiling is enabled
+_profiler = None
+
+
+def format_frame(code):
+    """Return the name of a frame of the code: the function, and the file and line where it is defined"""
+    directory, filename = os.path.split(code.co_filename)
+    return '{} ({}/{}:{})'.format(code.co_name, os.path.basename(directory), filename, code.co_firstlineno)
+
+
+class StackSampler:
+    """Samples the stacks of registered threads from a background thread
+
+    The thread only runs while threads are registered, and is restarted in
+    forked processes.
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        # Thread ident -> dict of stack -> number of samples
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+        self._pid = None
+        # Code object -> formatted frame
+        self._frame_names = {}
+
+    def start(self, ident):
+        """Start sampling the stack of the thread"""
+        with self._lock:
+            self._stacks[ident] = {}
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='StackSampler')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+        self._active.set()
+
+    def stop(self, ident):
+        """Stop sampling the stack of the thread, returning a dict of stack -> number of samples"""
+        with self._lock:
+            stacks = self._stacks.pop(ident, {})
+            if not self._stacks:
+                self._active.clear()
+        return stacks
+
+    def get_stack(self, frame):
+        """Return the stack of the frame, in the folded format (from the root)"""
+        names = []
+        frame_names = self._frame_names
+        while frame is not None:
+            code = frame.f_code
+            name = frame_names.get(code)
+            if name is None:
+                name = frame_names[code] = format_frame(code)
+            names.append(name)
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = self.get_stack(frame)
+                        stacks[stack] = stacks.get(stack, 0) + 1
+            del frames
+
+
+class RequestProfiler:
+    """Samples the stacks of requests, writing the profiles of slow (and 1 in every) requests to a directory"""
+    def __init__(self, directory, threshold=DEFAULT_THRESHOLD, every=0, interval=DEFAULT_INTERVAL,
+                 max_files=DEFAULT_MAX_FILES):
+        self.directory = directory
+        self.threshold = threshold
+        self.every = every
+        self.interval = interval
+        self.max_files = max_files
+        self.sampler = StackSampler(interval)
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['MME_PROFILE_DIR'], threshold=config['MME_PROFILE_THRESHOLD'],
+                   every=config['MME_PROFILE_EVERY'], interval=config['MME_PROFILE_INTERVAL'],
+                   max_files=config['MME_PROFILE_MAX_FILES'])
+
+    def start(self):
+        self.sampler.start(threading.current_thread().ident)
+
+    def stop(self, request_id, elapsed, status=None):
+        """Stop sampling the current thread, and write its profile if the request is slow or sampled
+
+        Returns the name of the profile written, if any.
+        """
+        stacks = self.sampler.stop(threading.current_thread().ident)
+        if elapsed >= self.threshold:
+            reason = 'slow'
+        elif self.every and random.random() < 1 / self.every:
+            reason = 'sampled'
+        else:
+            return None
+
+        info = {
+            'request_id': request_id,
+            'reason': reason,
+            'time': time.time(),
+            'pid': os.getpid(),
+            'status': status,
+            'seconds': elapsed,
+            'stages': metrics.get_request_stages(),
+            'elasticsearch_requests': metrics.get_request_elasticsearch_requests(),
+            'interval': self.interval,
+            'samples': sum(stacks.values()),
+        }
+        try:
+            return self.write(info, stacks)
+        except (IOError, OSError):
+            logger.exception("Unable to write profile to: {!r}".format(self.directory))
+
+    def write(self, info, stacks):
+        """Write a profile to the directory, removing the oldest profiles beyond max_files"""
+        name = '{:.6f}-{}'.format(info['time'], info['request_id'])
+        prefix = os.path.join(self.directory, name)
+        with self._write_lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            with open(prefix + '.folded', 'w') as ofp:
+                for stack, count in sorted(stacks.items()):
+                    ofp.write('{} {}\n'.format(stack, count))
+            with open(prefix + '.json', 'w') as ofp:
+                json.dump(info, ofp, indent=2, sort_keys=True)
+
+            names = list_profiles(self.directory)
+            for old_name in names[:max(0, len(names) - self.max_files)]:
+                for extension in ['.folded', '.json']:
+                    try:
+                        os.remove(os.path.join(self.directory, old_name + extension))
+                    except OSError:
+                        pass
+
+        logger.warning("Profiled {} match request {!r} ({:.3f}s): {}".format(
+            info['reason'], info['request_id'], info['seconds'], prefix + '.folded'))
+        return name
+
+
+def configure(config):
+    """Enable (or disable) profiling of match requests, with the given settings"""
+    global _profiler
+    _profiler = RequestProfiler.from_config(config) if config['MME_PROFILE'] else None
+
+
+def profile_requests():
+    """Decorate a Flask view to profile its requests, if profiling is enabled
+
+    The request id is taken from the X-Request-Id header, if present.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return f(*args, **kwargs)
+
+            request_id = UNSAFE_ID_RE.sub('_', request.headers.get('X-Request-Id', ''))[:64] or uuid.uuid4().hex
+            start = time.time()
+            status = 500
+            profiler.start()
+            try:
+                response = f(*args, **kwargs)
+                status = getattr(response, 'status_code', 200)
+                return response
+            except HTTPException as e:
+                status = e.code
+                raise
+            finally:
+                profiler.stop(request_id, time.time() - start, status=status)
+        return decorated_function
+    return decorator
+
+
+def list_profiles(directory):
+    """Return the names of the profiles in the directory, oldest first"""
+    names = [name[:-len('.folded')] for name in os.listdir(directory) if name.endswith('.folded')]
+    return sorted(names, key=lambda name: float(name.split('-', 1)[0]))
+
+
+def read_profile(directory, name):
+    """Return the (info, dict of stack -> samples) of a profile"""
+    stacks = {}
+    with open(os.path.join(directory, name + '.folded')) as ifp:
+        for line in ifp:
+            stack, count = line.rstrip('\n').rsplit(' ', 1)
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+
+    try:
+        with open(os.path.join(directory, name + '.json')) as ifp:
+            info = json.load(ifp)
+    except (IOError, OSError, ValueError):
+        info = {}
+
+    return info, stacks
+
+
+def summarize_profiles(directory, top=20):
+    """Return a summary of the profiles in the directory
+
+    Returns a dict with the number of 'profiles' and 'samples', the mean
+    seconds of each stage ('stages'), the slowest requests ('slowest'), and
+    the hottest frames, by the fraction of samples in which each frame is on
+    the stack ('total') and is the innermost frame ('self').
+    """
+    n_profiles = 0
+    n_samples = 0
+    self_samples = {}
+    total_samples = {}
+    stage_seconds = {}
+    requests = []
+    for name in list_profiles(directory):
+        info, stacks = read_profile(directory, name)
+        n_profiles += 1
+        requests.append((info.get('seconds', 0), info.get('request_id', name)))
+        for stage, seconds in info.get('stages', {}).items():
+            stage_seconds.setdefault(stage, []).append(seconds)
+
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            n_samples += count
+            self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + count
+            # Count recursive frames once per sample
+            for frame in set(frames):
+                total_samples[frame] = total_samples.get(frame, 0) + count
+
+    def get_top(samples):
+        frames = sorted(samples, key=lambda frame: (-samples[frame], frame))[:top]
+        return [(frame, samples[frame] / n_samples) for frame in frames]
+
+    return {
+        'profiles': n_profiles,
+        'samples': n_samples,
+        'stages': dict([(stage, sum(values) / len(values)) for stage, values in stage_seconds.items()]),
+        'slowest': sorted(requests, reverse=True)[:top],
+        'self': get_top(self_samples),
+        'total': get_top(total_samples),
+    }
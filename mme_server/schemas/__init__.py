@@ -1,28 +1,69 @@
 from __future__ import with_statement, division, unicode_literals
 
 import json
+import threading
 
 from pkgutil import get_data
 
-from jsonschema import validate, RefResolver, FormatChecker, ValidationError
+from jsonschema import validators, RefResolver, FormatChecker, ValidationError
+from jsonschema.exceptions import best_match
 
 
 SCHEMA_FILE = 'api.json'
 REQUEST_SCHEMA = '#/definitions/request'
 RESPONSE_SCHEMA = '#/definitions/response'
 
+# The parsed schema, loaded on first use
+_schema = None
+_schema_lock = threading.Lock()
+# Compiled validators, per thread (resolvers track their resolution scope, so
+# cannot be shared between threads)
+_local = threading.local()
+
+
 def load_schema():
     # Read resource from same directory of (potentially-zipped) module
     schema_data = get_data(__package__, SCHEMA_FILE).decode('utf-8')
     return json.loads(schema_data)
 
 
-def validate_subschema(data, schema_selector):
-    schema = load_schema()
+def get_schema():
+    """Return the parsed API schema, loading it once per process"""
+    global _schema
+    if _schema is None:
+        with _schema_lock:
+            if _schema is None:
+                _schema = load_schema()
+    return _schema
+
+
+def create_validator(schema_selector):
+    """Return a new validator for the subschema with the given selector"""
+    schema = get_schema()
     resolver = RefResolver.from_schema(schema)
-    format_checker = FormatChecker()
-    request_schema = resolver.resolve_from_url(schema_selector)
-    validate(data, request_schema, resolver=resolver, format_checker=format_checker)
+    subschema = resolver.resolve_from_url(schema_selector)
+    Validator = validators.validator_for(schema)
+    Validator.check_schema(subschema)
+    return Validator(subschema, resolver=resolver, format_checker=FormatChecker())
+
+
+def get_validator(schema_selector):
+    """Return the compiled validator for the subschema with the given selector"""
+    cache = getattr(_local, 'validators', None)
+    if cache is None:
+        cache = _local.validators = {}
+
+    validator = cache.get(schema_selector)
+    if validator is None:
+        validator = cache[schema_selector] = create_validator(schema_selector)
+    return validator
+
+
+def validate_subschema(data, schema_selector):
+    validator = get_validator(schema_selector)
+    error = best_match(validator.iter_errors(data))
+    if error is not None:
+        raise error
 
 
 def validate_request(data):
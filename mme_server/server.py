@@ -8,12 +8,14 @@ from __future__ import with_statement, division, unicode_literals
 
 import logging
 import json
+import random
 
-from flask import Flask, request, after_this_request, jsonify
+from flask import Flask, Response, request, after_this_request, jsonify
 from flask_negotiate import consumes, produces
 from collections import defaultdict
 from werkzeug.exceptions import BadRequest
 
+from . import metrics, profiler
 from .compat import urlopen, Request
 from .auth import auth_token_required
 from .models import MatchRequest
@@ -24,13 +26,27 @@ API_MIME_TYPE = 'application/vnd.ga4gh.matchmaker.v1.0+json'
 
 # Global flask application
 app = Flask(__name__.split('.')[0])
+app.config.from_object('{}.settings'.format(__package__))
+app.config.from_envvar('MME_SERVER_SETTINGS', silent=True)
+metrics.DIRECTORY = app.config['MME_METRICS_DIR']
+profiler.configure(app.config)
 # app.config['DEBUG'] = True
 
 # Logger
 logger = logging.getLogger(__name__)
 
 
+def get_match_filters(config, patient):
+    """Return the filters of the patients matched to a query patient, from the server settings"""
+    filters = dict(config['MME_MATCH_FILTERS'] or {})
+    if config['MME_EXCLUDE_TEST_PATIENTS'] and not patient.is_test():
+        filters['test'] = False
+    return filters
+
+
 @app.route('/v1/match', methods=['POST'])
+@metrics.track_requests()
+@profiler.profile_requests()
 @consumes(API_MIME_TYPE, 'application/json')
 @produces(API_MIME_TYPE)
 @auth_token_required()
@@ -52,7 +68,8 @@ def match():
 
     try:
         logger.info("Validate request syntax")
-        validate_request(request_json)
+        with metrics.timed('validation'):
+            validate_request(request_json)
     except ValidationError as e:
         error = jsonify(message='Request does not conform to API specification',
                         request=request_json)
@@ -60,19 +77,32 @@ def match():
         return error
 
     logger.info("Parsing query")
-    request_obj = MatchRequest.from_api(request_json)
+    with metrics.timed('normalization'):
+        request_obj = MatchRequest.from_api(request_json)
 
     logger.info("Finding similar patients")
-    response_obj = request_obj.match(n=5)
+    with metrics.timed('search'):
+        response_obj = request_obj.match(n=5, engine=app.config['MME_MATCH_ENGINE'],
+                                         candidates=app.config['MME_RERANK_CANDIDATES'],
+                                         filters=get_match_filters(app.config, request_obj.patient))
 
     logger.info("Serializing response")
     response_json = response_obj.to_api()
 
-    try:
-        logger.info("Validating response syntax")
-        validate_response(response_json)
-    except ValidationError as e:
-        # log to console and return response anyway
-        logger.error('Response does not conform to API specification:\n{}\n\nResponse:\n{}'.format(e, response_json))
+    if random.random() < app.config['MME_VALIDATE_RESPONSE_RATE']:
+        try:
+            logger.info("Validating response syntax")
+            with metrics.timed('response_validation'):
+                validate_response(response_json)
+        except ValidationError as e:
+            # log to console and return response anyway
+            logger.error('Response does not conform to API specification:\n{}\n\nResponse:\n{}'.format(e, response_json))
+
+    with metrics.timed('serialization'):
+        return jsonify(response_json)
+
 
-    return jsonify(response_json)
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return the server metrics, in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,102 @@
+"""
+Default server settings.
+
+Override them with a Python file of the same variables, named by the
+MME_SERVER_SETTINGS environment variable.
+"""
+
+# The elasticsearch nodes to connect to (shared by all requests in a process)
+MME_ELASTICSEARCH_HOSTS = ['localhost:9200']
+
+# The maximum number of connections kept open to each elasticsearch node
+MME_ELASTICSEARCH_POOL_SIZE = 10
+
+# The elasticsearch request timeout, in seconds
+MME_ELASTICSEARCH_TIMEOUT = 10
+
+# Whether each process resolves vocabulary terms from an in-process copy of the
+# vocabularies index (loaded on first use), rather than with one query per patient
+MME_PRELOAD_TERMS = True
+
+# Where patients are stored: 'elasticsearch', or 'memory' (an in-process
+# inverted index in each server process, which is not persisted)
+MME_PATIENT_STORE = 'elasticsearch'
+
+# A patients file (JSON array or newline-delimited JSON) to load into the
+# 'memory' patient store of each server process
+MME_MEMORY_PATIENTS = None
+
+# How to score matches: 'elasticsearch' (the elasticsearch TF/IDF score),
+# 'similarity' (in-process semantic similarity; requires numpy), or 'rerank'
+# (semantic similarity of the best elasticsearch candidates; requires numpy)
+MME_MATCH_ENGINE = 'elasticsearch'
+
+# The number of elasticsearch candidates to rescore with the 'rerank' engine
+MME_RERANK_CANDIDATES = 500
+
+# Which phenotypes select the candidates of match queries: phenotypes annotated
+# on more than MME_MATCH_RESCORE_FRACTION of patients only rescore the
+# candidates selected by genes and rarer phenotypes (unless these select fewer
+# than MME_MATCH_MIN_CANDIDATES patients), and phenotypes annotated on more
+# than MME_MATCH_DROP_FRACTION of patients are dropped (None to disable). Indexes
+# of fewer than MME_MATCH_MIN_CANDIDATES patients match all terms alike
+MME_MATCH_RESCORE_FRACTION = 0.1
+MME_MATCH_DROP_FRACTION = 0.9
+MME_MATCH_MIN_CANDIDATES = 500
+
+# The number of match responses cached by each server process, and the seconds
+# they are kept (0 to disable). Cached matches are discarded as soon as
+# patients are indexed or deleted
+MME_MATCH_CACHE_SIZE = 1024
+MME_MATCH_CACHE_TTL = 300
+
+# The seconds each process caches the generation token of the patients, instead
+# of reading it for every match request: changes to the patients by other
+# processes reach the match cache (and similarity index) after at most this long
+MME_GENERATION_TTL = 1.0
+
+# Whether to exclude test patients from the matches of (non-test) match requests
+MME_EXCLUDE_TEST_PATIENTS = False
+
+# Filters applied to the patients matched to every match request, as a dict of
+# indexed field ('test', 'server' or 'institution') -> value or list of values,
+# e.g. {'server': ['local']} to only match patients indexed with --server local.
+# Filters restrict the matched patients without affecting their scores
+MME_MATCH_FILTERS = {}
+
+# The seconds to wait for each outgoing server to respond to a federated match
+# request, and for all servers to respond
+MME_FEDERATION_TIMEOUT = 10
+MME_FEDERATION_DEADLINE = 30
+
+# The maximum number of connections kept open to each outgoing server
+MME_FEDERATION_POOL_SIZE = 4
+
+# The number of threads running datastore requests for each process of the
+# asyncio (ASGI) server, which bounds its concurrent datastore requests
+MME_ASYNC_THREADS = 20
+
+# The compiled HPO snapshot written by `mme-server index hpo`, and memory-mapped
+# by server processes to load the ontology (None to disable)
+MME_ONTOLOGY_SNAPSHOT = 'hpo.snapshot'
+
+# A directory shared by the worker processes of a server, to which each writes
+# its metrics, so that /metrics reports all workers (a temporary directory is
+# used with --workers if None)
+MME_METRICS_DIR = None
+
+# Whether to profile match requests, by sampling the stack of each request
+# every MME_PROFILE_INTERVAL seconds, and writing the profiles of requests that
+# take longer than MME_PROFILE_THRESHOLD seconds (and of 1 in every
+# MME_PROFILE_EVERY requests, if not 0) to MME_PROFILE_DIR, which keeps the
+# latest MME_PROFILE_MAX_FILES profiles
+MME_PROFILE = False
+MME_PROFILE_INTERVAL = 0.005
+MME_PROFILE_THRESHOLD = 1.0
+MME_PROFILE_EVERY = 0
+MME_PROFILE_DIR = 'profiles'
+MME_PROFILE_MAX_FILES = 100
+
+# The fraction of responses to validate against the API schema (1 to validate
+# every response, 0 to skip validation)
+MME_VALIDATE_RESPONSE_RATE = 1.0
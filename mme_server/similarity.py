@@ -0,0 +1,176 @@
+"""
+Module providing ontology-aware (semantic) similarity scoring of patients.
+
+Patients are scored against a query by a best-match-average Resnik
+similarity, using information content derived from how often each HPO term
+is annotated (directly or by implication) across the stored patients.
+
+Requires numpy (pip install mme-server[similarity]).
+"""
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for similarity scoring (pip install mme-server[similarity])')
+
+
+def get_top(scores, n):
+    """Return the indices of the (at most) n highest, non-zero scores, best first"""
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > n:
+        candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+    return candidates[np.argsort(-scores[candidates], kind='mergesort')]
+
+
+class PatientProfiles:
+    """The phenotype and gene profiles of a set of patients, packed into arrays
+
+    Each profile is a (patient id, phenotypes, genes) tuple, where phenotypes
+    includes all implied terms (as stored in the patients index). Profile r
+    contributes one (rows[k] = r, terms[k] = term index) entry per phenotype,
+    and likewise for genes.
+
+    The entries are also kept grouped by term, so the rows annotated with term
+    i are term_rows[term_offsets[i]:term_offsets[i + 1]].
+    """
+    def __init__(self, ontology, profiles):
+        require_numpy()
+        self.ontology = ontology
+        self.ids = []
+        self._gene_index = {}
+
+        rows = array(str('i'))
+        terms = array(str('i'))
+        gene_rows = array(str('i'))
+        genes = array(str('i'))
+        for row, (id, profile_phenotypes, profile_genes) in enumerate(profiles):
+            self.ids.append(id)
+            indices = [ontology.get_index(term_id) for term_id in profile_phenotypes]
+            indices = [index for index in indices if index is not None]
+            terms.extend(indices)
+            rows.extend([row] * len(indices))
+
+            indices = [self._gene_index.setdefault(gene_id, len(self._gene_index)) for gene_id in profile_genes]
+            genes.extend(indices)
+            gene_rows.extend([row] * len(indices))
+
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.terms = np.asarray(terms, dtype=np.int32)
+        self.gene_rows = np.asarray(gene_rows, dtype=np.int32)
+        self.genes = np.asarray(genes, dtype=np.int32)
+
+        order = np.argsort(self.terms, kind='mergesort')
+        self.term_rows = self.rows[order]
+        self.term_offsets = np.zeros(len(ontology) + 1, dtype=np.int64)
+        np.cumsum(self.get_term_counts(), out=self.term_offsets[1:])
+
+    def get_rows(self, i):
+        """Return the rows of the profiles annotated with term i"""
+        return self.term_rows[self.term_offsets[i]:self.term_offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_term_counts(self):
+        """Return the number of profiles annotated with each ontology term"""
+        return np.bincount(self.terms, minlength=len(self.ontology))
+
+    def has_genes(self, gene_ids):
+        """Return a boolean array of whether each profile shares any of the given genes"""
+        indices = [self._gene_index[gene_id] for gene_id in gene_ids if gene_id in self._gene_index]
+        matched = np.zeros(len(self), dtype=bool)
+        if indices:
+            mask = np.isin(self.genes, indices)
+            matched[self.gene_rows[mask]] = True
+        return matched
+
+
+class ResnikScorer:
+    """Scores patient profiles by their Resnik similarity to a query
+
+    The information content (IC) of a term is -log(p), where p is the
+    (smoothed) fraction of patients annotated with the term. The similarity of
+    two terms is the IC of their most informative common ancestor (MICA).
+
+    Query terms are the most specific of the query phenotypes, and the score of
+    a profile is the average, over query terms, of the best match among the
+    profile's terms (query-to-patient best-match average). Since stored
+    profiles are closed under the ancestor relation, the best match for a
+    query term is simply its most informative ancestor in the profile. The sum
+    is normalized by the query's own IC, so scores are in [0, 1].
+
+    If the query has candidate genes, the phenotype score is averaged with
+    whether the patient shares any candidate gene.
+    """
+    def __init__(self, ontology, term_counts, n_patients):
+        require_numpy()
+        self.ontology = ontology
+        p = (np.asarray(term_counts, dtype=np.float64) + 1) / (n_patients + 1)
+        self.ic = -np.log(p)
+
+    @classmethod
+    def from_profiles(cls, ontology, profiles):
+        """Create a scorer with information content computed from the given PatientProfiles"""
+        return cls(ontology, profiles.get_term_counts(), len(profiles))
+
+    def get_query_terms(self, phenotypes):
+        """Return the indices of the most specific of the given terms"""
+        indices = set([self.ontology.get_index(id) for id in phenotypes])
+        indices.discard(None)
+        ancestors = set()
+        for i in indices:
+            # The closure is in topological order, so the term itself is last
+            ancestors.update(self.ontology.get_closure_indices(i)[:-1])
+        return sorted(indices - ancestors)
+
+    def score_phenotypes(self, phenotypes, profiles):
+        """Return an array of the phenotype similarity of each profile to the query phenotypes"""
+        scores = np.zeros(len(profiles))
+        query = self.get_query_terms(phenotypes)
+        if not query or not len(profiles):
+            return scores
+
+        best = np.empty(len(profiles))
+        total = 0
+        for i in query:
+            # Assign the IC of each ancestor to the profiles annotated with it,
+            # from least to most informative, leaving the IC of the MICA
+            best.fill(0)
+            closure = self.ontology.get_closure_indices(i)
+            for j in sorted(closure, key=lambda j: self.ic[j]):
+                if self.ic[j] > 0:
+                    best[profiles.get_rows(j)] = self.ic[j]
+            scores += best
+            total += self.ic[i]
+
+        if total > 0:
+            scores /= total
+        return scores
+
+    def score(self, phenotypes, genes, profiles):
+        """Return an array of the similarity of each profile to the query, in [0, 1]"""
+        scores = np.zeros(len(profiles))
+        n_components = 0
+        if phenotypes:
+            scores += self.score_phenotypes(phenotypes, profiles)
+            n_components += 1
+
+        if genes:
+            scores += profiles.has_genes(genes)
+            n_components += 1
+
+        if n_components:
+            scores /= n_components
+        return scores
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import unittest
 
@@ -8,6 +9,12 @@ from random import randint
 
 from elasticsearch import Elasticsearch
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mme_server.managers.stats import TermStats
 from mme_server.schemas import validate_request, validate_response, ValidationError
 
 EXAMPLE_REQUEST = {
@@ -152,6 +159,1061 @@ class DatastoreTests(TestCase):
         self.assertAlmostEqual(len(term['term_category']), 20, delta=5)
 
 
+class TermResolverTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.vocabularies.resolver import TermResolver
+        self.resolver = TermResolver([
+            {'id': 'ENSG00000151092', 'name': ['N-glycanase 1'], 'alt_id': ['NGLY1', 'PNG1']},
+            {'id': 'ENSG00000108883', 'name': ['elongation factor Tu GTP binding domain containing 2'], 'alt_id': ['EFTUD2', 'SNRP116', 'PNG1']},
+        ])
+
+    def test_resolve_id(self):
+        self.assertEqual(self.resolver.get_term('ENSG00000151092')['name'], ['N-glycanase 1'])
+
+    def test_resolve_alt_id(self):
+        self.assertEqual(self.resolver.get_term('NGLY1')['id'], 'ENSG00000151092')
+
+    def test_ambiguous_alt_id(self):
+        self.assertIsNone(self.resolver.get_term('PNG1'))
+        self.resolver.remove('ENSG00000108883')
+        self.assertEqual(self.resolver.get_term('PNG1')['id'], 'ENSG00000151092')
+
+    def test_replace_term(self):
+        self.resolver.add({'id': 'ENSG00000151092', 'name': ['N-glycanase 1'], 'alt_id': ['NGLY1']})
+        self.assertEqual(self.resolver.get_term('PNG1')['id'], 'ENSG00000108883')
+
+    def test_unknown_term(self):
+        self.assertIsNone(self.resolver.get_term('HP:0000252'))
+
+    def test_term_category(self):
+        self.resolver.update([
+            {'id': 'HP:0000001', 'name': ['All'], 'is_a': []},
+            {'id': 'HP:0000118', 'name': ['Phenotypic abnormality'], 'is_a': ['HP:0000001']},
+        ])
+        term = self.resolver.get_term('HP:0000118')
+        self.assertEqual(term['term_category'], ['HP:0000001', 'HP:0000118'])
+
+
+class TermLookupTests(TestCase):
+    def setUp(self):
+        from mme_server.server import app
+        from mme_server.backend import get_backend
+        self.context = app.app_context()
+        self.context.push()
+        self.vocabularies = get_backend().get_manager('vocabularies')
+        # Resolve terms with a single query per lookup, instead of the in-process resolver
+        self.vocabularies.PRELOAD_TERMS = False
+        self.vocabularies.search_terms = self.search_terms
+        self.queries = []
+        self.terms = [
+            {'id': 'HP:0000252', 'name': ['Microcephaly'], 'alt_id': ['HP:0001366'], 'term_category': ['HP:0000252']},
+            {'id': 'HP:0000522', 'name': ['Alacrima'], 'alt_id': [], 'term_category': ['HP:0000522']},
+            {'id': 'ENSG00000151092', 'name': ['N-glycanase 1'], 'alt_id': ['NGLY1', 'PNG1']},
+            {'id': 'ENSG00000108883', 'name': ['EFTUD2'], 'alt_id': ['EFTUD2', 'PNG1']},
+        ]
+
+    def tearDown(self):
+        del self.vocabularies.PRELOAD_TERMS
+        del self.vocabularies.search_terms
+        self.context.pop()
+
+    def search_terms(self, ids):
+        self.queries.append(sorted(ids))
+        return [term for term in self.terms if term['id'] in ids or set(term['alt_id']).intersection(ids)]
+
+    def test_single_query(self):
+        terms = self.vocabularies.get_terms(['HP:0001366', 'NGLY1', 'PNG1', 'HP:9999999'])
+        self.assertEqual(self.queries, [['HP:0001366', 'HP:9999999', 'NGLY1', 'PNG1']])
+        self.assertEqual(terms['HP:0001366']['id'], 'HP:0000252')
+        self.assertEqual(terms['NGLY1']['id'], 'ENSG00000151092')
+        # An alt_id shared by several terms is not resolved
+        self.assertNotIn('PNG1', terms)
+        self.assertNotIn('HP:9999999', terms)
+
+    def test_patient_single_lookup(self):
+        from mme_server.models import Patient
+        patient = Patient.from_api({
+            'id': '1',
+            'features': [{'id': 'HP:0001366'}, {'id': 'HP:0000522', 'observed': 'no'}],
+            'genomicFeatures': [{'gene': {'id': 'NGLY1'}}, {'gene': {'id': 'PNG1'}}],
+        })
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(self.queries[0], ['HP:0000522', 'HP:0001366', 'NGLY1', 'PNG1'])
+        self.assertEqual(patient.phenotypes, set(['HP:0000252']))
+        self.assertEqual(patient.genes, set(['ENSG00000151092', 'PNG1']))
+        self.assertEqual(patient.to_api()['features'][0]['label'], 'Microcephaly')
+
+
+class OntologyTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.vocabularies.ontology import Ontology
+        # A diamond below the root, with an extra leaf
+        self.ontology = Ontology.from_terms([
+            {'id': 'HP:4', 'is_a': ['HP:2', 'HP:3']},
+            {'id': 'HP:2', 'is_a': ['HP:1']},
+            {'id': 'HP:3', 'is_a': ['HP:1']},
+            {'id': 'HP:1', 'is_a': []},
+            {'id': 'HP:5', 'is_a': ['HP:3', 'HP:0']},
+        ])
+
+    def test_topological_order(self):
+        for id in self.ontology.ids:
+            for parent_id in self.ontology.get_parents(id):
+                self.assertLess(self.ontology.get_index(parent_id), self.ontology.get_index(id))
+
+    def test_ancestors(self):
+        self.assertEqual(set(self.ontology.get_ancestors('HP:4')), set(['HP:1', 'HP:2', 'HP:3', 'HP:4']))
+        # Unknown parents are ignored
+        self.assertEqual(set(self.ontology.get_ancestors('HP:5')), set(['HP:1', 'HP:3', 'HP:5']))
+
+    def test_cycle(self):
+        from mme_server.managers.vocabularies.ontology import Ontology
+        terms = [{'id': 'HP:1', 'is_a': ['HP:2']}, {'id': 'HP:2', 'is_a': ['HP:1']}]
+        self.assertRaises(ValueError, Ontology.from_terms, terms)
+
+
+class OBOParserTests(TestCase):
+    OBO = u"""format-version: 1.2
+remark: "header" ! comment
+
+[Term]
+id: HP:0000001
+name: All
+
+! A comment line
+[Term]
+id: HP:0000118
+name: Phenotypic abnormality ! comment
+def: "A \\"quoted\\" phenotype! \\t\\u00e9" [HPO:probinson]
+synonym: "Organ abnormality" EXACT []
+is_a: HP:0000001 ! All
+
+[Term]
+id: HP:0000002
+name: Obsolete term
+is_obsolete: true
+
+[Term]
+id: HP:0000252
+name: Microcephaly \\
+  with continuation
+alt_id: HP:0001366
+is_a: HP:0000118 ! Phenotypic abnormality
+is_a: HP:0000002
+"""
+
+    def setUp(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp(suffix='.obo')
+        with os.fdopen(fd, 'wb') as ofp:
+            ofp.write(self.OBO.encode('utf-8'))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_stanzas(self):
+        from mme_server.managers.vocabularies.parsers import OBOParser
+        stanzas = list(OBOParser(self.filename).stanzas())
+        self.assertEqual([name for name, tags in stanzas], ['Term'] * 4)
+        tags = stanzas[1][1]
+        self.assertEqual(tags['name'], ['Phenotypic abnormality'])
+        self.assertEqual(tags['def'], [u'A "quoted" phenotype! \t\u00e9'])
+        self.assertEqual(tags['synonym'], ['Organ abnormality'])
+        self.assertEqual(tags['is_a'], ['HP:0000001'])
+        self.assertEqual(stanzas[3][1]['name'], ['Microcephaly  with continuation'])
+
+    def test_matches_reference_parser(self):
+        from mme_server.managers.vocabularies.parsers import OBOParser, ReferenceOBOParser
+        self.assertEqual(list(OBOParser(self.filename).stanzas()),
+                         list(ReferenceOBOParser(self.filename).stanzas()))
+        terms = list(OBOParser(self.filename))
+        self.assertEqual(terms, list(ReferenceOBOParser(self.filename)))
+        self.assertEqual([term['id'] for term in terms], ['HP:0000001', 'HP:0000118', 'HP:0000252'])
+        self.assertEqual(terms[2]['term_category'], ['HP:0000001', 'HP:0000118', 'HP:0000252'])
+
+    @unittest.skipUnless(os.path.isfile('hp.obo'), 'hp.obo not downloaded')
+    def test_benchmark_hpo(self):
+        import time
+        from mme_server.managers.vocabularies.parsers import OBOParser, ReferenceOBOParser
+
+        def parse(Parser):
+            # Take the best of several runs, to reduce timing noise
+            times = []
+            for i in range(3):
+                start = time.time()
+                terms = list(Parser('hp.obo'))
+                times.append(time.time() - start)
+            return min(times), terms
+
+        fast_time, fast_terms = parse(OBOParser)
+        reference_time, reference_terms = parse(ReferenceOBOParser)
+        self.assertEqual(fast_terms, reference_terms)
+        self.assertGreaterEqual(reference_time / fast_time, 5)
+
+
+class ResolverGenerationTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.vocabularies import VocabularyManager
+        self.addCleanup(save_manager_state())
+        VocabularyManager.reset_resolver()
+        self.vocabularies = VocabularyManager(StubDatastore())
+        self.loads = 0
+
+        def load_resolver():
+            self.loads += 1
+            return 'resolver {}'.format(self.loads)
+        self.vocabularies.load_resolver = load_resolver
+
+    def tearDown(self):
+        from mme_server.managers.vocabularies import VocabularyManager
+        VocabularyManager.reset_resolver()
+        VocabularyManager.GENERATION_TTL = 1.0
+
+    def test_loaded_once(self):
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 1')
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 1')
+
+    def test_reloaded_when_indexed(self):
+        from mme_server.managers.vocabularies import VocabularyManager, GENERATION_DOC_TYPE
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 1')
+        # Changes by this process are seen at once
+        self.vocabularies.bump_generation()
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 2')
+        # Vocabularies indexed by another process
+        self.vocabularies.get_db().index(index=VocabularyManager.NAME, doc_type=GENERATION_DOC_TYPE,
+                                         id=VocabularyManager.GENERATION_ID, body={'token': 'other'})
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 2')
+        VocabularyManager.GENERATION_TTL = 0
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 3')
+        self.assertEqual(self.vocabularies.get_resolver(), 'resolver 3')
+
+
+class OntologySnapshotTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from mme_server.managers.vocabularies.snapshot import write_snapshot
+        self.addCleanup(save_manager_state())
+        self.terms = [
+            {'id': 'HP:0000001', 'name': ['All'], 'alt_id': [], 'is_a': []},
+            {'id': 'HP:0000118', 'name': ['Phenotypic abnormality'], 'alt_id': [], 'is_a': ['HP:0000001']},
+            {'id': 'HP:0000252', 'name': ['Microcephaly'], 'alt_id': ['HP:0001366', 'HP:0005484'], 'is_a': ['HP:0000118']},
+        ]
+        fd, self.filename = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        write_snapshot(self.filename, self.terms, 'checksum')
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_terms(self):
+        from mme_server.managers.vocabularies.snapshot import OntologySnapshot
+        snapshot = OntologySnapshot(self.filename)
+        self.assertEqual(snapshot.checksum, 'checksum')
+        self.assertEqual(list(snapshot.iter_terms()), self.terms)
+
+    def test_find(self):
+        from mme_server.managers.vocabularies.snapshot import OntologySnapshot, AMBIGUOUS, write_snapshot
+        snapshot = OntologySnapshot(self.filename)
+        self.assertEqual(len(snapshot), 3)
+        i = snapshot.find('HP:0005484')
+        self.assertEqual(snapshot.get_term(i), self.terms[2])
+        self.assertEqual(snapshot.find('HP:0000252'), i)
+        self.assertIsNone(snapshot.find('HP:0000002'))
+        self.assertIsNone(snapshot.find('HP:9999999'))
+
+        write_snapshot(self.filename, self.terms + [
+            {'id': 'HP:0000002', 'name': ['Two'], 'alt_id': ['HP:0001366'], 'is_a': ['HP:0000001']},
+        ], 'checksum')
+        snapshot = OntologySnapshot(self.filename)
+        self.assertEqual(snapshot.find('HP:0001366'), AMBIGUOUS)
+        self.assertEqual(snapshot.get_term(snapshot.find('HP:0000002'))['name'], ['Two'])
+
+    def test_resolver(self):
+        from mme_server.managers.vocabularies.snapshot import OntologySnapshot
+        from mme_server.managers.vocabularies.resolver import TermResolver
+        resolver = TermResolver([{'id': 'ENSG1', 'name': ['GENE1'], 'alt_id': ['GENE1']}],
+                                snapshot=OntologySnapshot(self.filename))
+        self.assertEqual(len(resolver), 4)
+        self.assertIn('HP:0001366', resolver)
+        self.assertEqual(resolver.get_term('HP:0001366')['term_category'],
+                         ['HP:0000001', 'HP:0000118', 'HP:0000252'])
+        self.assertEqual(resolver.get_term('GENE1')['id'], 'ENSG1')
+
+        # Added terms replace the snapshot terms
+        resolver.add({'id': 'HP:0000252', 'name': ['Small head'], 'alt_id': [], 'is_a': ['HP:0000001']})
+        self.assertIsNone(resolver.get_term('HP:0001366'))
+        self.assertEqual(resolver.get_term('HP:0000252')['term_category'], ['HP:0000001', 'HP:0000252'])
+        resolver.remove('HP:0000118')
+        self.assertIsNone(resolver.get_term('HP:0000118'))
+        self.assertEqual(sorted(resolver.get_ids()), ['ENSG1', 'HP:0000001', 'HP:0000252'])
+
+    def test_ontology(self):
+        from mme_server.managers.vocabularies.snapshot import OntologySnapshot
+        ontology = OntologySnapshot(self.filename).get_ontology()
+        self.assertEqual(ontology.get_ancestors('HP:0000252'), ['HP:0000001', 'HP:0000118', 'HP:0000252'])
+        self.assertEqual(ontology.get_parents('HP:0000118'), ['HP:0000001'])
+
+    def test_invalid_snapshot(self):
+        from mme_server.managers.vocabularies.snapshot import OntologySnapshot, read_checksum
+        with open(self.filename, 'wb') as ofp:
+            ofp.write(b'format-version: 1.2')
+        self.assertRaises(ValueError, OntologySnapshot, self.filename)
+        self.assertIsNone(read_checksum(self.filename))
+
+    def test_checksum_of_indexed_file(self):
+        from mme_server.managers.vocabularies import VocabularyManager, SNAPSHOT_DOC_TYPE
+        vocabularies = VocabularyManager(StubDatastore())
+        vocabularies.SNAPSHOT_FILENAME = self.filename
+        # Not loaded unless it is a snapshot of the indexed file
+        self.assertIsNone(vocabularies.load_snapshot())
+        vocabularies.save(id='hpo', doc={'checksum': 'other'}, doc_type=SNAPSHOT_DOC_TYPE)
+        self.assertIsNone(vocabularies.load_snapshot())
+        vocabularies.save(id='hpo', doc={'checksum': 'checksum'}, doc_type=SNAPSHOT_DOC_TYPE)
+        self.assertEqual(vocabularies.load_snapshot().checksum, 'checksum')
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ResnikScorerTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.vocabularies.ontology import Ontology
+        from mme_server.similarity import PatientProfiles, ResnikScorer
+        self.ontology = Ontology.from_terms([
+            {'id': 'HP:1', 'is_a': []},
+            {'id': 'HP:2', 'is_a': ['HP:1']},
+            {'id': 'HP:3', 'is_a': ['HP:1']},
+            {'id': 'HP:4', 'is_a': ['HP:2']},
+            {'id': 'HP:5', 'is_a': ['HP:2']},
+        ])
+        closure = self.get_closure
+        self.profiles = PatientProfiles(self.ontology, [
+            ('P1', closure(['HP:4']), ['ENSG1']),
+            ('P2', closure(['HP:5']), []),
+            ('P3', closure(['HP:3']), ['ENSG2']),
+        ])
+        self.scorer = ResnikScorer.from_profiles(self.ontology, self.profiles)
+
+    def get_closure(self, ids):
+        return set([ancestor for id in ids for ancestor in self.ontology.get_ancestors(id)])
+
+    def test_query_terms(self):
+        query = self.scorer.get_query_terms(self.get_closure(['HP:4', 'HP:3']))
+        self.assertEqual(set([self.ontology.ids[i] for i in query]), set(['HP:3', 'HP:4']))
+
+    def test_score_phenotypes(self):
+        from mme_server.similarity import get_top
+        scores = self.scorer.score(self.get_closure(['HP:4']), [], self.profiles)
+        self.assertAlmostEqual(scores[0], 1)
+        # Shares only HP:2 with the query
+        self.assertTrue(0 < scores[1] < scores[0])
+        # Shares only the root with the query
+        self.assertEqual(scores[2], 0)
+        self.assertEqual(list(get_top(scores, 5)), [0, 1])
+
+    def test_score_genes(self):
+        from mme_server.similarity import get_top
+        scores = self.scorer.score(self.get_closure(['HP:3']), ['ENSG2'], self.profiles)
+        self.assertEqual(list(get_top(scores, 1)), [2])
+        self.assertAlmostEqual(scores[2], 1)
+        # Shares the gene, but not the phenotype
+        scores = self.scorer.score(self.get_closure(['HP:3']), ['ENSG1'], self.profiles)
+        self.assertAlmostEqual(scores[0], 0.5)
+
+
+class LRUCacheTests(TestCase):
+    def setUp(self):
+        from mme_server.cache import LRUCache
+        self.cache = LRUCache(maxsize=2)
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_expiry(self):
+        self.cache.set('a', 1, ttl=0)
+        self.assertEqual(self.cache.get('a', 'missing'), 'missing')
+
+    def test_cached_none(self):
+        self.cache.set('a', None)
+        self.assertIsNone(self.cache.get('a', 'missing'))
+
+
+def save_manager_state():
+    """Return a function restoring the class attributes that managers share across the process
+
+    Tests with a StubDatastore change them (for instance, the indices known to
+    exist), which would otherwise leak into later tests.
+    """
+    from mme_server.managers.base import BaseManager
+    from mme_server.managers.memory import MemoryPatientManager
+    from mme_server.managers.patients import PatientManager
+    from mme_server.managers.vocabularies import VocabularyManager
+    saved = [
+        (BaseManager, '_existing_indices', set(BaseManager._existing_indices)),
+        (MemoryPatientManager, '_generation', MemoryPatientManager._generation),
+        (VocabularyManager, 'GENERATION_TTL', VocabularyManager.GENERATION_TTL),
+        (VocabularyManager, '_current_generation', VocabularyManager._current_generation),
+    ]
+    for name in ['_mappings_updated', 'RESCORE_FRACTION', 'DROP_FRACTION', 'MIN_CANDIDATES',
+                 '_match_cache', 'GENERATION_TTL', '_current_generation', '_stats']:
+        saved.append((PatientManager, name, getattr(PatientManager, name)))
+
+    def restore():
+        for cls, name, value in saved:
+            setattr(cls, name, value)
+    return restore
+
+
+class StubDatastore:
+    """A datastore client storing documents in a dict, for managers that only index and get documents"""
+    class Indices:
+        def __init__(self):
+            self.mappings = {}
+            self.settings = {'refresh_interval': '1s', 'number_of_replicas': '1'}
+
+        def exists(self, index):
+            return True
+
+        def put_mapping(self, index, doc_type, body):
+            self.mappings[(index, doc_type)] = body
+
+        def get_settings(self, index):
+            return {index: {'settings': {'index': dict(self.settings)}}}
+
+        def put_settings(self, index, body):
+            self.settings.update(body['index'])
+
+        def refresh(self, index):
+            pass
+
+        def delete(self, index):
+            pass
+
+    def __init__(self):
+        self.indices = self.Indices()
+        self.docs = {}
+        self.versions = {}
+
+    def index(self, index, doc_type, id, body, version=None):
+        from elasticsearch import ConflictError
+        key = (index, doc_type, id)
+        if version is not None and version != self.versions.get(key):
+            raise ConflictError(409, 'version conflict')
+        self.docs[key] = json.loads(json.dumps(body))
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, index, doc_type, id):
+        from elasticsearch import NotFoundError
+        if (index, doc_type, id) not in self.docs:
+            raise NotFoundError(404, 'not found')
+        return {'_id': id, '_source': self.docs[(index, doc_type, id)], '_version': self.versions[(index, doc_type, id)]}
+
+    def mget(self, index, doc_type, body, _source_include=None):
+        docs = []
+        for id in body['ids']:
+            source = self.docs.get((index, doc_type, id))
+            if source is None:
+                docs.append({'_id': id, 'found': False})
+            else:
+                docs.append({'_id': id, 'found': True, '_source': source,
+                             '_version': self.versions[(index, doc_type, id)]})
+        return {'docs': docs}
+
+    def bulk(self, body, index, doc_type=None, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        while lines:
+            action, meta = lines.pop(0).popitem()
+            key = (meta.get('_index', index), meta.get('_type', doc_type), meta['_id'])
+            if action == 'delete':
+                self.docs.pop(key, None)
+            else:
+                self.docs[key] = lines.pop(0)
+                self.versions[key] = self.versions.get(key, 0) + 1
+            items.append({action: {'_id': key[2], 'status': 200}})
+        return {'errors': False, 'items': items}
+
+    def delete(self, index, doc_type, id):
+        from elasticsearch import NotFoundError
+        if self.docs.pop((index, doc_type, id), None) is None:
+            raise NotFoundError(404, 'not found')
+
+
+class BulkIndexingTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.patients import PatientManager
+        self.addCleanup(save_manager_state())
+        self.patients = PatientManager(StubDatastore())
+        self.settings = self.patients.get_db().indices.settings
+
+    def test_disables_refreshes_and_replicas(self):
+        with self.patients.bulk_indexing():
+            self.assertEqual(self.settings, {'refresh_interval': '-1', 'number_of_replicas': 0})
+        self.assertEqual(self.settings, {'refresh_interval': '1s', 'number_of_replicas': '1'})
+
+    def test_keeps_replicas(self):
+        with self.patients.bulk_indexing(replicas=True):
+            self.assertEqual(self.settings, {'refresh_interval': '-1', 'number_of_replicas': '1'})
+        self.assertEqual(self.settings, {'refresh_interval': '1s', 'number_of_replicas': '1'})
+
+
+class MatchCacheTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.patients import PatientManager
+        self.addCleanup(save_manager_state())
+        PatientManager.configure_match_cache(maxsize=10, ttl=60)
+        self.patients = PatientManager(StubDatastore())
+        # Another process sharing the datastore
+        self.other_patients = PatientManager(self.patients.get_db())
+
+    def tearDown(self):
+        from mme_server.managers.patients import PatientManager
+        PatientManager.configure_match_cache()
+
+    def test_key_is_canonical(self):
+        key = self.patients.get_match_cache_key(['HP:1', 'HP:2'], ['ENSG1'], 5, engine='elasticsearch')
+        self.assertEqual(key, self.patients.get_match_cache_key(set(['HP:2', 'HP:1']), set(['ENSG1']), 5,
+                                                                engine='elasticsearch'))
+        self.assertNotEqual(key, self.patients.get_match_cache_key(['HP:1', 'HP:2'], ['ENSG1'], 10,
+                                                                   engine='elasticsearch'))
+        self.assertNotEqual(key, self.patients.get_match_cache_key(['HP:1'], ['ENSG1'], 5, engine='elasticsearch'))
+
+    def test_cached_match(self):
+        key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        self.assertIsNone(self.patients.get_cached_match(key))
+        self.patients.set_cached_match(key, 'response')
+        self.assertEqual(self.patients.get_cached_match(key), 'response')
+
+    def test_generation_invalidates(self):
+        key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        self.patients.set_cached_match(key, 'response')
+        # Patients changed by this process change the key at once
+        self.other_patients.bump_generation()
+        new_key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        self.assertNotEqual(key, new_key)
+        self.assertIsNone(self.patients.get_cached_match(new_key))
+
+    def test_generation_cached(self):
+        from mme_server.managers.patients import PatientManager
+        key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        # Patients changed by another process change the key once the generation is read again
+        self.patients.get_db().index(index=PatientManager.NAME, doc_type=PatientManager.GENERATION_DOC_TYPE,
+                                     id=PatientManager.GENERATION_ID, body={'token': 'other'})
+        self.assertEqual(self.patients.get_match_cache_key(['HP:1'], [], 5), key)
+        PatientManager.GENERATION_TTL = 0
+        self.assertNotEqual(self.patients.get_match_cache_key(['HP:1'], [], 5), key)
+
+    def test_disabled(self):
+        from mme_server.managers.patients import PatientManager
+        PatientManager.configure_match_cache(maxsize=0)
+        key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        self.assertIsNone(key)
+        self.patients.set_cached_match(key, 'response')
+        self.assertIsNone(self.patients.get_cached_match(key))
+
+    def test_delete_index(self):
+        from mme_server.managers.patients import PatientManager
+        key = self.patients.get_match_cache_key(['HP:1'], [], 5)
+        self.patients.set_cached_match(key, 'response')
+        self.patients.delete_index()
+        self.assertIsNone(self.patients.get_cached_match(key))
+        self.assertNotEqual(self.patients.get_match_cache_key(['HP:1'], [], 5), key)
+        # Also with the cache disabled
+        PatientManager.configure_match_cache(maxsize=0)
+        self.patients.delete_index()
+
+
+class ServerVerifyTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.servers import ServerManager
+        self.addCleanup(save_manager_state())
+        self.servers = ServerManager(StubDatastore())
+        self.lookups = []
+        self.clients = {}
+
+        def find_client(digest):
+            self.lookups.append(digest)
+            return self.clients.get(digest)
+        self.servers.find_client = find_client
+
+    def tearDown(self):
+        from mme_server.managers.servers import ServerManager
+        ServerManager._verified.clear()
+        ServerManager._current_version = None
+        ServerManager.VERSION_TTL = 1.0
+
+    def test_cached(self):
+        from mme_server.managers.servers import hash_key
+        self.clients[hash_key('key')] = 'client'
+        self.assertEqual(self.servers.verify('key'), 'client')
+        self.assertEqual(self.servers.verify('key'), 'client')
+        self.assertEqual(len(self.lookups), 1)
+        self.assertIsNone(self.servers.verify(''))
+
+    def test_version_invalidates(self):
+        from mme_server.managers.servers import ServerManager, hash_key
+        self.clients[hash_key('key')] = 'client'
+        self.assertEqual(self.servers.verify('key'), 'client')
+        # The client is removed by another process, which saves a new version
+        del self.clients[hash_key('key')]
+        self.servers.get_db().index(index=ServerManager.NAME, doc_type=ServerManager.VERSION_DOC_TYPE,
+                                    id=ServerManager.VERSION_ID, body={'token': 'other'})
+        self.assertEqual(self.servers.verify('key'), 'client')
+        ServerManager.VERSION_TTL = 0
+        self.assertIsNone(self.servers.verify('key'))
+
+    def test_bump_version(self):
+        self.assertIsNone(self.servers.verify('key'))
+        self.servers.bump_version()
+        self.assertIsNone(self.servers.verify('key'))
+        self.assertEqual(len(self.lookups), 2)
+
+
+class TermStatsTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.patients import PatientManager
+        self.addCleanup(save_manager_state())
+        self.patients = PatientManager(StubDatastore())
+        self.patients.save_term_stats(TermStats())
+        self.index('a', ['HP:1', 'HP:2'], ['ENSG1'])
+        self.index('b', ['HP:1'], [])
+
+    def tearDown(self):
+        from mme_server.managers.patients import PatientManager
+        PatientManager.reset_similarity()
+
+    def index(self, id, phenotypes, genes):
+        from mme_server.models import Patient
+        self.patients.index_patient(Patient({'id': id}, phenotypes, genes))
+
+    def test_counts(self):
+        stats = self.patients.get_term_stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats.get_count('phenotype', 'HP:1'), 2)
+        self.assertEqual(stats.get_count('gene', 'ENSG1'), 1)
+        self.assertEqual(stats.get_count('gene', 'ENSG2'), 0)
+        self.assertEqual(stats.get_most_common('phenotype', 1), [('HP:1', 2)])
+        self.assertEqual(stats.get_least_common('phenotype'), [('HP:2', 1), ('HP:1', 2)])
+
+    def test_replace_and_delete(self):
+        self.index('a', ['HP:3'], [])
+        stats = self.patients.get_term_stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats.counts, {'phenotype': {'HP:1': 1, 'HP:3': 1}, 'gene': {}})
+        self.patients.delete('b')
+        self.assertEqual(self.patients.get_term_stats().to_dict(),
+                         {'patients': 1, 'counts': {'phenotype': {'HP:3': 1}, 'gene': {}}})
+
+    def test_changed_by_other_process(self):
+        from mme_server.managers.patients import PatientManager
+        # Another process sharing the datastore
+        other_patients = PatientManager(self.patients.get_db())
+        changes = TermStats()
+        changes.add({'phenotype': ['HP:2'], 'gene': []})
+        other_patients.update_term_stats(changes)
+        self.assertEqual(self.patients.get_stored_term_stats().get_count('phenotype', 'HP:2'), 2)
+
+    def test_split_into_buckets(self):
+        from mme_server.managers.patients import PatientManager
+        db = self.patients.get_db()
+        docs = [db.docs[(PatientManager.NAME, PatientManager.STATS_DOC_TYPE, id)]
+                for id in self.patients.get_stats_ids()]
+        self.assertEqual(len(docs), PatientManager.STATS_BUCKETS)
+        self.assertEqual(sum(doc['patients'] for doc in docs), 2)
+        self.assertEqual(sum(len(doc['counts'].get('phenotype', {})) for doc in docs), 2)
+
+        # Only the documents of the changed terms are rewritten
+        versions = dict(db.versions)
+        self.index('c', ['HP:1'], [])
+        changed = [key for key in versions if db.versions[key] != versions[key]]
+        self.assertEqual(len([doc_type for index, doc_type, id in changed
+                              if doc_type == PatientManager.STATS_DOC_TYPE]), 1)
+
+    def test_duplicate_ids_counted_once(self):
+        from mme_server.managers import patients
+        from mme_server.managers.vocabularies import VocabularyManager
+        from mme_server.managers.vocabularies.resolver import TermResolver
+        normalize_record = patients.normalize_record
+        # Records are already index documents, so vocabularies are not needed
+        patients.normalize_record = lambda record: (record['id'], record['doc'])
+        VocabularyManager.reset_resolver()
+        VocabularyManager._resolver = TermResolver()
+        try:
+            records = [{'id': 'c', 'doc': {'phenotype': ['HP:{}'.format(i)], 'gene': []}} for i in range(3, 6)]
+            self.patients.index_records(records, processes=1)
+        finally:
+            patients.normalize_record = normalize_record
+            VocabularyManager.reset_resolver()
+        stats = self.patients.get_term_stats()
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(stats.counts['phenotype'], {'HP:1': 2, 'HP:2': 1, 'HP:5': 1})
+
+    def test_put_mappings(self):
+        from elasticsearch import RequestError
+        from mme_server.managers.patients import PatientManager
+        db = self.patients.get_db()
+        self.patients.put_mappings()
+        self.assertEqual(sorted(doc_type for index, doc_type in db.indices.mappings),
+                         ['generation', 'patient', 'stats'])
+        self.assertEqual(db.indices.mappings[(PatientManager.NAME, 'patient')]['properties']['institution'],
+                         {'type': 'string', 'index': 'not_analyzed'})
+
+        def put_mapping(index, doc_type, body):
+            raise RequestError(400, 'illegal_argument_exception')
+        db.indices.put_mapping = put_mapping
+        self.assertRaises(Exception, self.patients.put_mappings, ['patient'])
+
+    def test_mappings_updated_before_indexing(self):
+        from mme_server.models import Patient
+        from mme_server.managers.patients import PatientManager
+        db = StubDatastore()
+        patients = PatientManager(db)
+        PatientManager._mappings_updated = False
+        patients.index_patient(Patient({'id': 'c'}, ['HP:1'], []))
+        self.assertIn((PatientManager.NAME, 'patient'), db.indices.mappings)
+        # Only once per process
+        db.indices.mappings.clear()
+        patients.index_patient(Patient({'id': 'c'}, ['HP:1'], []))
+        self.assertEqual(db.indices.mappings, {})
+
+    def test_generation_refreshes(self):
+        from mme_server.managers.patients import PatientManager
+        PatientManager.configure_match_cache(generation_ttl=0)
+        try:
+            self.assertEqual(self.patients.get_term_stats().get_count('phenotype', 'HP:3'), 0)
+            # Patients indexed by another process, which saves the stats and a new generation
+            db = self.patients.get_db()
+            changes = TermStats()
+            changes.add({'phenotype': ['HP:3'], 'gene': []})
+            PatientManager(db).update_term_stats(changes)
+            db.index(index=PatientManager.NAME, doc_type=PatientManager.GENERATION_DOC_TYPE,
+                     id=PatientManager.GENERATION_ID, body={'token': 'other'})
+            self.assertEqual(self.patients.get_term_stats().get_count('phenotype', 'HP:3'), 1)
+        finally:
+            PatientManager.configure_match_cache()
+
+
+class JSONRecordReaderTests(TestCase):
+    def setUp(self):
+        self.records = [{'id': 'P{}'.format(i), 'features': [{'id': 'HP:0000252'}]} for i in range(10)]
+
+    def read(self, text, chunk_size):
+        from io import StringIO
+        from mme_server.managers.readers import iter_json_records
+        return list(iter_json_records(StringIO(text), chunk_size=chunk_size))
+
+    def test_json_array(self):
+        text = json.dumps(self.records, indent=2)
+        for chunk_size in [1, 7, 1 << 16]:
+            self.assertEqual(self.read(text, chunk_size), self.records)
+
+    def test_ndjson(self):
+        text = '\n'.join([json.dumps(record) for record in self.records]) + '\n'
+        for chunk_size in [1, 7, 1 << 16]:
+            self.assertEqual(self.read(text, chunk_size), self.records)
+
+    def test_truncated_array(self):
+        text = json.dumps(self.records)[:-1]
+        self.assertRaises(ValueError, self.read, text, 7)
+
+    def test_trailing_comma(self):
+        text = json.dumps(self.records)[:-1] + ',]'
+        for chunk_size in [1, 7, 1 << 16]:
+            self.assertRaises(ValueError, self.read, text, chunk_size)
+        self.assertEqual(self.read('[]', 7), [])
+
+    def test_trailing_text(self):
+        text = json.dumps(self.records) + '\n{"id": "P10"}'
+        for chunk_size in [1, 7, 1 << 16]:
+            self.assertRaises(ValueError, self.read, text, chunk_size)
+        self.assertEqual(self.read(json.dumps(self.records) + '\n\n', 7), self.records)
+
+    def test_malformed_record_fails_early(self):
+        from io import StringIO
+        from mme_server.managers.readers import iter_json_records
+        for records in [self.records * 100, [self.records[0]]]:
+            for text in ['{"id": "P", "features": }\n' + '\n'.join([json.dumps(record) for record in records]),
+                         '[{"id": "P", "features": [}],' + json.dumps(records)[1:]]:
+                ifp = StringIO(text)
+                self.assertRaises(ValueError, list, iter_json_records(ifp, chunk_size=64))
+                if len(records) > 1:
+                    self.assertLess(ifp.tell(), len(text) // 2)
+
+
+class PatientStoreTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.memory import PatientStore
+        self.store = PatientStore()
+        self.store.save('a', {'phenotype': ['HP:1', 'HP:2'], 'gene': ['ENSG1']})
+        self.store.save('b', {'phenotype': ['HP:1', 'HP:3'], 'gene': []})
+        self.store.save('c', {'phenotype': ['HP:1'], 'gene': []})
+
+    def match_ids(self, clauses, n=10):
+        return [id for id, doc, score in self.store.match(clauses, n=n)]
+
+    def test_counts(self):
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.get_count('phenotype', 'HP:1'), 3)
+        self.assertEqual(self.store.get_count('gene', 'ENSG1'), 1)
+        self.assertEqual(self.store.get_count('gene', 'ENSG2'), 0)
+
+    def test_match(self):
+        self.assertEqual(self.match_ids([('phenotype', 'HP:1'), ('phenotype', 'HP:3')]), ['b', 'a', 'c'])
+        self.assertEqual(self.match_ids([('gene', 'ENSG1'), ('phenotype', 'HP:3')]), ['a', 'b'])
+        self.assertEqual(self.match_ids([('phenotype', 'HP:1')], n=2), ['a', 'b'])
+        self.assertEqual(self.match_ids([('phenotype', 'HP:4')]), [])
+
+    def test_match_empty(self):
+        from mme_server.managers.memory import PatientStore
+        self.assertEqual(PatientStore().match([('phenotype', 'HP:1')]), [])
+
+    def test_match_python(self):
+        # Scores do not depend on numpy
+        from mme_server.managers import memory
+        clauses = [('phenotype', 'HP:1'), ('phenotype', 'HP:2'), ('gene', 'ENSG1')]
+        expected = self.store.match(clauses)
+        np, memory.np = memory.np, None
+        try:
+            matches = self.store.match(clauses)
+        finally:
+            memory.np = np
+        self.assertEqual([id for id, doc, score in matches], [id for id, doc, score in expected])
+        for (id, doc, score), (_, _, expected_score) in zip(matches, expected):
+            self.assertAlmostEqual(score, expected_score)
+
+    def test_match_filters(self):
+        from mme_server.managers import memory
+        self.store.save('d', {'phenotype': ['HP:1'], 'gene': [], 'test': True, 'server': 'peer'})
+        np = memory.np
+        for module_np in [np, None]:
+            memory.np = module_np
+            try:
+                self.assertEqual(self.match_ids([('phenotype', 'HP:1')]), ['a', 'b', 'c', 'd'])
+                self.assertEqual([id for id, doc, score in self.store.match([('phenotype', 'HP:1')], filters=[('test', [True])])], ['d'])
+                self.assertEqual([id for id, doc, score in self.store.match([('phenotype', 'HP:3')], filters=[('server', ['peer', 'other'])])], [])
+            finally:
+                memory.np = np
+
+    def test_match_rescore(self):
+        from mme_server.managers import memory
+        # As bool(must=[bool(should=[HP:2, HP:3])], should=[HP:1]), with scores independent of numpy
+        np = memory.np
+        matches = []
+        for module_np in [np, None]:
+            memory.np = module_np
+            try:
+                matches.append(self.store.match([('phenotype', 'HP:2'), ('phenotype', 'HP:3')],
+                                                rescore=[('phenotype', 'HP:1')]))
+            finally:
+                memory.np = np
+        for rescored in matches:
+            self.assertEqual([id for id, doc, score in rescored], ['a', 'b'])
+            self.assertAlmostEqual(rescored[0][2], rescored[1][2])
+        self.assertAlmostEqual(matches[0][0][2], matches[1][0][2])
+
+    def test_replace_and_delete(self):
+        self.store.save('b', {'phenotype': ['HP:2'], 'gene': []})
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.get_count('phenotype', 'HP:3'), 0)
+        self.assertEqual(self.match_ids([('phenotype', 'HP:3')]), [])
+        self.assertTrue(self.store.delete('a'))
+        self.assertFalse(self.store.delete('a'))
+        self.assertEqual(self.match_ids([('phenotype', 'HP:2')]), ['b'])
+        self.assertEqual(sorted([id for id, doc in self.store.scan()]), ['b', 'c'])
+
+    def test_compact(self):
+        self.store._compact()
+        self.assertEqual(self.match_ids([('phenotype', 'HP:3')]), ['b'])
+        self.assertEqual(self.store.get_count('phenotype', 'HP:1'), 3)
+
+
+class MemoryPatientManagerTests(TestCase):
+    def setUp(self):
+        from mme_server.managers.memory import MemoryPatientManager
+        from mme_server.models import Patient
+        self.addCleanup(save_manager_state())
+        MemoryPatientManager._store.clear()
+        self.patients = MemoryPatientManager(None)
+        self.patients.index_patient(Patient({'id': 'a'}, ['HP:1', 'HP:2'], ['ENSG1']))
+        self.patients.index_patient(Patient({'id': 'b'}, ['HP:1'], []))
+
+    def tearDown(self):
+        from mme_server.managers.memory import MemoryPatientManager
+        MemoryPatientManager._store.clear()
+
+    def test_match(self):
+        from mme_server.models import MatchResult
+        hits = self.patients.match(['HP:2'], ['ENSG1'], n=5)
+        self.assertEqual([hit.meta.id for hit in hits], ['a'])
+        result = MatchResult.from_index(hits[0])
+        self.assertEqual(result.patient.genes, set(['ENSG1']))
+        self.assertTrue(0 < result.score < 1)
+
+    def test_filters(self):
+        from mme_server.models import Patient
+        patient = Patient({'id': 'c', 'test': True, 'contact': {'institution': 'Institution'}}, ['HP:2'], [])
+        self.patients.index_patient(patient, server='peer')
+        # Query all terms alike
+        self.patients.configure_match_query(None, None)
+        unfiltered = self.patients.match(['HP:1', 'HP:2'], [], n=5)
+        filtered = self.patients.match(['HP:1', 'HP:2'], [], n=5, filters={'test': False})
+        self.assertEqual([hit.meta.id for hit in filtered], ['a', 'b'])
+        # Filters do not change scores
+        scores = dict([(hit.meta.id, hit.meta.score) for hit in unfiltered])
+        for hit in filtered:
+            self.assertAlmostEqual(hit.meta.score, scores[hit.meta.id])
+
+        self.assertEqual([hit.meta.id for hit in self.patients.match(['HP:2'], [], filters={'server': 'peer'})], ['c'])
+        self.assertEqual(list(self.patients.iter_filtered_ids({'institution': ['Institution']})), ['c'])
+        self.assertRaises(ValueError, self.patients.match, ['HP:2'], [], filters={'label': 'c'})
+
+    def test_filter_query(self):
+        from mme_server.managers.patients import PatientManager
+        manager = PatientManager(None)
+        manager.get_term_stats = lambda: TermStats()
+        query = manager.get_match_query(['HP:1'], [], filters={'test': False}).to_dict()
+        # Patients without a test flag are not excluded
+        self.assertEqual(query['bool']['filter'], [{'bool': {'must_not': [{'term': {'test': True}}]}}])
+        self.assertEqual(query['bool']['minimum_should_match'], 1)
+        self.assertNotIn('filter', manager.get_match_query(['HP:1'], []).to_dict()['bool'])
+        query = manager.get_match_query(['HP:1'], [], filters={'test': True, 'server': 'peer'}).to_dict()
+        self.assertEqual(query['bool']['filter'], [{'terms': {'server': ['peer']}}, {'terms': {'test': [True]}}])
+        query = manager.get_match_query(['HP:1'], [], filters={'test': [True, False]}).to_dict()
+        self.assertNotIn('filter', query['bool'])
+
+    def test_no_elasticsearch_search(self):
+        self.assertRaises(ValueError, self.patients.search)
+        # Methods that search elasticsearch are overridden
+        self.assertEqual(len(self.patients.count_term_stats()), 2)
+        self.assertEqual(sorted(id for id, phenotypes, genes in self.patients.iter_profiles()), ['a', 'b'])
+        self.assertEqual(sorted(self.patients.iter_filtered_ids({})), ['a', 'b'])
+        self.assertEqual(len(self.patients.get_candidate_profiles(['HP:1'], [], 5)), 2)
+
+    def test_small_index_ranking(self):
+        from mme_server.models import Patient
+        self.patients.index_patient(Patient({'id': 'c'}, ['HP:1', 'HP:3'], []))
+        # HP:1 is annotated on every patient, but the index is smaller than MIN_CANDIDATES
+        self.patients.configure_match_query()
+        ranked = self.patients.match(['HP:1', 'HP:3'], [], n=5)
+        self.assertEqual(self.patients.get_query_tiers(['HP:1', 'HP:3'], []),
+                         ([('phenotype', 'HP:1'), ('phenotype', 'HP:3')], []))
+        self.patients.configure_match_query(None, None)
+        expected = self.patients.match(['HP:1', 'HP:3'], [], n=5)
+        self.assertEqual([hit.meta.id for hit in ranked], [hit.meta.id for hit in expected])
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual(ranked[0].meta.id, 'c')
+
+    def test_filter_missing_test_flag(self):
+        # As indexed by older versions
+        from mme_server.managers.memory import MemoryPatientManager
+        MemoryPatientManager._store.save('d', {'phenotype': ['HP:2'], 'gene': []})
+        self.patients.configure_match_query(None, None)
+        self.assertIn('d', [hit.meta.id for hit in self.patients.match(['HP:2'], [], filters={'test': False})])
+        self.assertIn('d', list(self.patients.iter_filtered_ids({'test': False})))
+        self.assertNotIn('d', list(self.patients.iter_filtered_ids({'test': True})))
+
+    def test_query_tiers(self):
+        from mme_server.managers.patients import PatientManager
+        manager = PatientManager(None)
+        manager.get_term_stats = lambda: TermStats({'phenotype': {'HP:0': 1000, 'HP:1': 950, 'HP:2': 200, 'HP:3': 5},
+                                                    'gene': {'ENSG1': 3}}, 1000)
+        manager.configure_match_query(0.1, 0.9, min_candidates=0)
+        select, rescore = manager.get_query_tiers(['HP:0', 'HP:1', 'HP:2', 'HP:3'], ['ENSG1'])
+        self.assertEqual(select, [('gene', 'ENSG1'), ('phenotype', 'HP:3')])
+        self.assertEqual(rescore, [('phenotype', 'HP:2')])
+        query = manager.get_match_query(['HP:0', 'HP:1', 'HP:2', 'HP:3'], ['ENSG1']).to_dict()
+        self.assertEqual(len(query['bool']['must'][0]['bool']['should']), 2)
+        self.assertEqual(query['bool']['should'], [{'match': {'phenotype': 'HP:2'}}])
+
+        # Common phenotypes select candidates if there are too few
+        manager.configure_match_query(0.1, 0.9, min_candidates=100)
+        self.assertEqual(manager.get_query_tiers(['HP:1', 'HP:2', 'HP:3'], ['ENSG1']),
+                         ([('gene', 'ENSG1'), ('phenotype', 'HP:3'), ('phenotype', 'HP:2')], []))
+        # Ubiquitous phenotypes are kept if there is nothing else to match
+        self.assertEqual(manager.get_query_tiers(['HP:0'], []), ([('phenotype', 'HP:0')], []))
+
+    def test_match_tiers(self):
+        from mme_server.models import Patient
+        for id in 'cdefgh':
+            self.patients.index_patient(Patient({'id': id}, ['HP:1'], []))
+        self.patients.configure_match_query(0.5, None, min_candidates=0)
+        # Only patients with the rare gene or phenotype are matched, and ranked by all terms
+        hits = self.patients.match(['HP:1', 'HP:2'], ['ENSG1'])
+        self.assertEqual([hit.meta.id for hit in hits], ['a'])
+        self.patients.configure_match_query(None, None)
+        self.assertEqual(len(self.patients.match(['HP:1', 'HP:2'], ['ENSG1'])), 8)
+
+    @unittest.skipIf(numpy is None, 'numpy is required for similarity scoring')
+    def test_similarity_index_generation(self):
+        from mme_server.managers.memory import MemoryPatientManager
+        from mme_server.managers.vocabularies import VocabularyManager
+        from mme_server.managers.vocabularies.resolver import TermResolver
+        # Vocabularies without a generation token
+        patients = MemoryPatientManager(StubDatastore())
+        VocabularyManager.reset_resolver()
+        VocabularyManager._resolver = TermResolver([
+            {'id': 'HP:1', 'name': ['One'], 'is_a': []},
+            {'id': 'HP:2', 'name': ['Two'], 'is_a': ['HP:1']},
+        ])
+        try:
+            profiles, scorer = patients.get_similarity_index()
+            self.assertEqual(sorted(profiles.ids), ['a', 'b'])
+            self.assertIs(patients.get_similarity_index()[0], profiles)
+            # Patients changed by another process (without resetting this process's index)
+            MemoryPatientManager._store.save('c', {'phenotype': ['HP:1', 'HP:2'], 'gene': []})
+            MemoryPatientManager._generation += 1
+            self.assertEqual(sorted(patients.get_similarity_index()[0].ids), ['a', 'b', 'c'])
+        finally:
+            VocabularyManager.reset_resolver()
+            MemoryPatientManager.reset_similarity()
+
+    def test_delete(self):
+        generation = self.patients.get_generation()
+        self.assertEqual(self.patients.count(), 2)
+        self.patients.delete('a')
+        self.assertNotEqual(self.patients.get_generation(), generation)
+        self.assertEqual(self.patients.count(), 1)
+        self.assertEqual([patient.get_id() for patient in self.patients.get_patients(['a', 'b'])], ['b'])
+
+
+class BenchTests(TestCase):
+    def setUp(self):
+        from mme_server.bench import CohortGenerator
+        from mme_server.managers.vocabularies.ontology import Ontology
+        ontology = Ontology.from_terms([
+            {'id': 'HP:0000001', 'is_a': []},
+            {'id': 'HP:0000118', 'is_a': ['HP:0000001']},
+            {'id': 'HP:0000002', 'is_a': ['HP:0000118']},
+            {'id': 'HP:0000003', 'is_a': ['HP:0000002']},
+            {'id': 'HP:0000004', 'is_a': ['HP:0000002']},
+            {'id': 'HP:0000005', 'is_a': ['HP:0000004']},
+        ])
+        self.generator = CohortGenerator(ontology, ['ENSG1', 'ENSG2'], diseases=5, min_features=1, max_features=3)
+
+    def test_patients(self):
+        patients = list(self.generator.iter_patients(20))
+        self.assertEqual(len(set([patient['id'] for patient in patients])), 20)
+        for patient in patients:
+            features = [feature['id'] for feature in patient['features']]
+            self.assertTrue(set(features) <= set(['HP:0000118', 'HP:0000002', 'HP:0000003', 'HP:0000004', 'HP:0000005']))
+            validate_request({'patient': patient})
+
+        # Patients are generated deterministically
+        self.assertEqual(self.generator.get_patient('bench-3'), patients[3])
+
+    def test_summarize(self):
+        from mme_server.bench import summarize
+        summary = summarize([float(i) for i in range(100, 0, -1)])
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['p50'], 50)
+        self.assertEqual(summary['p99'], 99)
+        self.assertEqual(summary['max'], 100)
+
+
 class MatchRequestTests(TestCase):
     def setUp(self):
         self.request = deepcopy(EXAMPLE_REQUEST)
@@ -217,6 +1279,26 @@ class FlaskTests(unittest.TestCase):
         from mme_server.cli import remove_server
         remove_server(self.test_server_id, 'in')
 
+    def test_unhashed_key_migrated(self):
+        from mme_server.server import app
+        from mme_server.backend import get_backend
+        from mme_server.managers.servers import ServerManager
+        with app.app_context():
+            servers = get_backend().get_manager('servers')
+            # A client authorized before keys were hashed
+            servers.save(id=self.test_server_id + '_old', doc_type=ServerManager.CLIENT_DOC_TYPE,
+                         doc={'server_id': self.test_server_id + '_old', 'server_label': 'old',
+                              'server_key': 'myunhashedauthtoken'})
+            servers.refresh()
+            ServerManager._migrated = False
+            try:
+                self.assertIsNotNone(servers.verify('myunhashedauthtoken'))
+                client = servers.get_db().get(index=ServerManager.NAME, doc_type=ServerManager.CLIENT_DOC_TYPE,
+                                              id=self.test_server_id + '_old')['_source']
+                self.assertNotIn('server_key', client)
+            finally:
+                servers.remove(self.test_server_id + '_old', 'in')
+
     def assertValidResponse(self, data):
         validate_response(data)
 
@@ -254,6 +1336,343 @@ class FlaskTests(unittest.TestCase):
         add_server(self.test_server_id, 'out', key='', base_url='https://example.com/')
 
 
+@unittest.skipIf(sys.version_info < (3, 5), 'the asyncio server requires Python 3.5+')
+class AsyncMatchTests(unittest.TestCase):
+    def setUp(self):
+        self.data = json.dumps(EXAMPLE_REQUEST)
+        self.headers = {
+            'Accept': 'application/vnd.ga4gh.matchmaker.v1.0+json',
+            'Content-Type': 'application/json',
+        }
+
+    def post(self, data, headers):
+        """Send a request to the ASGI application, returning the (status, headers, body) of the response"""
+        import asyncio
+        from mme_server.asgi import MatchApplication
+
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': '/v1/match',
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': data.encode('utf-8')}
+
+        async def send(message):
+            messages.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(MatchApplication()(scope, receive, send))
+        finally:
+            loop.close()
+
+        start, body = messages
+        return start['status'], dict(start['headers']), body['body']
+
+    def test_accept_header_required(self):
+        del self.headers['Accept']
+        status, headers, body = self.post(self.data, self.headers)
+        self.assertEqual(status, 406)
+
+    def test_content_type_required(self):
+        del self.headers['Content-Type']
+        status, headers, body = self.post(self.data, self.headers)
+        self.assertEqual(status, 415)
+
+    def test_match_request(self):
+        from mme_server.cli import add_server, remove_server
+        server_id = 'test_server_{}'.format(randint(0, 1000000))
+        add_server(server_id, 'in', key='mysecretauthtoken')
+        try:
+            self.headers['X-Auth-Token'] = 'mysecretauthtoken'
+            status, headers, body = self.post(self.data, self.headers)
+        finally:
+            remove_server(server_id, 'in')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/vnd.ga4gh.matchmaker.v1.0+json')
+        validate_response(json.loads(body.decode('utf-8')))
+
+
+class StubServer:
+    """A local Matchmaker Exchange server, returning a fixed response after a delay"""
+    def __init__(self, results, delay=0, status=200):
+        import threading
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        stub = self
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                import time
+                length = int(self.headers['Content-Length'])
+                stub.requests.append((self.path, dict(self.headers), json.loads(self.rfile.read(length).decode('utf-8'))))
+                time.sleep(delay)
+                body = json.dumps({'results': results}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/vnd.ga4gh.matchmaker.v1.0+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('localhost', 0), Handler)
+        self.base_url = 'http://localhost:{}/v1'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class PeerHealthTests(TestCase):
+    def setUp(self):
+        from mme_server.health import PeerHealth
+        self.health = PeerHealth(failure_threshold=3, reset_timeout=60, min_samples=10)
+
+    def test_circuit_breaker(self):
+        for i in range(3):
+            self.assertTrue(self.health.allow_request(now=0))
+            self.health.record(1, False, now=0)
+        self.assertEqual(self.health.state, 'open')
+        self.assertFalse(self.health.allow_request(now=30))
+
+        # A single trial request is allowed once the reset timeout passes
+        self.assertTrue(self.health.allow_request(now=60))
+        self.assertFalse(self.health.allow_request(now=61))
+        self.health.record(1, False, now=61)
+        self.assertEqual(self.health.state, 'open')
+
+        self.assertTrue(self.health.allow_request(now=121))
+        self.health.record(1, True, now=121)
+        self.assertEqual(self.health.state, 'closed')
+        self.assertTrue(self.health.allow_request(now=122))
+
+    def test_adaptive_timeout(self):
+        self.assertEqual(self.health.get_timeout(10), 10)
+        for i in range(99):
+            self.health.record(0.2, True)
+        self.health.record(0.4, True)
+        self.assertEqual(self.health.get_percentile(0.5), 0.25)
+        self.assertEqual(self.health.get_percentile(0.99), 0.25)
+        self.assertEqual(self.health.get_percentile(1), 0.5)
+        self.assertEqual(self.health.get_timeout(10), 1.0)
+
+    def test_serialization(self):
+        from mme_server.health import PeerHealth
+        self.health.record(0.2, True)
+        self.health.record(0.2, False)
+        self.assertEqual(PeerHealth.from_dict(self.health.to_dict()).to_dict(), self.health.to_dict())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from mme_server import metrics
+        self.directory = tempfile.mkdtemp()
+        self.counter = metrics.Counter('test_requests_total', 'Test requests', labels=['status'])
+        self.histogram = metrics.Histogram('test_seconds', 'Test latency', buckets=[0.1, 1.0])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_render_counter(self):
+        self.counter.inc(status=200)
+        self.counter.inc(2, status=200)
+        self.counter.inc(status=404)
+        lines = self.counter.render(self.counter.merge_states([self.counter.get_state()]))
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{status="200"} 3', lines)
+        self.assertIn('test_requests_total{status="404"} 1', lines)
+
+    def test_render_histogram(self):
+        for value in [0.05, 0.5, 0.5, 5.0]:
+            self.histogram.observe(value)
+        # Summed with the same observations from another process
+        state = self.histogram.get_state()
+        lines = self.histogram.render(self.histogram.merge_states([state, state]))
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 6', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 8', lines)
+        self.assertIn('test_seconds_count 8', lines)
+        self.assertIn('test_seconds_sum 12.1', lines)
+
+    def test_worker_metrics(self):
+        from mme_server import metrics
+        # Metrics written by another (running) worker process
+        state = {
+            'pid': os.getppid(),
+            'metrics': {
+                metrics.REQUESTS.name: [[['200'], 1000]],
+                metrics.IN_FLIGHT.name: [[[], 5]],
+            },
+        }
+        with open(os.path.join(self.directory, 'metrics-{}.json'.format(os.getppid())), 'w') as ofp:
+            json.dump(state, ofp)
+
+        directory, metrics.DIRECTORY = metrics.DIRECTORY, self.directory
+        try:
+            with metrics.tracked_request() as result:
+                result['status'] = 200
+            text = metrics.render()
+        finally:
+            metrics.DIRECTORY = directory
+
+        requests = 1000 + metrics.REQUESTS.get(status=200)
+        self.assertIn('mme_match_requests_total{{status="200"}} {}'.format(requests), text.splitlines())
+        self.assertIn('mme_match_requests_in_flight 5', text.splitlines())
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'metrics-{}.json'.format(os.getpid()))))
+
+    def test_request_stages(self):
+        from mme_server import metrics
+        with metrics.tracked_request() as result:
+            with metrics.timed('search'):
+                pass
+            self.assertEqual(list(metrics.get_request_stages()), ['search'])
+            result['status'] = 200
+        # Kept until the next request of the thread, so callers can read them
+        self.assertEqual(list(metrics.get_request_stages()), ['search'])
+        with metrics.tracked_request() as result:
+            self.assertEqual(metrics.get_request_stages(), {})
+
+    def test_metrics_endpoint(self):
+        from mme_server.server import app
+        response = app.test_client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'# TYPE mme_match_stage_seconds histogram', response.data)
+
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from mme_server.profiler import RequestProfiler
+        self.directory = tempfile.mkdtemp()
+        self.profiler = RequestProfiler(self.directory, threshold=0.05, interval=0.001, max_files=2)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def busy(self, seconds):
+        import time
+        start = time.time()
+        while time.time() - start < seconds:
+            sum(range(100))
+
+    def test_sample_slow_request(self):
+        from mme_server.profiler import list_profiles, read_profile
+        self.profiler.start()
+        self.busy(0.1)
+        name = self.profiler.stop('request1', 0.1)
+
+        self.assertEqual(list_profiles(self.directory), [name])
+        info, stacks = read_profile(self.directory, name)
+        self.assertEqual(info['request_id'], 'request1')
+        self.assertEqual(info['reason'], 'slow')
+        self.assertTrue(stacks)
+        self.assertTrue(any(['busy (' in stack for stack in stacks]))
+
+    def test_skip_fast_request(self):
+        from mme_server.profiler import list_profiles
+        self.profiler.start()
+        self.assertIsNone(self.profiler.stop('request1', 0.01))
+        self.assertEqual(list_profiles(self.directory), [])
+
+    def test_rotate_and_summarize(self):
+        from mme_server.profiler import list_profiles, summarize_profiles
+        for i in range(3):
+            info = {'request_id': 'request{}'.format(i), 'reason': 'slow', 'time': 1000 + i, 'seconds': i,
+                    'stages': {'search': i}}
+            self.profiler.write(info, {'main;match;search': 3, 'main;match': 1})
+
+        self.assertEqual(len(list_profiles(self.directory)), 2)
+        summary = summarize_profiles(self.directory)
+        self.assertEqual(summary['profiles'], 2)
+        self.assertEqual(summary['samples'], 8)
+        self.assertEqual(summary['stages'], {'search': 1.5})
+        self.assertEqual(summary['slowest'][0], (2, 'request2'))
+        self.assertEqual(summary['self'][0], ('search', 0.75))
+        self.assertEqual(summary['total'][:2], [('main', 1.0), ('match', 1.0)])
+
+
+class FederationTests(TestCase):
+    def setUp(self):
+        from mme_server import federation
+        federation._peer_health.clear()
+        self.request = deepcopy(EXAMPLE_REQUEST)
+        self.stubs = {}
+
+    def tearDown(self):
+        for stub in self.stubs.values():
+            stub.close()
+
+    def add_stub(self, server_id, scores, **kwargs):
+        results = [{'score': {'patient': score}, 'patient': EXAMPLE_REQUEST['patient']} for score in scores]
+        self.stubs[server_id] = StubServer(results, **kwargs)
+
+    def match(self, **kwargs):
+        from mme_server.federation import match_servers
+        servers = [{'server_id': server_id, 'server_key': 'key-' + server_id, 'base_url': stub.base_url}
+                   for server_id, stub in sorted(self.stubs.items())]
+        return match_servers(self.request, servers, **kwargs)
+
+    def test_merge_responses(self):
+        self.add_stub('a', [0.9, 0.2])
+        self.add_stub('b', [0.5])
+        response = self.match()
+        self.assertEqual([(result['server_id'], result['score']['patient']) for result in response['results']],
+                         [('a', 0.9), ('b', 0.5), ('a', 0.2)])
+        path, headers, data = self.stubs['b'].requests[0]
+        self.assertEqual(path, '/v1/match')
+        self.assertEqual(headers['X-Auth-Token'], 'key-b')
+        self.assertEqual(data, self.request)
+
+    def test_errors(self):
+        self.add_stub('a', [0.9])
+        self.add_stub('b', [0.5], status=500)
+        response = self.match()
+        self.assertEqual([result['server_id'] for result in response['results']], ['a'])
+        statuses = dict([(outcome['server_id'], outcome['status']) for outcome in response['servers']])
+        self.assertEqual(statuses, {'a': 'ok', 'b': 'error'})
+
+    def test_deadline(self):
+        import time
+        self.add_stub('a', [0.9])
+        self.add_stub('b', [0.5], delay=1)
+        start = time.time()
+        response = self.match(timeout=5, deadline=0.3)
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual([result['server_id'] for result in response['results']], ['a'])
+        statuses = dict([(outcome['server_id'], outcome['status']) for outcome in response['servers']])
+        self.assertEqual(statuses, {'a': 'ok', 'b': 'timeout'})
+
+    def test_open_circuit(self):
+        from mme_server.federation import get_health
+        self.add_stub('a', [0.9])
+        self.add_stub('b', [0.5], status=500)
+        for i in range(5):
+            self.match()
+        response = self.match()
+        statuses = dict([(outcome['server_id'], outcome['status']) for outcome in response['servers']])
+        self.assertEqual(statuses, {'a': 'ok', 'b': 'unavailable'})
+        self.assertEqual(len(self.stubs['b'].requests), 5)
+        self.assertEqual(get_health({'server_id': 'a'}).successes, 6)
+
+
 class EndToEndTests(unittest.TestCase):
     def setUp(self):
         from mme_server.cli import main
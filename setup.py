@@ -20,7 +20,17 @@ INSTALL_REQUIRES = [
     'rdflib',
     'jsonschema',
     'rfc3987',
+    # Pooled connections to other servers (also required by elasticsearch)
+    'urllib3',
 ]
+EXTRAS_REQUIRE = {
+    # In-process semantic similarity scoring
+    'similarity': ['numpy'],
+    # Serving requests from multiple worker processes
+    'production': ['gunicorn'],
+    # Serving requests from an asyncio event loop (Python 3.5+)
+    'async': ['uvicorn'],
+}
 KEYWORDS = ['Matchmaker Exchange', 'Matchmaker Exchange API', 'patient matchmaking', 'genomics', 'rare disease']
 CLASSIFIERS = [
     'Development Status :: 3 - Alpha',
@@ -47,6 +57,7 @@ setup(
     keywords=KEYWORDS,
     classifiers=CLASSIFIERS,
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     include_package_data=True,
     zip_safe=False,
     test_suite='mme_server.tests',